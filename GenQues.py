@@ -4,17 +4,20 @@ from PyQt5.QtWidgets import (
     QApplication, QWidget, QHBoxLayout, QVBoxLayout, QPushButton,
     QLabel, QListWidget, QFileDialog, QMessageBox, QSplitter, QProgressBar,
     QCheckBox, QGroupBox, QTreeWidget, QTreeWidgetItem, QHeaderView,
-    QTabWidget, QTextEdit, QTreeWidgetItemIterator, QSpinBox, QDialog
+    QTabWidget, QTextEdit, QTreeWidgetItemIterator, QSpinBox, QDialog, QAbstractItemView
 )
-from PyQt5.QtCore import Qt, QThread, pyqtSignal
+from PyQt5.QtCore import Qt, QThread, QTimer, QUrl, pyqtSignal
 from PyQt5.QtWebEngineWidgets import QWebEngineView
-from PyQt5.QtGui import QFont
+from PyQt5.QtGui import QBrush, QColor, QFont
 import mammoth
 from dotenv import load_dotenv
 from google.oauth2 import service_account
 import glob
 import difflib
 import threading
+import multiprocessing
+import queue
+from process.cancellation import CancellationToken
 
 load_dotenv()
 
@@ -43,13 +46,46 @@ check_pandoc_availability()
 # ============================================================
 # PHẦN ĐA LUỒNG (MULTITHREADING) - TỐI ƯU
 # ============================================================
+# Tên model chuẩn đã test thành công
+MODEL_NAME = "gemini-2.5-pro"
+# Cột nhập khoảng trang trong cây tài liệu
+PAGE_COLUMN = 2
+
 class TaskInfo:
     """Class lưu thông tin cho từng nhiệm vụ nhỏ"""
-    def __init__(self, output_name, pdf_files, task_type, prompt_content):
+    def __init__(self, output_name, pdf_files, task_type, prompt_content, page_ranges=None, aliases=None):
         self.output_name = output_name
         self.pdf_files = pdf_files
         self.task_type = task_type  # "TN" hoặc "DS"
         self.prompt_content = prompt_content
+        # {đường dẫn PDF: "40-62"} - chỉ gửi các trang này (không có = cả file)
+        self.page_ranges = page_ranges or {}
+        # Tên các nhóm trùng nội dung: dùng chung kết quả (link file) thay vì sinh lại
+        self.aliases = aliases or []
+
+    def to_payload(self):
+        """Chuyển thành dict để lưu vào hàng đợi bền vững"""
+        payload = {
+            "output_name": self.output_name,
+            "pdf_files": list(self.pdf_files),
+            "task_type": self.task_type,
+            "prompt_content": self.prompt_content,
+        }
+        if self.page_ranges:
+            payload["page_ranges"] = dict(self.page_ranges)
+        if self.aliases:
+            payload["aliases"] = list(self.aliases)
+        return payload
+
+    @classmethod
+    def from_payload(cls, payload):
+        return cls(payload["output_name"], payload["pdf_files"], payload["task_type"], payload["prompt_content"],
+                   payload.get("page_ranges"), payload.get("aliases"))
+
+def get_default_job_queue():
+    """Hàng đợi SQLite dùng chung cho GUI (nằm cạnh file exe/script)"""
+    from process.job_queue import JobQueue
+    return JobQueue(os.path.join(external_path, "jobs.db"))
 
 class ProcessingThread(QThread):
     progress = pyqtSignal(str)
@@ -57,24 +93,51 @@ class ProcessingThread(QThread):
     error_signal = pyqtSignal(str)
     progress_update = pyqtSignal(int, int)
 
-    def __init__(self, selected_items, prompt_paths, project_id, creds, max_workers=3):
+    def __init__(self, selected_items, prompt_paths, project_id, creds, max_workers=3, job_queue=None,
+                 render_processes=0, page_ranges=None, group_files=None):
         super().__init__()
         self.selected_items = selected_items
+        self.page_ranges = page_ranges or {}
+        # Hàm gom nhóm của GUI: có thì gộp file/nhóm trùng nội dung trước khi tạo task
+        self.group_files = group_files
+        self.group_aliases = {}
         self.prompt_paths = prompt_paths
         self.project_id = project_id
         self.creds = creds
         self.max_workers = max_workers
+        self.render_processes = render_processes
         self.generated_files = []
         self.is_running = True
         self.lock = threading.Lock()
+        self.job_queue = job_queue
+        self.cancel_token = CancellationToken()
+        self.cancelled_tasks = []
+        self.in_flight = {}
+        self.lease_keeper = None
+        self.submit_interval = 0.1
+        # Mỗi tác vụ một dòng JSON: thời gian từng công đoạn, số lần gọi pandoc/ảnh, token
+        from process.metrics import MetricsLog
+        self.metrics_log = MetricsLog(os.getenv("METRICS_LOG") or os.path.join(external_path, "metrics.jsonl"))
+        # Cộng dồn token/ảnh/chi phí theo tác vụ -> nhóm -> lô, dừng khi vượt ngân sách (BUDGET_*)
+        from process.budget import Budget, UsageLedger
+        self.ledger = UsageLedger()
+        self.budget = Budget.from_env()
+        self.budget_reason = None
 
     def run(self):
-        """Logic chạy chính: Tách nhỏ tác vụ để chạy song song thực sự"""
-        import time
-        import concurrent.futures
+        """
+        Logic chạy chính: GUI chỉ là một producer/consumer của hàng đợi bền vững.
+        1. Đẩy các task mới vào hàng đợi (kèm độ ưu tiên).
+        2. Các luồng con lease job theo thứ tự ưu tiên cho tới khi hàng đợi cạn.
+        """
+        import uuid
+        from process.job_queue import estimate_group_size
 
         self.progress.emit("⚙️ Đang chuẩn bị dữ liệu và đọc Prompt...")
 
+        if self.job_queue is None:
+            self.job_queue = get_default_job_queue()
+
         # 1. Đọc Prompt một lần duy nhất để tối ưu I/O
         prompt_content_tn = ""
         prompt_content_ds = ""
@@ -101,23 +164,65 @@ class ProcessingThread(QThread):
             except Exception as e:
                 self.error_signal.emit(f"Lỗi đọc prompt TLN: {e}")
                 return
-        # 2. Tạo danh sách công việc (Flattened List)
+        # 2. Gộp file/nhóm trùng nội dung (băm SHA-256 cả file ở lần đầu -> làm ở đây, không chặn UI)
+        if self.group_files and self.selected_items:
+            self._dedupe_selection()
+
+        # 3. Tạo danh sách công việc (Flattened List)
         # Tách riêng TN và DS thành các task độc lập
         all_tasks = []
         
         for output_name, pdf_files in self.selected_items.items():
+            group_ranges = {path: self.page_ranges[path] for path in pdf_files if path in self.page_ranges}
+            aliases = self.group_aliases.get(output_name)
             # Nếu user chọn TN, tạo task TN
             if prompt_content_tn:
-                all_tasks.append(TaskInfo(output_name, pdf_files, "TN", prompt_content_tn))
+                all_tasks.append(TaskInfo(output_name, pdf_files, "TN", prompt_content_tn, group_ranges, aliases))
             
             # Nếu user chọn DS, tạo task DS (độc lập hoàn toàn với TN)
             if prompt_content_ds:
-                all_tasks.append(TaskInfo(output_name, pdf_files, "DS", prompt_content_ds))
+                all_tasks.append(TaskInfo(output_name, pdf_files, "DS", prompt_content_ds, group_ranges, aliases))
             # Nếu user chọn TLN, tạo task TLN (độc lập hoàn toàn với TN và DS)
             if prompt_content_tln:
-                all_tasks.append(TaskInfo(output_name, pdf_files, "TLN", prompt_content_tln))
+                all_tasks.append(TaskInfo(output_name, pdf_files, "TLN", prompt_content_tln, group_ranges, aliases))
+
+        if self.group_aliases:
+            self.progress.emit("🔗 Nhóm trùng nội dung dùng chung kết quả: " + "; ".join(
+                f"{name} -> {', '.join(aliases)}" for name, aliases in self.group_aliases.items()))
+
+        # Ước tính token/chi phí trước khi chạy (từ số trang PDF và độ dài prompt)
+        from process.budget import format_estimate, preflight_estimate
+        estimate = preflight_estimate(all_tasks, self.ledger.pricing)
+        if estimate["tasks"]:
+            self.progress.emit(format_estimate(estimate))
+        if self.budget.enabled:
+            self.progress.emit(f"💳 Ngân sách: {self.budget.describe()}")
+            over = self.budget.exceeded(estimate)
+            if over:
+                self.progress.emit(f"⚠️ Ước tính đã vượt ngân sách ({over}) - sẽ dừng khi chạm giới hạn")
+
+        # 4. Đẩy vào hàng đợi bền vững (task trùng đang chờ sẽ không bị nhân đôi; sửa prompt/khoảng trang -> cập nhật payload)
+        batch_id = uuid.uuid4().hex
+        try:
+            # Lease của phiên GUI trước bị tắt ngang / worker đã chết -> trả về hàng đợi ngay,
+            # không phải chờ hết visibility timeout (30 phút) mới chạy tiếp được
+            reclaimed = self.job_queue.reclaim_orphaned()
+            if reclaimed:
+                self.progress.emit(f"♻️ Thu hồi {reclaimed} tác vụ dở dang của phiên trước")
+            for task in all_tasks:
+                self.job_queue.enqueue(
+                    task.task_type,
+                    task.output_name,
+                    task.to_payload(),
+                    batch_id=batch_id,
+                    size_hint=estimate_group_size(task.pdf_files)
+                )
+        except Exception as e:
+            self.error_signal.emit(f"Lỗi ghi hàng đợi: {e}")
+            return
 
-        total_tasks = len(all_tasks)
+        # Tổng số = task mới + task còn tồn từ phiên trước
+        total_tasks = self.job_queue.count_active()
         if total_tasks == 0:
             self.finished.emit([])
             return
@@ -125,118 +230,296 @@ class ProcessingThread(QThread):
         self.progress.emit(f"🚀 Bắt đầu xử lý {total_tasks} tác vụ (TN & DS tách biệt)...")
         self.progress_update.emit(0, total_tasks)
 
-        completed_count = 0
-        failed_count = 0
-
-        # 3. Thực thi song song
-        with concurrent.futures.ThreadPoolExecutor(max_workers=self.max_workers) as executor:
-            # Map future -> task để theo dõi
-            future_to_task = {}
-            
-            for task in all_tasks:
-                if not self.is_running: break
-                
-                # Submit task vào pool
-                future = executor.submit(self._process_worker, task, self.project_id, self.creds)
-                future_to_task[future] = task
-                
-                # Nghỉ cực ngắn để tránh spam API cùng 1 mili-giây gây lỗi 429
-                time.sleep(0.1)
-
-            # Thu thập kết quả khi từng task hoàn thành
-            for future in concurrent.futures.as_completed(future_to_task):
-                if not self.is_running: break
-                
-                task = future_to_task[future]
-                try:
-                    result_path, error_msg = future.result()
-                    
-                    with self.lock:
-                        completed_count += 1
-                        if result_path:
-                            self.generated_files.append(result_path)
-                            status_icon = "✅"
-                            msg = f"Xong {task.output_name} ({task.task_type})"
-                        else:
-                            failed_count += 1
-                            status_icon = "⚠️"
-                            msg = f"Lỗi {task.output_name} ({task.task_type}): {error_msg}"
-                    
-                    self.progress.emit(f"{status_icon} [{completed_count}/{total_tasks}] {msg}")
-                    self.progress_update.emit(completed_count, total_tasks)
-
-                except Exception as e:
-                    with self.lock:
-                        failed_count += 1
-                        completed_count += 1
-                    self.progress.emit(f"❌ Lỗi ngoại lệ tại {task.output_name}: {str(e)}")
-                    self.progress_update.emit(completed_count, total_tasks)
-
-        # 4. Tổng kết
+        self.completed_count = 0
+        self.failed_count = 0
+        self.total_tasks = total_tasks
+
+        # 5. Pipeline theo stage: model (I/O) -> parse -> render (CPU) -> save (disk)
+        # GENQUES_ASYNC=1: request model/ảnh chạy trên asyncio, số request song song chỉ giới hạn
+        # bởi quota (MODEL_RPM/IMAGE_RPM, ASYNC_MAX_IN_FLIGHT) thay vì số luồng
+        from process.async_pipeline import AsyncGenerationPipeline, async_mode_enabled
+        if async_mode_enabled():
+            self.pipeline = AsyncGenerationPipeline(
+                self.project_id, self.creds, MODEL_NAME, cancel_token=self.cancel_token
+            ).start()
+            # Bộ giới hạn tốc độ của pipeline đã giãn request, không cần nghỉ giữa các lần lease
+            self.submit_interval = 0
+            self.progress.emit(f"⚡ Chế độ asyncio: tối đa {self.pipeline.capacity} tác vụ đồng thời")
+        else:
+            from process.pipeline import build_generation_pipeline
+            self.pipeline = build_generation_pipeline(
+                self.project_id, self.creds, MODEL_NAME,
+                cancel_token=self.cancel_token,
+                model_workers=self.max_workers,
+                render_processes=self.render_processes
+            ).start()
+        metrics_server = self._start_metrics_server()
+        try:
+            self._feed_pipeline(f"gui-{batch_id[:8]}")
+        except Exception as e:
+            self.progress.emit(f"❌ Lỗi luồng xử lý: {str(e)}")
+        finally:
+            self.pipeline.close()
+            self.pipeline.join(timeout=30)
+            if metrics_server is not None:
+                metrics_server.stop()
+
+        # 6. Tổng kết
+        from process.metrics import aggregate, format_summary
+        dead_count = len(self.job_queue.dead_letters())
         summary = (
             f"🏁 Đã xử lý xong!\n"
-            f"✅ Thành công: {completed_count - failed_count}\n"
-            f"❌ Thất bại: {failed_count}\n"
+            f"✅ Thành công: {self.completed_count - self.failed_count}\n"
+            f"❌ Thất bại: {self.failed_count}\n"
+            f"☠️ Dead-letter: {dead_count}\n"
+            f"⏹️ Đã hủy: {len(self.cancelled_tasks)} (sẽ chạy tiếp ở lần sau)\n"
             f"📄 Tổng file: {len(self.generated_files)}"
         )
+        if self.budget_reason:
+            summary += f"\n💳 Dừng do vượt ngân sách: {self.budget_reason}"
+        timing = format_summary(aggregate(self.metrics_log.records))
+        if timing:
+            summary += f"\n{timing}"
+        usage = self.ledger.format_summary()
+        if usage:
+            summary += f"\n{usage}"
+        self.job_queue.close()
         self.progress.emit(summary)
         self.finished.emit(self.generated_files)
 
-    def stop(self):
-        self.is_running = False
+    def _dedupe_selection(self):
+        """File giống hệt nội dung chỉ sinh một lần; nhóm bản sao trùng nhóm chính -> chỉ link kết quả"""
+        from process.dedupe import dedupe_selection
+
+        file_paths = sorted({path for paths in self.selected_items.values() for path in paths})
+        self.progress.emit(f"🔍 Đang kiểm tra nội dung trùng của {len(file_paths)} file...")
+        self.selected_items, self.group_aliases, copy_count = dedupe_selection(
+            file_paths, self.group_files, self.page_ranges)
+        if copy_count:
+            alias_count = sum(len(names) for names in self.group_aliases.values())
+            self.progress.emit(f"🔗 {copy_count} file trùng nội dung được gộp; {alias_count} nhóm dùng chung kết quả")
+
+    def _start_metrics_server(self):
+        """Endpoint /metrics cho chạy không giám sát (bật bằng biến môi trường METRICS_PORT)"""
+        port = int(os.getenv("METRICS_PORT", "0") or 0)
+        if not port:
+            return None
+        from process.metrics_server import MetricsServer, build_generation_registry
+        try:
+            registry = build_generation_registry(self.job_queue, in_flight=lambda: len(self.in_flight))
+            return MetricsServer(registry, port).start()
+        except OSError as e:
+            self.progress.emit(f"⚠️ Không mở được cổng metrics {port}: {e}")
+            return None
+
+    def _feed_pipeline(self, owner):
+        """
+        Luồng điều phối: lease job khi pipeline còn chỗ, nhận kết quả để complete/fail.
+        Số job đang xử lý không vượt quá sức chứa của pipeline (backpressure tới hàng đợi).
+        Lease của mọi job đang chạy được gia hạn bởi một luồng heartbeat chung (pipeline asyncio
+        giữ tới hàng trăm job, mỗi job một luồng heartbeat thì mất ý nghĩa "ít luồng").
+        """
+        from process.job_queue import SharedLeaseKeeper
+        from process.pipeline import PipelineItem
+
+        job_queue = self.job_queue
+        in_flight = self.in_flight = {}
+        capacity = self.pipeline.capacity
+
+        # Đăng ký owner như một node sống (mỗi 30 giây) để phiên khác không thu hồi nhầm lease đang chạy
+        with SharedLeaseKeeper(job_queue, owner, interval=30, node_info={"kind": "gui"}) as keeper:
+            self.lease_keeper = keeper
+            while True:
+                # Xử lý các kết quả đã về
+                self._drain_results(owner, in_flight, timeout=0)
+
+                if self.is_running and len(in_flight) < capacity:
+                    job = job_queue.lease(owner)
+                    if job is not None:
+                        keeper.add(job.id)
+                        item = PipelineItem(job.id, job.payload, context=job)
+                        in_flight[job.id] = item
+                        self.pipeline.submit(item)
+                        # Nghỉ cực ngắn để tránh spam API cùng 1 mili-giây gây lỗi 429
+                        if self.submit_interval:
+                            self.cancel_token.wait(self.submit_interval)
+                        continue
+
+                if not in_flight:
+                    # Còn job đang chờ retry -> đợi; hết hẳn hoặc đã dừng -> thoát
+                    if not self.is_running or not job_queue.has_active():
+                        return
+                    self.cancel_token.wait(1)
+                    continue
+
+                self._drain_results(owner, in_flight, timeout=0.5)
+
+    def _drain_results(self, owner, in_flight, timeout):
+        """Lấy kết quả từ pipeline và cập nhật hàng đợi + tiến độ"""
+        import queue as queue_module
+        from process.job_queue import STATE_DEAD
+
+        while True:
+            try:
+                item = self.pipeline.results.get(timeout=timeout) if timeout else self.pipeline.results.get_nowait()
+            except queue_module.Empty:
+                return
+            timeout = 0
+            job = item.context
+            self.lease_keeper.discard(job.id)
+            in_flight.pop(job.id, None)
+            status = "cancelled" if item.cancelled else ("done" if item.result else "error")
+            record = self.metrics_log.write(item.metrics, job_id=job.id, status=status, error=item.error)
+            self.ledger.add(record, group=job.output_name, batch=job.batch_id or "")
+            self._check_budget()
+            if item.profiler is not None:
+                profile_path = item.profiler.dump()
+                if profile_path:
+                    self.progress.emit(f"🔬 Profile {item.label}: {profile_path}")
+
+            if item.cancelled:
+                # Trả job về hàng đợi để lần sau chạy tiếp, không tính là lỗi
+                self.job_queue.release(job.id, owner)
+                self.cancelled_tasks.append(item.label)
+                self.progress.emit(f"⏹️ Đã hủy {item.label}")
+                continue
+
+            if item.result:
+                self.job_queue.complete(job.id, owner, item.result)
+                self.completed_count += 1
+                self.generated_files.append(item.result)
+                self.generated_files.extend(item.linked_results)
+                self.progress.emit(f"✅ [{self.completed_count}/{self.total_tasks}] Xong {item.label}")
+                self.progress_update.emit(self.completed_count, self.total_tasks)
+                continue
+
+            error_msg = item.error or "Không rõ lỗi"
+            new_state = self.job_queue.fail(job.id, owner, error_msg)
+            if new_state == STATE_DEAD:
+                self.completed_count += 1
+                self.failed_count += 1
+                self.progress.emit(f"⚠️ [{self.completed_count}/{self.total_tasks}] Lỗi {item.label}: {error_msg}")
+                self.progress_update.emit(self.completed_count, self.total_tasks)
+            else:
+                self.progress.emit(
+                    f"🔁 Lỗi {item.label}, sẽ thử lại (lần {job.attempts}/{job.max_attempts}): {error_msg}"
+                )
 
-    @staticmethod
-    def _process_worker(task, project_id, creds):
+    def _check_budget(self):
         """
-        Hàm xử lý chạy trong từng luồng con.
+        Vượt ngân sách -> pause: ngừng lease job mới (job đang chạy làm nốt, phần còn lại ở trong
+        hàng đợi cho lần sau); stop: hủy luôn các job đang chạy (cũng được trả về hàng đợi).
+        Chỉ tính tác vụ đã kết thúc nên có thể vượt thêm tối đa phần của các job đang chạy.
         """
-        import os
-        from process.response2docx import response2docx_json, response2docx_dung_sai_json, response2docx_tra_loi_ngan_json
+        if self.budget_reason or not self.budget.enabled:
+            return
+        reason = self.budget.exceeded(self.ledger.snapshot())
+        if not reason:
+            return
+        self.budget_reason = reason
+        if self.budget.action == "stop":
+            self.progress.emit(f"💳 Vượt ngân sách ({reason}) - dừng và hủy các tác vụ đang chạy")
+            self.stop()
+        else:
+            self.progress.emit(f"💳 Vượt ngân sách ({reason}) - tạm dừng, các tác vụ đang chạy sẽ làm nốt")
+            self.is_running = False
+
+    def stop(self):
+        """Dừng thật sự: ngừng lease job mới và hủy các lời gọi AI/ảnh/pandoc đang chạy"""
+        self.is_running = False
+        self.cancel_token.cancel()
+
+# ============================================================
+# XEM TRƯỚC DOCX CHẠY NỀN (KHÔNG CHẶN GIAO DIỆN)
+# ============================================================
 
-        # Tên model chuẩn đã test thành công
-        MODEL_NAME = "gemini-2.5-pro" 
+PREVIEW_MAX_SIZE_MB = 10.0
+
+def preview_cache_key(path):
+    """Khóa cache: đường dẫn + mtime + kích thước (file bị ghi lại -> khóa mới)"""
+    st = os.stat(path)
+    return (os.path.normcase(os.path.abspath(path)), st.st_mtime_ns, st.st_size)
+
+def convert_docx_to_html(full_path):
+    """Chuyển DOCX -> HTML bằng mammoth (chạy trong PreviewLoader, không chạy trên luồng UI)"""
+    file_size_mb = os.path.getsize(full_path) / (1024 * 1024)
+    if file_size_mb > PREVIEW_MAX_SIZE_MB:
+        return f"""<html><body style="font-family: Arial; text-align: center; padding-top: 50px;">
+            <h2 style="color: #f44336;">⚠️ File quá lớn để xem trước ({file_size_mb:.2f} MB)</h2>
+            <p>Vui lòng nhấn nút <b>"↗️ Mở bằng Word/WPS"</b> ở góc trên.</p></body></html>"""
+
+    with open(full_path, "rb") as docx_file:
+        result = mammoth.convert_to_html(docx_file)
+    html = result.value.strip()
+    if not html:
+        return "<p>File không có nội dung để hiển thị.</p>"
+    return f"""<html><head><style>
+            body {{ font-family: 'Segoe UI', Arial, sans-serif; padding: 30px; line-height: 1.6; color: #333; }}
+            p {{ margin-bottom: 15px; }}
+            img {{ max-width: 100%; height: auto; border: 1px solid #ddd; }}
+            table {{ border-collapse: collapse; width: 100%; margin: 15px 0; }}
+            th, td {{ border: 1px solid #ddd; padding: 8px; }}
+        </style></head><body>{html}</body></html>"""
+
+class PreviewLoader(QThread):
+    """
+    Luồng nền chuyển DOCX -> HTML, kết quả giữ trong LRU theo (path, mtime, size).
+    File đang chọn được ưu tiên hơn file lân cận (prefetch); yêu cầu đã cũ bị bỏ qua.
+    """
+    preview_ready = pyqtSignal(str, str)
+
+    PRIORITY_CURRENT = 0
+    PRIORITY_PREFETCH = 1
+
+    def __init__(self, cache_size=32):
+        super().__init__()
+        from process.response2docx import LruCache
+        self.cache = LruCache(cache_size)
+        self.requests = queue.PriorityQueue()
+        self.lock = threading.Lock()
+        self.wanted = set()
+        self.sequence = 0
+        self.is_running = True
 
+    def cached(self, path):
         try:
-            if task.task_type == "TN":
-                output_filename = f"{task.output_name}_TN"
-                docx_path = response2docx_json(
-                    task.pdf_files,
-                    task.prompt_content,
-                    output_filename,
-                    project_id,
-                    creds,
-                    MODEL_NAME, 
-                    batch_name=task.output_name
-                )
-            elif task.task_type == "DS":
-                output_filename = f"{task.output_name}_DS"
-                docx_path = response2docx_dung_sai_json(
-                    task.pdf_files,
-                    task.prompt_content,
-                    output_filename,
-                    project_id,
-                    creds,
-                    MODEL_NAME, 
-                    batch_name=task.output_name
-                )
-            else:# task.task_type == "TLN":
-                output_filename = f"{task.output_name}_TLN"
-                docx_path = response2docx_tra_loi_ngan_json(
-                    task.pdf_files,
-                    task.prompt_content,
-                    output_filename,
-                    project_id,
-                    creds,
-                    MODEL_NAME,
-                    batch_name=task.output_name
-                )
-            if docx_path and os.path.exists(docx_path):
-                return docx_path, None
-            else:
-                return None, "Hàm trả về None hoặc file không tồn tại"
+            return self.cache.get(preview_cache_key(path))
+        except OSError:
+            return None
+
+    def request(self, current_path, neighbour_paths=()):
+        """Đặt lại danh sách cần tải: file đang chọn (None nếu đã có trong cache) + các file lân cận"""
+        with self.lock:
+            self.wanted = {current_path, *neighbour_paths}
+            if current_path:
+                self.sequence += 1
+                self.requests.put((self.PRIORITY_CURRENT, self.sequence, current_path))
+            for path in neighbour_paths:
+                self.sequence += 1
+                self.requests.put((self.PRIORITY_PREFETCH, self.sequence, path))
 
-        except Exception as e:
-            return None, str(e)
+    def run(self):
+        while self.is_running:
+            _, _, path = self.requests.get()
+            if path is None:
+                break
+            with self.lock:
+                if path not in self.wanted:
+                    continue
+            try:
+                key = preview_cache_key(path)
+                html = self.cache.get(key)
+                if html is None:
+                    html = convert_docx_to_html(path)
+                    self.cache.put(key, html)
+            except Exception as e:
+                html = f"<h3>Lỗi khi đọc file</h3><p>{str(e)}</p>"
+            self.preview_ready.emit(path, html)
+
+    def stop(self):
+        self.is_running = False
+        # Đánh thức luồng đang chờ; ưu tiên -1 để được lấy trước mọi yêu cầu còn lại
+        self.requests.put((-1, 0, None))
 
 # ============================================================
 # PHẦN GIAO DIỆN CHÍNH (MainWindow)
@@ -249,6 +532,11 @@ class MainWindow(QWidget):
         self.resize(1400, 850)
         self.generated_files = []
         self.processing_thread = None
+        self.job_queue = get_default_job_queue()
+        self.preview_loader = PreviewLoader()
+        self.preview_loader.preview_ready.connect(self.on_preview_ready)
+        self.preview_loader.start()
+        self.current_preview_path = None
         
         # Prompt files mặc định
         self.default_prompt_tn = self._get_priority_path("testTN.txt")
@@ -269,6 +557,29 @@ class MainWindow(QWidget):
         self.setup_modern_theme()
         self.init_ui()
         self.setup_credentials()
+        # Hỏi chạy tiếp các job còn tồn sau khi cửa sổ đã hiển thị
+        QTimer.singleShot(0, self.check_unfinished_jobs)
+
+    def check_unfinished_jobs(self):
+        """Phát hiện job còn dở từ phiên trước (cửa sổ bị đóng giữa chừng)"""
+        try:
+            remaining = self.job_queue.count_active()
+        except Exception as e:
+            print(f"⚠️ Không đọc được hàng đợi: {e}")
+            return
+        if remaining == 0:
+            return
+
+        confirm = QMessageBox.question(
+            self, "Còn việc chưa xong",
+            f"Phiên trước còn {remaining} tác vụ chưa hoàn thành.\nBạn có muốn chạy tiếp không?",
+            QMessageBox.Yes | QMessageBox.No
+        )
+        if confirm == QMessageBox.Yes:
+            self.start_processing({}, {})
+        else:
+            self.job_queue.discard_active()
+
     def _get_priority_path(self, filename):
         """
         Hàm helper tìm đường dẫn file theo thứ tự ưu tiên:
@@ -470,7 +781,13 @@ class MainWindow(QWidget):
         
         self.just_checked = False
         self.file_tree = QTreeWidget()
-        self.file_tree.setHeaderLabels(["Tên Tài Liệu", "Đường Dẫn Chi Tiết"])
+        self.file_tree.setHeaderLabels(["Tên Tài Liệu", "Đường Dẫn Chi Tiết", "Trang"])
+        self.file_tree.headerItem().setToolTip(
+            PAGE_COLUMN, "Nhấp đúp để chọn trang (VD: 40-62, 70). Đặt ở thư mục = áp dụng cho mọi file bên trong"
+        )
+        # Chỉ cột "Trang" được sửa, bằng nhấp đúp (nhấp đơn vẫn là tick chọn)
+        self.file_tree.setEditTriggers(QAbstractItemView.NoEditTriggers)
+        self.file_tree.itemDoubleClicked.connect(self.edit_page_range)
         self.file_tree.setAlternatingRowColors(True)
         self.file_tree.setIndentation(20)
         self.file_tree.itemChanged.connect(self.handle_item_check_changed)
@@ -478,6 +795,7 @@ class MainWindow(QWidget):
         header = self.file_tree.header()
         header.setSectionResizeMode(0, QHeaderView.ResizeToContents)
         header.setSectionResizeMode(1, QHeaderView.Stretch)
+        header.setSectionResizeMode(PAGE_COLUMN, QHeaderView.ResizeToContents)
         self.file_tree.setColumnWidth(0, 450)
 
         self.file_tree.itemChanged.connect(self.handle_item_check_changed)
@@ -576,6 +894,9 @@ class MainWindow(QWidget):
         self.thread_spinbox.setValue(3)
         self.thread_spinbox.setFixedWidth(60)
         thread_layout.addWidget(self.thread_spinbox)
+        self.checkbox_multiprocess = QCheckBox("Render đa tiến trình")
+        self.checkbox_multiprocess.setToolTip("Dựng DOCX trong nhiều tiến trình (nhanh hơn khi xử lí nhiều bài, tốn RAM hơn)")
+        thread_layout.addWidget(self.checkbox_multiprocess)
         # thread_layout.addWidget(QLabel("(Dựa trên số bài xử lí, ví dụ: xử lí 2 bài thì tăng x2 số luồng)"))
         thread_layout.addStretch()
         
@@ -584,6 +905,12 @@ class MainWindow(QWidget):
         self.process_button.setMinimumHeight(50)
         self.process_button.clicked.connect(self.process_files)
         
+        self.stop_button = QPushButton("⏹ DỪNG")
+        self.stop_button.setMinimumHeight(50)
+        self.stop_button.setStyleSheet("color: #c62828; border-color: #ef9a9a;")
+        self.stop_button.setEnabled(False)
+        self.stop_button.clicked.connect(self.stop_processing)
+        
         self.progress_bar = QProgressBar()
         self.progress_bar.setVisible(False)
         self.progress_bar.setTextVisible(True)
@@ -594,7 +921,10 @@ class MainWindow(QWidget):
         self.status_label.setStyleSheet("font-weight: bold; color: #555; min-height: 40px;")
         
         action_layout.addLayout(thread_layout)
-        action_layout.addWidget(self.process_button)
+        button_row = QHBoxLayout()
+        button_row.addWidget(self.process_button, 4)
+        button_row.addWidget(self.stop_button, 1)
+        action_layout.addLayout(button_row)
         action_layout.addWidget(self.progress_bar)
         action_layout.addWidget(self.status_label)
 
@@ -619,7 +949,10 @@ class MainWindow(QWidget):
         lbl_result.setStyleSheet("font-weight: bold; color: #2E7D32; padding: 5px;")
         
         self.docx_list = QListWidget()
-        self.docx_list.itemClicked.connect(self.show_selected_docx)
+        # currentItemChanged: bắt cả click chuột lẫn di chuyển bằng bàn phím
+        self.docx_list.currentItemChanged.connect(
+            lambda current, previous: current is not None and self.show_selected_docx(current)
+        )
         
         left_layout.addWidget(lbl_result)
         left_layout.addWidget(self.docx_list)
@@ -644,8 +977,14 @@ class MainWindow(QWidget):
         self.btn_open_external.clicked.connect(self.open_current_docx)
         self.btn_open_external.setEnabled(False)
         
+        self.btn_export = QPushButton("📤 Xuất Moodle/QTI/MD")
+        self.btn_export.setFixedSize(180, 35)
+        self.btn_export.setToolTip("Xuất toàn bộ file đã tạo sang Moodle XML, QTI, Markdown, JSON (không gọi lại AI)")
+        self.btn_export.clicked.connect(self.export_generated_files)
+        
         preview_header.addWidget(lbl_preview)
         preview_header.addStretch()
+        preview_header.addWidget(self.btn_export)
         preview_header.addWidget(self.btn_open_external)
         
         self.docx_viewer = QWebEngineView()
@@ -728,6 +1067,7 @@ class MainWindow(QWidget):
                     item.setText(1, file_path)
                     item.setCheckState(0, Qt.Checked)
                     item.setData(0, Qt.UserRole, "file")
+                    item.setFlags(item.flags() | Qt.ItemIsEditable)
             self.update_file_count()
 
     def add_folder(self):
@@ -742,6 +1082,7 @@ class MainWindow(QWidget):
         folder_item.setText(1, folder_path)
         folder_item.setCheckState(0, Qt.Checked)
         folder_item.setData(0, Qt.UserRole, "folder")
+        folder_item.setFlags(folder_item.flags() | Qt.ItemIsEditable)
         
         pdf_files = glob.glob(os.path.join(folder_path, "*.pdf"))
         for pdf_file in sorted(pdf_files):
@@ -750,6 +1091,7 @@ class MainWindow(QWidget):
             file_item.setText(1, pdf_file)
             file_item.setCheckState(0, Qt.Checked)
             file_item.setData(0, Qt.UserRole, "file")
+            file_item.setFlags(file_item.flags() | Qt.ItemIsEditable)
         
         for name in sorted(os.listdir(folder_path)):
             subfolder_path = os.path.join(folder_path, name)
@@ -759,8 +1101,32 @@ class MainWindow(QWidget):
         if is_root: folder_item.setExpanded(True)
         else: folder_item.setExpanded(False)
 
+    def edit_page_range(self, item, column):
+        if column == PAGE_COLUMN:
+            self.file_tree.editItem(item, PAGE_COLUMN)
+
+    def validate_page_range_item(self, item):
+        """Tô đỏ ô "Trang" gõ sai; trả về thông báo lỗi (None nếu hợp lệ)"""
+        from process.pdf_pages import PageRangeError, parse_page_ranges
+        try:
+            parse_page_ranges(item.text(PAGE_COLUMN))
+            item.setData(PAGE_COLUMN, Qt.ForegroundRole, None)
+            item.setToolTip(PAGE_COLUMN, "")
+            return None
+        except PageRangeError as e:
+            item.setForeground(PAGE_COLUMN, QBrush(QColor("#c62828")))
+            item.setToolTip(PAGE_COLUMN, str(e))
+            return str(e)
+
     def handle_item_check_changed(self, item, column):
         """Xử lý sự kiện khi user tick vào checkbox"""
+        if column == PAGE_COLUMN:
+            self.file_tree.blockSignals(True)
+            try:
+                self.validate_page_range_item(item)
+            finally:
+                self.file_tree.blockSignals(False)
+            return
         self.just_checked = True
         if column != 0: return
 
@@ -785,6 +1151,9 @@ class MainWindow(QWidget):
         if self.just_checked:
             self.just_checked = False
             return
+        # Cột "Trang" dùng để nhập khoảng trang, không đảo tick
+        if column == PAGE_COLUMN:
+            return
 
         # Nếu không phải bấm ô vuông (tức là bấm vào chữ), ta tự động đảo tick
         self.file_tree.blockSignals(True) # Chặn signal để tránh vòng lặp vô tận
@@ -1069,6 +1438,7 @@ class MainWindow(QWidget):
     def get_selected_items(self):
         """
         Lấy danh sách items và gom nhóm bằng thuật toán _smart_group_files CÓ SẴN.
+        (Gộp file/nhóm trùng nội dung cần băm cả file nên làm trong ProcessingThread, không chặn UI.)
         """
         # 1. Thu thập TẤT CẢ các file PDF đang được tick chọn vào 1 danh sách
         all_checked_pdfs = []
@@ -1229,6 +1599,38 @@ class MainWindow(QWidget):
             
         return groups
 
+    def get_page_ranges(self):
+        """
+        {đường dẫn PDF: khoảng trang} của các file đang chọn; file không ghi trang thì lấy của
+        thư mục gần nhất có ghi. Trả về (page_ranges, danh sách lỗi).
+        """
+        page_ranges = {}
+        errors = []
+
+        def traverse(item, inherited):
+            if item.checkState(0) == Qt.Unchecked:
+                return
+            spec = item.text(PAGE_COLUMN).strip() or inherited
+            if item.text(PAGE_COLUMN).strip():
+                error = self.validate_page_range_item(item)
+                if error:
+                    errors.append(f"{item.text(0)}: {error}")
+            item_type = item.data(0, Qt.UserRole)
+            if item_type == "file" and spec:
+                page_ranges[item.text(1)] = spec
+            elif item_type == "folder":
+                for i in range(item.childCount()):
+                    traverse(item.child(i), spec)
+
+        root = self.file_tree.invisibleRootItem()
+        self.file_tree.blockSignals(True)
+        try:
+            for i in range(root.childCount()):
+                traverse(root.child(i), "")
+        finally:
+            self.file_tree.blockSignals(False)
+        return page_ranges, errors
+
     def _collect_checked_pdfs_recursive(self, parent_item, pdf_list):
         """Lấy tất cả PDF trong folder"""
         for i in range(parent_item.childCount()):
@@ -1243,6 +1645,11 @@ class MainWindow(QWidget):
 
     def process_files(self):
         """Bắt đầu xử lý với đa luồng"""
+        page_ranges, range_errors = self.get_page_ranges()
+        if range_errors:
+            QMessageBox.warning(self, "Lỗi", "Khoảng trang không hợp lệ:\n" + "\n".join(range_errors))
+            return
+
         selected_items = self.get_selected_items()
         # print(f"🔍 Prompt TN hiện tại: {self.current_prompt_tn}")
         # print(f"🔍 Prompt DS hiện tại: {self.current_prompt_ds}")
@@ -1255,7 +1662,7 @@ class MainWindow(QWidget):
         if not self.checkbox_tn.isChecked() and not self.checkbox_ds.isChecked() and not self.checkbox_tln.isChecked():
             QMessageBox.warning(self, "Lỗi", "Vui lòng chọn ít nhất một dạng đề!")
             return
-        
+
         prompt_paths = {}
         if self.checkbox_tn.isChecked():
             prompt_file = self.current_prompt_tn 
@@ -1278,6 +1685,10 @@ class MainWindow(QWidget):
                 return
             prompt_paths["tra_loi_ngan"] = prompt_file
         
+        self.start_processing(selected_items, prompt_paths, page_ranges, group_files=self._smart_group_files)
+
+    def start_processing(self, selected_items, prompt_paths, page_ranges=None, group_files=None):
+        """Khởi chạy ProcessingThread (task mới + task còn tồn trong hàng đợi)"""
         self.set_ui_enabled(False)
         self.progress_bar.setVisible(True)
         self.progress_bar.setValue(0)
@@ -1286,6 +1697,10 @@ class MainWindow(QWidget):
         self.status_label.setText("⏳ Đang khởi tạo quá trình xử lý đa luồng...")
         
         max_workers = self.thread_spinbox.value()
+        render_processes = 0
+        if self.checkbox_multiprocess.isChecked():
+            from process.render_pool import default_process_count
+            render_processes = default_process_count()
         
         # Khởi tạo và chạy processing thread
         self.processing_thread = ProcessingThread(
@@ -1293,7 +1708,11 @@ class MainWindow(QWidget):
             prompt_paths,
             self.project_id,
             self.credentials,
-            max_workers
+            max_workers,
+            job_queue=self.job_queue,
+            render_processes=render_processes,
+            page_ranges=page_ranges,
+            group_files=group_files
         )
         
         self.processing_thread.progress.connect(self.update_status)
@@ -1322,6 +1741,24 @@ class MainWindow(QWidget):
         self.btn_edit_prompt_ds.setEnabled(enabled)
         self.btn_edit_prompt_tln.setEnabled(enabled)
         self.thread_spinbox.setEnabled(enabled)
+        self.checkbox_multiprocess.setEnabled(enabled)
+        self.stop_button.setEnabled(not enabled)
+
+    def stop_processing(self):
+        """Hủy các tác vụ đang chạy, các job chưa xong được giữ lại trong hàng đợi"""
+        if self.processing_thread and self.processing_thread.isRunning():
+            self.stop_button.setEnabled(False)
+            self.status_label.setText("⏹️ Đang dừng... (hủy các yêu cầu đang chạy)")
+            self.processing_thread.stop()
+
+    def closeEvent(self, event):
+        """Đóng cửa sổ khi đang chạy: hủy tác vụ, job dở được giữ lại cho lần sau"""
+        if self.processing_thread and self.processing_thread.isRunning():
+            self.processing_thread.stop()
+            self.processing_thread.wait(10000)
+        self.preview_loader.stop()
+        self.preview_loader.wait(2000)
+        event.accept()
 
     def update_status(self, message):
         """Cập nhật trạng thái"""
@@ -1363,8 +1800,8 @@ class MainWindow(QWidget):
             self.tab_widget.setCurrentIndex(1)
             
             if self.generated_files:
+                # Kích hoạt currentItemChanged -> show_selected_docx
                 self.docx_list.setCurrentRow(0)
-                self.show_selected_docx(self.docx_list.item(0))
 
             QMessageBox.information(
                 self, 
@@ -1374,41 +1811,69 @@ class MainWindow(QWidget):
                 f"👉 Bạn có thể xem và mở file tại tab 'KẾT QUẢ ĐẦU RA'."
             )
 
-    def show_selected_docx(self, item):
-        """Hiển thị preview"""
+    def _path_for_item(self, item):
         file_name = item.text()
-        full_path = next((f for f in self.generated_files if os.path.basename(f) == file_name), None)
+        return next((f for f in self.generated_files if os.path.basename(f) == file_name), None)
+
+    def show_selected_docx(self, item):
+        """Hiển thị preview (chuyển đổi chạy nền, không chặn giao diện)"""
+        full_path = self._path_for_item(item)
         self.btn_open_external.setEnabled(True)
+        self.current_preview_path = full_path
         if not full_path or not os.path.isfile(full_path):
-            self.docx_viewer.setHtml(f"<h3>Lỗi:</h3><p>File không tồn tại: {file_name}</p>")
+            self.docx_viewer.setHtml(f"<h3>Lỗi:</h3><p>File không tồn tại: {item.text()}</p>")
             self.btn_open_external.setEnabled(False)
             return
         
-        file_size_mb = os.path.getsize(full_path) / (1024 * 1024)
-        if file_size_mb > 10.0:
-            msg = f"""<html><body style="font-family: Arial; text-align: center; padding-top: 50px;">
-                <h2 style="color: #f44336;">⚠️ File quá lớn để xem trước ({file_size_mb:.2f} MB)</h2>
-                <p>Vui lòng nhấn nút <b>"↗️ Mở bằng Word/WPS"</b> ở góc trên.</p></body></html>"""
-            self.docx_viewer.setHtml(msg)
+        # Ưu tiên HTML xem trước do pipeline sinh sẵn: mở tức thì, không giới hạn dung lượng
+        from process.preview_html import load_fresh_preview
+        preview_path = load_fresh_preview(full_path)
+        if preview_path:
+            self.docx_viewer.load(QUrl.fromLocalFile(preview_path))
             return
         
-        try:
-            with open(full_path, "rb") as docx_file:
-                result = mammoth.convert_to_html(docx_file)
-                html = result.value.strip()
-                if html:
-                    styled_html = f"""<html><head><style>
-                            body {{ font-family: 'Segoe UI', Arial, sans-serif; padding: 30px; line-height: 1.6; color: #333; }}
-                            p {{ margin-bottom: 15px; }}
-                            img {{ max-width: 100%; height: auto; border: 1px solid #ddd; }}
-                            table {{ border-collapse: collapse; width: 100%; margin: 15px 0; }}
-                            th, td {{ border: 1px solid #ddd; padding: 8px; }}
-                        </style></head><body>{html}</body></html>"""
-                    self.docx_viewer.setHtml(styled_html)
-                else:
-                    self.docx_viewer.setHtml(f"<p>File không có nội dung để hiển thị.</p>")
-        except Exception as e:
-            self.docx_viewer.setHtml(f"<h3>Lỗi khi đọc file</h3><p>{str(e)}</p>")
+        # Prefetch các file ngay trên/dưới để lướt danh sách không phải chờ
+        row = self.docx_list.row(item)
+        neighbours = []
+        for offset in (1, -1, 2):
+            neighbour_item = self.docx_list.item(row + offset)
+            neighbour_path = self._path_for_item(neighbour_item) if neighbour_item else None
+            if neighbour_path and os.path.isfile(neighbour_path) and not load_fresh_preview(neighbour_path):
+                neighbours.append(neighbour_path)
+
+        html = self.preview_loader.cached(full_path)
+        if html is not None:
+            self.docx_viewer.setHtml(html)
+            self.preview_loader.request(None, neighbours)
+        else:
+            self.docx_viewer.setHtml("<p style='font-family: Arial; color: #777;'>⏳ Đang tải xem trước...</p>")
+            self.preview_loader.request(full_path, neighbours)
+
+    def on_preview_ready(self, path, html):
+        """Nhận HTML từ PreviewLoader; chỉ hiển thị nếu vẫn là file đang chọn"""
+        if path == self.current_preview_path:
+            self.docx_viewer.setHtml(html)
+
+    def export_generated_files(self):
+        """Xuất các file đã tạo ra mọi định dạng từ JSON chuẩn hóa đi kèm"""
+        from process.exporters import EXPORTERS, canonical_json_path_for, export_canonical_file
+        
+        exported, skipped = 0, []
+        for docx_path in self.generated_files:
+            canonical_path = canonical_json_path_for(docx_path)
+            if not os.path.exists(canonical_path):
+                skipped.append(os.path.basename(docx_path))
+                continue
+            try:
+                export_canonical_file(canonical_path, list(EXPORTERS))
+                exported += 1
+            except Exception as e:
+                skipped.append(f"{os.path.basename(docx_path)} ({e})")
+        
+        message = f"✅ Đã xuất {exported} file sang: {', '.join(EXPORTERS)}"
+        if skipped:
+            message += "\n\n⚠️ Bỏ qua (không có dữ liệu JSON):\n" + "\n".join(skipped)
+        QMessageBox.information(self, "Xuất đề", message)
 
     def open_current_docx(self):
         """Mở file bằng Word/WPS"""
@@ -1425,6 +1890,8 @@ class MainWindow(QWidget):
 
 
 if __name__ == "__main__":
+    # Bắt buộc khi đóng gói PyInstaller: tiến trình render con khởi động lại chính file exe
+    multiprocessing.freeze_support()
     app = QApplication(sys.argv)
     window = MainWindow()
     window.show()
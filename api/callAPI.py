@@ -4,6 +4,9 @@ from dotenv import load_dotenv
 from google.oauth2 import service_account
 from google import genai
 from google.genai import types
+from process.cancellation import run_cancellable, raise_if_cancelled
+from process.metrics import record_usage
+from process.pdf_buffers import get_pdf_pool
 
 # ============================================================
 # 1. CẤU HÌNH LOAD .ENV (Logic chuẩn từ test_connect.py)
@@ -94,52 +97,63 @@ class VertexClient:
             print(f"Lỗi init GenAI Client: {e}")
             self.client = None
 
-    def send_data_to_AI(self, prompt, file_paths=None, temperature=0.4, top_p=0.8):
+    @staticmethod
+    def _build_contents(prompt, pdf_buffers):
+        """PDF (bộ đệm dùng chung) + prompt text -> contents cho generate_content"""
+        contents = []
+        for buffer in pdf_buffers:
+            # SDK mới dùng from_bytes thay vì from_data cũ
+            pdf_part = types.Part.from_bytes(
+                data=buffer.data,
+                mime_type="application/pdf"
+            )
+            contents.append(types.Content(role="user", parts=[pdf_part]))
+            print(f"📄 Đã load PDF: {os.path.basename(buffer.path)}")
+
+        # 2. Xử lý Prompt text
+        text_part = types.Part.from_text(text=prompt)
+        contents.append(types.Content(role="user", parts=[text_part]))
+        return contents
+
+    def send_data_to_AI(self, prompt, file_paths=None, temperature=0.4, top_p=0.8, cancel_token=None):
         if not self.client:
             return "❌ Lỗi: Client chưa được khởi tạo."
 
-        contents = []
-
         # 1. Xử lý File PDF (Sử dụng types.Part.from_bytes)
+        # Bộ đệm dùng chung cả tiến trình: file đã nạp bởi tác vụ khác thì dùng lại, vượt
+        # PDF_MEMORY_LIMIT_MB thì chờ tới khi có chỗ; giữ tới khi request xong rồi mới trả.
+        pdf_buffers = []
         if file_paths:
             # Nếu file_paths là string đơn, chuyển thành list
             if isinstance(file_paths, str):
                 file_paths = [file_paths]
-                
-            for file_path in file_paths:
-                try:
-                    with open(file_path, "rb") as f:
-                        pdf_bytes = f.read()
-                    
-                    # SDK mới dùng from_bytes thay vì from_data cũ
-                    pdf_part = types.Part.from_bytes(
-                        data=pdf_bytes, 
-                        mime_type="application/pdf"
-                    )
-                    contents.append(types.Content(role="user", parts=[pdf_part]))
-                    print(f"📄 Đã load PDF: {os.path.basename(file_path)}")
-                except Exception as e:
-                    print(f"❌ Lỗi đọc file {file_path}: {e}")
-                    raise e
 
-        # 2. Xử lý Prompt text
-        text_part = types.Part.from_text(text=prompt)
-        contents.append(types.Content(role="user", parts=[text_part]))
-
-        # 3. Cấu hình sinh nội dung
-        generate_config = types.GenerateContentConfig(
-            temperature=temperature,
-            top_p=top_p
-        )
+            raise_if_cancelled(cancel_token)
+            try:
+                pdf_buffers = get_pdf_pool().acquire(file_paths, cancel_token)
+            except Exception as e:
+                print(f"❌ Lỗi đọc file PDF {file_paths}: {e}")
+                raise e
 
         try:
-            # Gọi API
-            response = self.client.models.generate_content(
+            contents = self._build_contents(prompt, pdf_buffers)
+
+            # 3. Cấu hình sinh nội dung
+            generate_config = types.GenerateContentConfig(
+                temperature=temperature,
+                top_p=top_p
+            )
+
+            # Gọi API (có thể hủy giữa chừng qua cancel_token)
+            response = run_cancellable(
+                self.client.models.generate_content,
                 model=self.model_name,
                 contents=contents,
-                config=generate_config
+                config=generate_config,
+                cancel_token=cancel_token
             )
             
+            record_usage(response)
             # Trả về text
             if response.text:
                 return response.text
@@ -149,22 +163,104 @@ class VertexClient:
         except Exception as e:
             print(f"❌ Lỗi khi gọi AI generate_content: {e}")
             raise e
+        finally:
+            get_pdf_pool().release(pdf_buffers)
     
-    def send_data_to_check(self, prompt, temperature=0.45, top_p=0.8):
+    def send_data_to_check(self, prompt, temperature=0.45, top_p=0.8, cancel_token=None):
         # Hàm check nhanh chỉ dùng text
         if not self.client:
              return "ERROR_NO_CREDS"
 
         try:
-            response = self.client.models.generate_content(
+            response = run_cancellable(
+                self.client.models.generate_content,
                 model=self.model_name,
                 contents=prompt,
                 config=types.GenerateContentConfig(
                     temperature=temperature,
                     top_p=top_p
-                )
+                ),
+                cancel_token=cancel_token
             )
+            record_usage(response, kind="repair")
             return response.text if response.text else "EMPTY_RESPONSE"
         except Exception as e:
             print(f"❌ Lỗi khi check data: {e}")
-            return str(e)
\ No newline at end of file
+            return str(e)
+
+# ============================================================
+# 4. CLASS VERTEX CLIENT BẤT ĐỒNG BỘ (ASYNCIO)
+# ============================================================
+
+class AsyncVertexClient(VertexClient):
+    """
+    Biến thể asyncio của VertexClient: request sinh đề đi qua client.aio (không chiếm luồng khi chờ HTTP).
+    Các hàm đồng bộ kế thừa vẫn dùng được cho việc gọi lẻ từ executor (sửa JSON, bù câu thiếu).
+    """
+
+    async def send_data_to_AI_async(self, prompt, file_paths=None, temperature=0.4, top_p=0.8,
+                                    cancel_token=None, metrics=None):
+        """
+        Như send_data_to_AI nhưng await được. metrics: TaskMetrics của tác vụ để ghi token
+        (nhiều tác vụ chạy chung một luồng event loop nên không dùng metrics gắn theo luồng được).
+        """
+        import asyncio
+        import threading
+        from process.async_pipeline import is_rate_limit_error
+        from process.metrics import bind
+
+        if not self.client:
+            return "❌ Lỗi: Client chưa được khởi tạo."
+
+        pdf_buffers = []
+        if file_paths:
+            if isinstance(file_paths, str):
+                file_paths = [file_paths]
+            raise_if_cancelled(cancel_token)
+            pool = get_pdf_pool()
+            # acquire có thể chờ trần bộ nhớ PDF -> chạy ngoài event loop. Tác vụ bị hủy trong lúc
+            # chờ thì luồng executor vẫn chạy nốt acquire: bộ đệm nó lấy được phải trả lại ngay,
+            # không thì refs kẹt ở pool dùng chung cả tiến trình và lượt chạy sau chờ trần mãi.
+            handoff = {"buffers": None, "abandoned": False}
+            handoff_lock = threading.Lock()
+
+            def acquire_buffers():
+                buffers = pool.acquire(file_paths, cancel_token)
+                with handoff_lock:
+                    if handoff["abandoned"]:
+                        pool.release(buffers)
+                        return []
+                    handoff["buffers"] = buffers
+                return buffers
+
+            try:
+                pdf_buffers = await asyncio.get_running_loop().run_in_executor(None, acquire_buffers)
+            except asyncio.CancelledError:
+                with handoff_lock:
+                    handoff["abandoned"] = True
+                    acquired = handoff["buffers"]
+                if acquired:
+                    pool.release(acquired)
+                raise
+            except Exception as e:
+                print(f"❌ Lỗi đọc file PDF {file_paths}: {e}")
+                raise e
+        try:
+            contents = self._build_contents(prompt, pdf_buffers)
+            response = await self.client.aio.models.generate_content(
+                model=self.model_name,
+                contents=contents,
+                config=types.GenerateContentConfig(temperature=temperature, top_p=top_p)
+            )
+            with bind(metrics):
+                record_usage(response)
+            if response.text:
+                return response.text
+            else:
+                return "⚠️ API trả về rỗng (Có thể do Safety Filter chặn)."
+        except Exception as e:
+            if not is_rate_limit_error(e):
+                print(f"❌ Lỗi khi gọi AI generate_content: {e}")
+            raise e
+        finally:
+            get_pdf_pool().release(pdf_buffers)
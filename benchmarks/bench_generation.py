@@ -0,0 +1,364 @@
+import argparse
+import contextlib
+import json
+import os
+import platform
+import random
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from typing import Dict, List, Optional
+
+# Cho phép chạy trực tiếp: python benchmarks/bench_generation.py ...
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from process.cancellation import raise_if_cancelled
+from process.metrics import bind, record_usage
+from process.pipeline import TASK_TYPES, PipelineItem, build_generation_pipeline
+
+# ============================================================
+# BENCHMARK OFFLINE - KHÔNG GỌI GEMINI THẬT
+# ============================================================
+#
+# FakeVertexClient phát lại response đã ghi sẵn (benchmarks/fixtures/<question_type>.txt)
+# với độ trễ cấu hình được và có thể tiêm lỗi: JSON hỏng (đi qua nhánh AI sửa JSON) và 429.
+# Phần còn lại là code thật: build_generation_pipeline -> parse_json_safely ->
+# DynamicDocxRenderer -> save_document_securely (+ sidecar), nên số đo phản ánh đúng app.
+#
+#   python benchmarks/bench_generation.py --scales 1,10,100
+#   python benchmarks/bench_generation.py --scales 1000 --types TN --latency 0.5 --jitter 0.2
+#   python benchmarks/bench_generation.py --baseline benchmarks/results/truoc.json
+#   python benchmarks/bench_generation.py --scales 200 --latency 2 --async      (pipeline asyncio)
+#
+# Kết quả ghi ra JSON (so sánh được giữa các lần chạy); --baseline báo chậm đi quá --tolerance.
+
+FIXTURE_DIR = os.path.join(ROOT, "benchmarks", "fixtures")
+RESULT_DIR = os.path.join(ROOT, "benchmarks", "results")
+SCHEMA_VERSION = 1
+
+_LOAI_DE_RE = re.compile(r'"loai_de":\s*"(\w+)"')
+
+
+class RateLimitError(Exception):
+    """Giả lập lỗi 429 RESOURCE_EXHAUSTED của Vertex AI"""
+
+
+class _FakeUsage:
+    def __init__(self, prompt_tokens: int, output_tokens: int):
+        self.prompt_token_count = prompt_tokens
+        self.candidates_token_count = output_tokens
+        self.thoughts_token_count = 0
+
+
+class _FakeResponse:
+    def __init__(self, text: str, prompt: str):
+        self.text = text
+        # Ước lượng ~4 ký tự / token để số liệu token trong metrics có ý nghĩa tương đối
+        self.usage_metadata = _FakeUsage(len(prompt) // 4, len(text) // 4)
+
+
+def load_fixtures(fixture_dir: str = FIXTURE_DIR) -> Dict[str, str]:
+    responses = {}
+    for question_type, _ in TASK_TYPES.values():
+        path = os.path.join(fixture_dir, f"{question_type}.txt")
+        with open(path, "r", encoding="utf-8") as f:
+            responses[question_type] = f.read()
+    return responses
+
+
+def break_json(text: str, rng: random.Random) -> str:
+    """Làm hỏng JSON kiểu model hay gặp: mất một dấu phẩy giữa hai trường"""
+    positions = [m.start() for m in re.finditer(r'",\n', text)]
+    if not positions:
+        return text[: len(text) // 2]
+    pos = rng.choice(positions)
+    return text[: pos + 1] + text[pos + 2:]
+
+
+class FakeVertexClient:
+    """Cùng giao diện với api.callAPI.VertexClient, phát lại response ghi sẵn"""
+
+    def __init__(self, responses: Dict[str, str], latency: float = 0.0, jitter: float = 0.0,
+                 malformed_rate: float = 0.0, rate_limit_rate: float = 0.0, seed: Optional[int] = None):
+        self.responses = responses
+        self.latency = latency
+        self.jitter = jitter
+        self.malformed_rate = malformed_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.rng = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def _roll(self, rate: float) -> bool:
+        with self._lock:
+            return rate > 0 and self.rng.random() < rate
+
+    def _delay(self) -> float:
+        with self._lock:
+            return max(0.0, self.latency + self.rng.uniform(-self.jitter, self.jitter))
+
+    def _sleep(self, cancel_token=None):
+        delay = self._delay()
+        if delay:
+            if cancel_token is not None:
+                cancel_token.wait(delay)
+            else:
+                time.sleep(delay)
+        raise_if_cancelled(cancel_token)
+
+    def _respond(self, text: str, prompt: str) -> str:
+        response = _FakeResponse(text, prompt)
+        record_usage(response)
+        return response.text
+
+    def _generate(self, prompt: str) -> str:
+        if self._roll(self.rate_limit_rate):
+            raise RateLimitError("429 RESOURCE_EXHAUSTED (giả lập)")
+        match = _LOAI_DE_RE.search(prompt)
+        question_type = match.group(1) if match else "trac_nghiem_4_dap_an"
+        text = self.responses.get(question_type, self.responses["trac_nghiem_4_dap_an"])
+        if self._roll(self.malformed_rate):
+            with self._lock:
+                text = break_json(text, self.rng)
+        return self._respond(text, prompt)
+
+    def send_data_to_AI(self, prompt, file_paths=None, temperature=0.4, top_p=0.8, cancel_token=None):
+        self._sleep(cancel_token)
+        return self._generate(prompt)
+
+    async def send_data_to_AI_async(self, prompt, file_paths=None, temperature=0.4, top_p=0.8,
+                                    cancel_token=None, metrics=None):
+        """Bản asyncio (--async): chờ bằng asyncio.sleep, không giữ luồng nào"""
+        import asyncio
+        delay = self._delay()
+        if delay:
+            await asyncio.sleep(delay)
+        raise_if_cancelled(cancel_token)
+        with bind(metrics):
+            return self._generate(prompt)
+
+    def send_data_to_check(self, prompt, temperature=0.45, top_p=0.8, cancel_token=None):
+        """Nhánh sửa JSON: trả lại bản ghi gốc (hợp lệ) của đúng loại đề"""
+        self._sleep(cancel_token)
+        match = _LOAI_DE_RE.search(prompt)
+        question_type = match.group(1) if match else "trac_nghiem_4_dap_an"
+        return self._respond(self.responses[question_type], prompt)
+
+
+# ============================================================
+# CHẠY MỘT KỊCH BẢN
+# ============================================================
+
+def _percentile(values: List[float], q: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    index = min(len(values) - 1, max(0, int(round(q * (len(values) - 1)))))
+    return values[index]
+
+
+def _read_prompt(task_type: str) -> str:
+    path = os.path.join(ROOT, f"test{task_type}.txt")
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return f.read()
+    except OSError:
+        return f"Tạo đề {task_type}"
+
+
+def run_scenario(task_type: str, tasks: int, args, responses: Dict[str, str]) -> Dict:
+    """Chạy 'tasks' tác vụ cùng loại qua pipeline thật, trả về kết quả tổng hợp"""
+    question_type, _ = TASK_TYPES[task_type]
+    output_root = tempfile.mkdtemp(prefix="genques-bench-")
+    client = FakeVertexClient(
+        responses, latency=args.latency, jitter=args.jitter,
+        malformed_rate=args.malformed_rate, rate_limit_rate=args.rate_limit_rate, seed=args.seed
+    )
+    if args.use_async:
+        from process.async_pipeline import AsyncGenerationPipeline
+        pipeline = AsyncGenerationPipeline(
+            None, None, "fake-model", max_in_flight=args.max_in_flight, output_root=output_root,
+            client_factory=lambda: client, model_rpm=args.model_rpm, rate_limit_backoff=0.1
+        )
+    else:
+        pipeline = build_generation_pipeline(
+            None, None, "fake-model",
+            model_workers=args.model_workers, output_root=output_root,
+            render_processes=args.render_processes, client_factory=lambda: client
+        )
+    prompt = _read_prompt(task_type)
+
+    def make_item(index, attempt=1):
+        payload = {"output_name": f"bench_{index:05d}", "pdf_files": [], "task_type": task_type,
+                   "prompt_content": prompt, "attempt": attempt}
+        return PipelineItem(index, payload)
+
+    records, retries, failed = [], 0, 0
+    started = time.perf_counter()
+    with contextlib.ExitStack() as stack:
+        if args.quiet:
+            # Mặc định bỏ log của pipeline: in hàng nghìn dòng làm sai lệch số đo
+            stack.enter_context(contextlib.redirect_stdout(stack.enter_context(open(os.devnull, "w"))))
+        pipeline.start()
+        pending = list(range(tasks))
+        in_flight = 0
+        done = 0
+        while done < tasks:
+            # Giữ số item trong pipeline <= sức chứa (giống ProcessingThread)
+            while pending and in_flight < pipeline.capacity:
+                pipeline.submit(make_item(pending.pop(0)))
+                in_flight += 1
+            item = pipeline.results.get()
+            in_flight -= 1
+            if item.error and "429" in item.error and item.payload["attempt"] < args.max_attempts:
+                retries += 1
+                pipeline.submit(make_item(item.key, item.payload["attempt"] + 1))
+                in_flight += 1
+                continue
+            done += 1
+            if item.error or not item.result:
+                failed += 1
+            records.append(item.metrics.to_dict())
+        pipeline.close()
+        pipeline.join()
+    wall = time.perf_counter() - started
+    shutil.rmtree(output_root, ignore_errors=True)
+
+    stages: Dict[str, Dict] = {}
+    names = sorted({name for r in records for name in r["timers"]})
+    for name in names:
+        samples = [r["timers"][name]["seconds"] for r in records if name in r["timers"]]
+        stages[name] = {
+            "count": sum(r["timers"][name]["count"] for r in records if name in r["timers"]),
+            "mean": round(sum(samples) / len(samples), 6),
+            "p50": round(_percentile(samples, 0.5), 6),
+            "p95": round(_percentile(samples, 0.95), 6),
+        }
+    return {
+        "task_type": task_type,
+        "question_type": question_type,
+        "tasks": tasks,
+        "ok": tasks - failed,
+        "failed": failed,
+        "retries_429": retries,
+        "json_repairs": stages.get("json_repair", {}).get("count", 0),
+        "wall_seconds": round(wall, 4),
+        "tasks_per_second": round(tasks / wall, 4) if wall else 0.0,
+        "stages": stages,
+    }
+
+
+# ============================================================
+# SO SÁNH VỚI BASELINE
+# ============================================================
+
+def compare(results: List[Dict], baseline: Dict, tolerance: float) -> List[str]:
+    """Danh sách cảnh báo chậm đi: thông lượng giảm hoặc p50 của stage tăng quá tolerance"""
+    old = {(r["task_type"], r["tasks"]): r for r in baseline.get("results", [])}
+    regressions = []
+    for r in results:
+        base = old.get((r["task_type"], r["tasks"]))
+        if base is None:
+            continue
+        label = f"{r['task_type']} x{r['tasks']}"
+        if base["tasks_per_second"] and r["tasks_per_second"] < base["tasks_per_second"] * (1 - tolerance):
+            regressions.append(
+                f"{label}: thông lượng {base['tasks_per_second']:.2f} -> {r['tasks_per_second']:.2f} tác vụ/s"
+            )
+        for name, stage in r["stages"].items():
+            base_stage = base.get("stages", {}).get(name)
+            # Bỏ qua stage quá nhanh (nhiễu đo lớn hơn tín hiệu)
+            if not base_stage or base_stage["p50"] < 0.005:
+                continue
+            if stage["p50"] > base_stage["p50"] * (1 + tolerance):
+                regressions.append(f"{label}: {name} p50 {base_stage['p50']:.4f}s -> {stage['p50']:.4f}s")
+    return regressions
+
+
+def _git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT,
+                              capture_output=True, text=True, timeout=5).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark sinh đề offline (client AI giả lập)")
+    parser.add_argument("--types", default="TN,DS,TLN", help="Loại đề, phân tách bằng dấu phẩy")
+    parser.add_argument("--scales", default="1,10,100", help="Số tác vụ mỗi kịch bản (VD: 1,10,100,1000)")
+    parser.add_argument("--latency", type=float, default=0.0, help="Độ trễ giả lập mỗi lần gọi model (giây)")
+    parser.add_argument("--jitter", type=float, default=0.0)
+    parser.add_argument("--malformed-rate", type=float, default=0.0, help="Tỉ lệ response JSON hỏng (0-1)")
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0, help="Tỉ lệ lỗi 429 (0-1)")
+    parser.add_argument("--max-attempts", type=int, default=3, help="Số lần thử tối đa khi gặp 429")
+    parser.add_argument("--model-workers", type=int, default=3)
+    parser.add_argument("--render-processes", type=int, default=0)
+    parser.add_argument("--async", dest="use_async", action="store_true",
+                        help="Dùng pipeline asyncio (process/async_pipeline.py) thay cho pipeline theo luồng")
+    parser.add_argument("--max-in-flight", type=int, default=200, help="Số tác vụ đồng thời của pipeline asyncio")
+    parser.add_argument("--model-rpm", type=float, default=0, help="Giới hạn request/phút của pipeline asyncio (0 = không)")
+    parser.add_argument("--seed", type=int, default=1234)
+    parser.add_argument("--fixtures", default=FIXTURE_DIR)
+    parser.add_argument("--output", help="File JSON kết quả (mặc định benchmarks/results/bench-<thời gian>.json)")
+    parser.add_argument("--baseline", help="File kết quả cũ để so sánh")
+    parser.add_argument("--tolerance", type=float, default=0.15, help="Ngưỡng chậm đi được chấp nhận (0.15 = 15%%)")
+    parser.add_argument("--verbose", dest="quiet", action="store_false", help="In log của pipeline")
+    args = parser.parse_args(argv)
+
+    types = [t.strip().upper() for t in args.types.split(",") if t.strip()]
+    unknown = [t for t in types if t not in TASK_TYPES]
+    if unknown:
+        parser.error(f"Loại đề không hợp lệ: {unknown} (chọn trong {list(TASK_TYPES)})")
+    scales = [int(s) for s in args.scales.split(",") if s.strip()]
+
+    responses = load_fixtures(args.fixtures)
+    results = []
+    for task_type in types:
+        for tasks in scales:
+            result = run_scenario(task_type, tasks, args, responses)
+            results.append(result)
+            print(f"⏱️ {task_type} x{tasks}: {result['wall_seconds']:.2f}s | {result['tasks_per_second']:.2f} tác vụ/s"
+                  f" | lỗi {result['failed']} | 429 thử lại {result['retries_429']} | sửa JSON {result['json_repairs']}")
+
+    report = {
+        "schema": SCHEMA_VERSION,
+        "meta": {
+            "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "commit": _git_commit(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "args": {k: v for k, v in vars(args).items() if k not in ("output", "baseline", "fixtures")},
+        },
+        "results": results,
+    }
+    output = args.output or os.path.join(RESULT_DIR, f"bench-{time.strftime('%Y%m%d-%H%M%S')}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"💾 Đã ghi kết quả: {output}")
+
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+        changed = {k for k, v in report["meta"]["args"].items()
+                   if k not in ("scales", "types", "tolerance") and baseline.get("meta", {}).get("args", {}).get(k) != v}
+        if changed:
+            print(f"⚠️ Cấu hình khác baseline ({', '.join(sorted(changed))}) - so sánh có thể không công bằng")
+        regressions = compare(results, baseline, args.tolerance)
+        if regressions:
+            print("❌ Chậm đi so với baseline:")
+            for line in regressions:
+                print(f"   • {line}")
+            return 1
+        print("✅ Không có regression so với baseline")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
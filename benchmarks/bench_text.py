@@ -0,0 +1,142 @@
+import argparse
+import contextlib
+import json
+import os
+import platform
+import sys
+import time
+import timeit
+from typing import Callable, Dict, List, Tuple
+
+# Cho phép chạy trực tiếp: python benchmarks/bench_text.py ...
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from benchmarks.corpus import all_corpora
+
+# ============================================================
+# MICROBENCHMARK ĐƯỜNG NÓNG TEXT / LATEX
+# ============================================================
+#
+# Đo riêng từng hàm xử lý chuỗi trên corpus mẫu (benchmarks/corpus.py):
+#   python benchmarks/bench_text.py
+#   python benchmarks/bench_text.py --only sanitize --repeat 7
+#   python benchmarks/bench_text.py --baseline benchmarks/results/text-truoc.json
+# Mỗi case báo thời gian tốt nhất / trung vị cho MỘT lượt qua cả corpus (giây) và µs mỗi phần tử.
+
+RESULT_DIR = os.path.join(ROOT, "benchmarks", "results")
+SCHEMA_VERSION = 1
+
+
+def build_cases(corpora: Dict) -> Dict[str, Tuple[Callable[[], object], int]]:
+    """Tên case -> (hàm chạy một lượt qua corpus, số phần tử)"""
+    from docx import Document
+    from process.response2docx import (
+        sanitize_latex_json, clean_json_string, clean_latex_math, tokenize_latex_text,
+        process_text_with_latex, _apply_latex_rules
+    )
+
+    response = corpora["response_100kb"]
+    cleaned = clean_json_string(response)
+    doc = Document()
+
+    def run_process_text(texts):
+        def run():
+            paragraph = doc.add_paragraph()
+            for text in texts:
+                process_text_with_latex(text, paragraph)
+            # Không để document phình ra qua các lượt lặp
+            paragraph._p.getparent().remove(paragraph._p)
+        return run
+
+    return {
+        "sanitize/response_100kb": (lambda: sanitize_latex_json(cleaned), 1),
+        "clean_json_string/response_100kb": (lambda: clean_json_string(response), 1),
+        "clean_latex_math/formulas": (lambda: [clean_latex_math(f) for f in corpora["formulas"]],
+                                      len(corpora["formulas"])),
+        # Bỏ qua cache: chi phí thật của chuỗi luật với công thức mới gặp
+        "clean_latex_math/formulas_uncached": (lambda: [_apply_latex_rules(f) for f in corpora["formulas"]],
+                                               len(corpora["formulas"])),
+        "tokenize/prose": (lambda: [tokenize_latex_text(t) for t in corpora["prose"]], len(corpora["prose"])),
+        "tokenize/physics": (lambda: [tokenize_latex_text(t) for t in corpora["physics"]], len(corpora["physics"])),
+        "process_text/prose": (run_process_text(corpora["prose"]), len(corpora["prose"])),
+        # Không có pandoc: công thức đi nhánh fallback text (vẫn gồm tokenize + clean_latex_math)
+        "process_text/physics": (run_process_text(corpora["physics"]), len(corpora["physics"])),
+    }
+
+
+def run_case(fn: Callable[[], None], items: int, repeat: int, min_time: float) -> Dict:
+    timer = timeit.Timer(fn)
+    # Tự chọn số lần lặp để mỗi mẫu >= min_time giây (giống python -m timeit)
+    number = 1
+    while timer.timeit(number) < min_time:
+        number *= 2
+    samples = sorted(t / number for t in timer.repeat(repeat=repeat, number=number))
+    best, median = samples[0], samples[len(samples) // 2]
+    return {
+        "best": round(best, 7),
+        "median": round(median, 7),
+        "per_item_us": round(best / items * 1e6, 3),
+        "loops": number,
+    }
+
+
+def compare(results: Dict[str, Dict], baseline: Dict, tolerance: float) -> List[str]:
+    regressions = []
+    for name, result in results.items():
+        base = baseline.get("results", {}).get(name)
+        if base and result["best"] > base["best"] * (1 + tolerance):
+            regressions.append(f"{name}: {base['best'] * 1e3:.3f}ms -> {result['best'] * 1e3:.3f}ms")
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Microbenchmark xử lý text/LaTeX")
+    parser.add_argument("--only", help="Chỉ chạy case có tên chứa chuỗi này (VD: sanitize)")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--min-time", type=float, default=0.2, help="Thời gian tối thiểu mỗi mẫu (giây)")
+    parser.add_argument("--output", help="File JSON kết quả (mặc định benchmarks/results/text-<thời gian>.json)")
+    parser.add_argument("--baseline", help="File kết quả cũ để so sánh")
+    parser.add_argument("--tolerance", type=float, default=0.15)
+    args = parser.parse_args(argv)
+
+    cases = build_cases(all_corpora())
+    results = {}
+    for name, (fn, items) in cases.items():
+        if args.only and args.only not in name:
+            continue
+        # Nhánh fallback khi thiếu pandoc in cảnh báo mỗi công thức -> bỏ stdout lúc đo
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            result = run_case(fn, items, args.repeat, args.min_time)
+        results[name] = result
+        print(f"⏱️ {name:<36} best {result['best'] * 1e3:9.3f}ms | {result['per_item_us']:10.2f}µs/phần tử")
+
+    report = {
+        "schema": SCHEMA_VERSION,
+        "meta": {
+            "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+        },
+        "results": results,
+    }
+    output = args.output or os.path.join(RESULT_DIR, f"text-{time.strftime('%Y%m%d-%H%M%S')}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"💾 Đã ghi kết quả: {output}")
+
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        if regressions:
+            print("❌ Chậm đi so với baseline:")
+            for line in regressions:
+                print(f"   • {line}")
+            return 1
+        print("✅ Không có regression so với baseline")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
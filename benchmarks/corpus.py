@@ -0,0 +1,110 @@
+import json
+import random
+from typing import Dict, List
+
+# ============================================================
+# CORPUS MẪU CHO MICROBENCHMARK (SINH TẤT ĐỊNH THEO SEED)
+# ============================================================
+#
+# - vietnamese_prose: câu văn Sử/Địa có HTML lẫn vào (kiểu model hay trả về), không công thức.
+# - physics_answers: lời giải dày công thức $...$ / \[...\] với \frac, \sqrt, \log, \operatorname...
+# - large_response: response JSON ~100 KB như model trả về, backslash LaTeX CHƯA escape
+#   (đầu vào thật của sanitize_latex_json).
+
+_PROSE = [
+    "Cách mạng tháng Tám năm 1945 thành công đã mở ra kỉ nguyên độc lập, tự do cho dân tộc.",
+    "Gió mùa Đông Bắc hoạt động mạnh ở miền Bắc từ tháng 11 đến tháng 4 năm sau.",
+    "Đồng bằng sông Cửu Long có diện tích khoảng 40 nghìn km², chiếm 12% diện tích cả nước.",
+    "Hiệp định Pa-ri năm 1973 buộc Mỹ phải rút hết quân viễn chinh khỏi miền Nam Việt Nam.",
+    "Tây Nguyên là vùng chuyên canh cà phê lớn nhất nước ta, nằm ở vĩ độ khoảng 12°B - 15°B.",
+    "Công cuộc Đổi mới từ năm 1986 đã đưa nền kinh tế tăng trưởng bình quân 6,5%/năm.",
+]
+_HTML = ["<b>", "</b>", "<br>", "&nbsp;", "<i>", "</i>", "<br/>"]
+
+_FORMULAS = [
+    r"\frac{a}{b}", r"\sqrt{x^2+1}", r"\log_{2} 8 = 3", r"v = \frac{s}{t}", r"E = mc^2",
+    r"\operatorname {sin} x", r"\root 3 {27}", r"F = G\frac{m_1 m_2}{r^2}", r"x\frac{1}{2}",
+    r"\Delta t = t_2 - t_1", r"\cdot x", r"{\bf v} = \vec{v}", r"\Rightarrow x = 2", r"ln x + log x",
+    r"\alpha + \beta = \pi", r"\int_0^1 x dx", r"a \leq b \Leftrightarrow b \geq a", r"\sp{2}",
+    r"\sum_{i=1}^{n} i = \frac{n(n+1)}{2}", r"\sin^2 x + \cos^2 x = 1", r"\nonumber\bigskip y",
+]
+
+
+def vietnamese_prose(count: int = 200, seed: int = 1) -> List[str]:
+    rng = random.Random(seed)
+    texts = []
+    for _ in range(count):
+        parts = []
+        for _ in range(rng.randint(1, 4)):
+            sentence = rng.choice(_PROSE)
+            if rng.random() < 0.4:
+                sentence = rng.choice(_HTML) + sentence + rng.choice(_HTML)
+            parts.append(sentence)
+        texts.append(" ".join(parts))
+    return texts
+
+
+def formulas(count: int = 500, seed: int = 2) -> List[str]:
+    """Công thức thô ($...$) - đầu vào của clean_latex_math; lặp lại nhiều như đề thật"""
+    rng = random.Random(seed)
+    return [f"${rng.choice(_FORMULAS)}$" for _ in range(count)]
+
+
+def physics_answers(count: int = 200, seed: int = 3) -> List[str]:
+    rng = random.Random(seed)
+    texts = []
+    for _ in range(count):
+        parts = ["Ta có"]
+        for _ in range(rng.randint(2, 6)):
+            formula = rng.choice(_FORMULAS)
+            parts.append(f"\\[{formula}\\]" if rng.random() < 0.2 else f"${formula}$")
+            parts.append(rng.choice(["suy ra", "nên", "do đó", "<br>", "và"]))
+        parts.append("Vậy đáp án đúng là B.")
+        texts.append(" ".join(parts))
+    return texts
+
+
+def _question(stt: int, rng: random.Random) -> Dict:
+    def field():
+        if rng.random() < 0.5:
+            return rng.choice(physics_answers(20, rng.randint(0, 10 ** 6)))
+        return rng.choice(vietnamese_prose(20, rng.randint(0, 10 ** 6)))
+
+    return {
+        "stt": stt,
+        "muc_do": rng.choice(["nhan_biet", "thong_hieu", "van_dung", "van_dung_cao"]),
+        "noi_dung": field(),
+        "hinh_anh": {"co_hinh": False},
+        "dap_an": [{"ky_hieu": k, "noi_dung": field()} for k in "ABCD"],
+        "dap_an_dung": rng.randint(1, 4),
+        "giai_thich": field() + "\n" + field(),
+    }
+
+
+def large_response(target_bytes: int = 100_000, seed: int = 4) -> str:
+    """
+    Response kiểu model: JSON trong ```json, LaTeX viết thẳng (\\frac chứ không phải \\\\frac),
+    kèm vài escape hợp lệ (\\n, \\", \\u00e9) để sanitizer phải phân biệt.
+    """
+    rng = random.Random(seed)
+    questions = []
+    size = 0
+    while size < target_bytes:
+        question = _question(len(questions) + 1, rng)
+        questions.append(question)
+        size += len(json.dumps(question, ensure_ascii=False))
+    text = json.dumps({"loai_de": "trac_nghiem_4_dap_an", "tong_so_cau": len(questions), "cau_hoi": questions},
+                      ensure_ascii=False, indent=2)
+    # json.dumps đã escape \ -> \\ ; trả lại dạng model viết (một backslash) cho các lệnh LaTeX
+    text = text.replace("\\\\", "\\")
+    text = text.replace("Vậy đáp án", "V\\u1eady \\\"đáp án\\\"", 5)
+    return f"```json\n{text}\n```"
+
+
+def all_corpora() -> Dict[str, object]:
+    return {
+        "prose": vietnamese_prose(),
+        "formulas": formulas(),
+        "physics": physics_answers(),
+        "response_100kb": large_response(),
+    }
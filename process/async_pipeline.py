@@ -0,0 +1,344 @@
+import asyncio
+import os
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional
+
+from process.cancellation import OperationCancelled
+from process.metrics import bind
+from process.pipeline import TASK_TYPES, PipelineItem, parse_item, save_item
+from process.profiling import section
+
+# ============================================================
+# PIPELINE ASYNCIO: HÀNG TRĂM REQUEST MODEL / ẢNH CÙNG LÚC VỚI VÀI LUỒNG
+# ============================================================
+#
+# Pipeline theo luồng (process/pipeline.py) giữ mỗi request model một luồng nằm chờ HTTP, nên số
+# request song song bị chặn bởi thread_spinbox. Bản này chạy mọi request model và ảnh trên MỘT
+# event loop (client.aio của GenAI SDK), chỉ giới hạn bởi quota:
+#   - MODEL_RPM / IMAGE_RPM (mặc định 60 / 30, 0 = không giới hạn): request/phút, giãn đều.
+#     Gặp 429 -> cả loại request đó tạm dừng RATE_LIMIT_BACKOFF giây (nhân đôi mỗi lần, thử tối đa 5 lần).
+#   - ASYNC_MAX_IN_FLIGHT (mặc định 200): số tác vụ nằm trong pipeline cùng lúc.
+#   - Việc CPU/đĩa (chuẩn bị PDF, parse JSON, bù câu, render DOCX + pandoc, lưu) chạy trong
+#     ThreadPoolExecutor: io_workers luồng cho chuẩn bị/parse, render_workers luồng cho render.
+#   - Ảnh của đề được sinh trước, song song (sau parse), rồi mới render -> render không gọi API.
+# Giao diện giống StagedPipeline (start/submit/results/capacity/close/join) nên ProcessingThread
+# dùng được nguyên si; bật trong GUI bằng GENQUES_ASYNC=1.
+
+DEFAULT_MODEL_RPM = 60
+DEFAULT_IMAGE_RPM = 30
+DEFAULT_MAX_IN_FLIGHT = 200
+RATE_LIMIT_ATTEMPTS = 5
+
+
+def is_rate_limit_error(error) -> bool:
+    """Lỗi 429 / hết quota (GenAI SDK: APIError.code == 429, status RESOURCE_EXHAUSTED)"""
+    code = getattr(error, "code", None) or getattr(error, "status_code", None)
+    return code == 429 or "RESOURCE_EXHAUSTED" in str(error)
+
+
+def async_mode_enabled() -> bool:
+    return os.getenv("GENQUES_ASYNC", "").strip().lower() in ("1", "true", "yes", "on")
+
+
+def _env_number(name: str, default: float) -> float:
+    try:
+        return float(os.getenv(name, "") or default)
+    except ValueError:
+        print(f"⚠️ {name} không phải số, dùng mặc định {default}")
+        return default
+
+
+class AsyncRateLimiter:
+    """Giãn đều request theo số request/phút; 429 -> tạm dừng cả nhóm. Chỉ dùng trong một event loop."""
+
+    def __init__(self, per_minute: float, name: str = ""):
+        self.interval = 60.0 / per_minute if per_minute > 0 else 0.0
+        self.name = name
+        self._next_at = 0.0
+        self._paused_until = 0.0
+
+    async def acquire(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            now = loop.time()
+            if self._paused_until > now:
+                await asyncio.sleep(self._paused_until - now)
+                continue
+            # Event loop đơn luồng: đọc và giữ chỗ không bị chen ngang (không có await ở giữa)
+            start = max(now, self._next_at)
+            self._next_at = start + self.interval
+            if start > now:
+                await asyncio.sleep(start - now)
+            # Bị 429 trong lúc chờ lượt -> xếp hàng lại sau khi hết tạm dừng
+            if self._paused_until <= loop.time():
+                return
+
+    def backoff(self, seconds: float):
+        self._paused_until = max(self._paused_until, asyncio.get_running_loop().time() + seconds)
+
+
+class AsyncGenerationPipeline:
+    """
+    Pipeline sinh đề trên asyncio. Payload giống build_generation_pipeline; kết quả (thành công/
+    lỗi/hủy) được đẩy vào self.results. client_factory: hàm trả về client AI cho mỗi item (client
+    không có send_data_to_AI_async thì gọi bản đồng bộ trong executor - VD client giả lập của benchmark).
+    """
+
+    def __init__(self, project_id, creds, model_name, cancel_token=None,
+                 max_in_flight: Optional[int] = None, io_workers: int = 8,
+                 render_workers: Optional[int] = None, output_root=None,
+                 client_factory: Optional[Callable] = None, model_rpm: Optional[float] = None,
+                 image_rpm: Optional[float] = None, rate_limit_backoff: Optional[float] = None):
+        self.project_id = project_id
+        self.creds = creds
+        self.model_name = model_name
+        self.cancel_token = cancel_token
+        self.output_root = output_root
+        self.client_factory = client_factory
+        self.max_in_flight = max_in_flight or int(_env_number("ASYNC_MAX_IN_FLIGHT", DEFAULT_MAX_IN_FLIGHT))
+        self.model_rpm = _env_number("MODEL_RPM", DEFAULT_MODEL_RPM) if model_rpm is None else model_rpm
+        self.image_rpm = _env_number("IMAGE_RPM", DEFAULT_IMAGE_RPM) if image_rpm is None else image_rpm
+        self.rate_limit_backoff = (_env_number("RATE_LIMIT_BACKOFF", 30) if rate_limit_backoff is None
+                                   else rate_limit_backoff)
+        if render_workers is None:
+            render_workers = max(1, min(4, (os.cpu_count() or 2) // 2))
+        self.results = queue.Queue()
+        self.cleanups: List[Callable[[], None]] = []
+        self._io = ThreadPoolExecutor(max_workers=io_workers, thread_name_prefix="async-io")
+        self._render = ThreadPoolExecutor(max_workers=render_workers, thread_name_prefix="async-render")
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._thread: Optional[threading.Thread] = None
+        self._closed: Optional[asyncio.Event] = None
+        self._tasks = set()
+        self._client = None
+        self._image_client = None
+
+    @property
+    def capacity(self) -> int:
+        return self.max_in_flight
+
+    # ---------------- Vòng đời (gọi từ luồng điều phối) ----------------
+
+    def start(self):
+        ready = threading.Event()
+        self._thread = threading.Thread(target=lambda: asyncio.run(self._main(ready)),
+                                        daemon=True, name="async-pipeline")
+        self._thread.start()
+        ready.wait()
+        return self
+
+    def submit(self, item: PipelineItem, timeout: Optional[float] = None):
+        """Đưa item vào event loop (không chặn; số item đồng thời do luồng điều phối giữ <= capacity)"""
+        self._loop.call_soon_threadsafe(self._spawn, item)
+
+    def close(self):
+        """Không nhận thêm item; event loop dừng sau khi các item đang chạy kết thúc"""
+        self._loop.call_soon_threadsafe(self._closed.set)
+
+    def join(self, timeout: Optional[float] = None):
+        if self._thread is not None:
+            self._thread.join(timeout)
+        if self.cancel_token is not None:
+            self.cancel_token.remove_callback(self._on_cancel)
+        for executor in (self._io, self._render):
+            executor.shutdown(wait=False, cancel_futures=True)
+        for cleanup in self.cleanups:
+            try:
+                cleanup()
+            except Exception as e:
+                print(f"⚠️ Lỗi khi dọn pipeline: {e}")
+        self.cleanups = []
+
+    def _on_cancel(self):
+        # Gọi từ luồng bấm hủy -> chuyển vào event loop
+        try:
+            self._loop.call_soon_threadsafe(self._cancel_all)
+        except RuntimeError:
+            pass  # loop đã đóng
+
+    def _cancel_all(self):
+        for task in list(self._tasks):
+            task.cancel()
+
+    # ---------------- Event loop ----------------
+
+    async def _main(self, ready: threading.Event):
+        self._loop = asyncio.get_running_loop()
+        self._loop.set_default_executor(self._io)
+        self._closed = asyncio.Event()
+        self.model_limiter = AsyncRateLimiter(self.model_rpm, "model")
+        self.image_limiter = AsyncRateLimiter(self.image_rpm, "image")
+        if self.cancel_token is not None:
+            self.cancel_token.add_callback(self._on_cancel)
+        ready.set()
+
+        await self._closed.wait()
+        while self._tasks:
+            await asyncio.gather(*list(self._tasks), return_exceptions=True)
+
+    def _spawn(self, item: PipelineItem):
+        if self.cancel_token is not None and self.cancel_token.is_cancelled:
+            item.cancelled = True
+            self.results.put(item)
+            return
+        task = self._loop.create_task(self._run_item(item))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    def _stage_time(self, item: PipelineItem, name: str, started: float):
+        elapsed = time.perf_counter() - started
+        item.stage_times[name] = item.stage_times.get(name, 0) + elapsed
+        item.metrics.add_time(f"stage.{name}", elapsed)
+
+    async def _call_in_thread(self, executor, item: PipelineItem, fn, *args):
+        """Chạy fn trong executor, gắn metrics/profiler của item cho luồng đó"""
+        def run():
+            with bind(item.metrics), section(item.profiler):
+                return fn(*args)
+
+        return await self._loop.run_in_executor(executor, run)
+
+    async def _in_thread(self, executor, item: PipelineItem, name: str, fn, *args):
+        started = time.perf_counter()
+        try:
+            return await self._call_in_thread(executor, item, fn, *args)
+        finally:
+            self._stage_time(item, name, started)
+
+    async def _wait_turn(self, limiter: AsyncRateLimiter, item: PipelineItem):
+        """Chờ lượt của limiter (kể cả thời gian tạm dừng do 429), ghi riêng vào rate_limit_wait"""
+        started = time.perf_counter()
+        try:
+            await limiter.acquire()
+        finally:
+            item.metrics.add_time("rate_limit_wait", time.perf_counter() - started)
+
+    async def _rate_limited(self, limiter: AsyncRateLimiter, item: PipelineItem, timer: str,
+                            fn, *args, **kwargs):
+        """
+        Gọi coroutine fn theo lượt của limiter; 429 -> tạm dừng cả nhóm rồi thử lại.
+        timer chỉ đo chính lời gọi fn (độ trễ API), không tính thời gian xếp hàng/backoff.
+        """
+        delay = self.rate_limit_backoff
+        for attempt in range(RATE_LIMIT_ATTEMPTS):
+            await self._wait_turn(limiter, item)
+            started = time.perf_counter()
+            try:
+                return await fn(*args, **kwargs)
+            except Exception as e:
+                if not is_rate_limit_error(e) or attempt == RATE_LIMIT_ATTEMPTS - 1:
+                    raise
+                item.metrics.add_value(f"rate_limited_{limiter.name}")
+                print(f"⏳ Hết quota {limiter.name} (429) - tạm dừng {delay:.0f}s rồi thử lại")
+                limiter.backoff(delay)
+                delay *= 2
+            finally:
+                item.metrics.add_time(timer, time.perf_counter() - started)
+
+    async def _run_item(self, item: PipelineItem):
+        stage = "model"
+        try:
+            await self._model(item)
+            stage = "parse"
+            await self._in_thread(self._io, item, "parse", parse_item, item, self.cancel_token)
+            if not item.error:
+                stage = "image"
+                images = await self._prefetch_images(item)
+                stage = "render"
+                await self._in_thread(self._render, item, "render", self._render_and_save, item, images)
+        except (OperationCancelled, asyncio.CancelledError):
+            item.cancelled = True
+        except Exception as e:
+            item.error = f"[{stage}] {e}"
+        self.results.put(item)
+
+    def _get_client(self):
+        if self.client_factory:
+            return self.client_factory()
+        if self._client is None:
+            # Một client dùng chung (chung connection pool) cho mọi request của pipeline
+            from api.callAPI import AsyncVertexClient
+            self._client = AsyncVertexClient(self.project_id, self.creds, self.model_name)
+        return self._client
+
+    async def _model(self, item: PipelineItem):
+        from process.response2docx import build_model_request
+
+        question_type, _ = TASK_TYPES.get(item.payload["task_type"], TASK_TYPES["TN"])
+        prompt, pdf_files = await self._in_thread(
+            self._io, item, "prepare", build_model_request,
+            item.payload["pdf_files"], item.payload["prompt_content"], question_type,
+            item.payload.get("page_ranges")
+        )
+        item.client = self._get_client()
+
+        print("📤 Đang gửi request tới AI...")
+        started = time.perf_counter()
+        try:
+            if hasattr(item.client, "send_data_to_AI_async"):
+                item.ai_response = await self._rate_limited(
+                    self.model_limiter, item, "model", item.client.send_data_to_AI_async, prompt, pdf_files,
+                    cancel_token=self.cancel_token, metrics=item.metrics
+                )
+            else:
+                await self._wait_turn(self.model_limiter, item)
+                called = time.perf_counter()
+                try:
+                    item.ai_response = await self._call_in_thread(
+                        self._io, item, item.client.send_data_to_AI, prompt, pdf_files, 0.4, 0.8,
+                        self.cancel_token
+                    )
+                finally:
+                    item.metrics.add_time("model", time.perf_counter() - called)
+        finally:
+            self._stage_time(item, "model", started)
+
+    async def _prefetch_images(self, item: PipelineItem) -> Dict[str, Optional[bytes]]:
+        """Sinh song song mọi ảnh của đề (theo IMAGE_RPM); ảnh lỗi -> None (render chèn placeholder)"""
+        from process.response2docx import pending_image_descriptions
+
+        descriptions = pending_image_descriptions(item.data)
+        if not descriptions:
+            return {}
+        from process.text2Image import generate_image_from_text_async, make_image_client
+        if self._image_client is None:
+            try:
+                self._image_client = await self._loop.run_in_executor(self._io, make_image_client)
+            except Exception as e:
+                print(f"❌ Lỗi init client sinh ảnh: {e}")
+        if self._image_client is None:
+            # Render sẽ tự sinh ảnh (hoặc chèn placeholder) như pipeline theo luồng
+            return {}
+
+        async def generate(description):
+            return await self._rate_limited(
+                self.image_limiter, item, "image", generate_image_from_text_async, description,
+                client=self._image_client, metrics=item.metrics
+            )
+
+        started = time.perf_counter()
+        try:
+            results = await asyncio.gather(*(generate(d) for d in descriptions), return_exceptions=True)
+        finally:
+            self._stage_time(item, "image", started)
+        images = {}
+        for description, result in zip(descriptions, results):
+            if isinstance(result, (asyncio.CancelledError, OperationCancelled)):
+                raise result
+            if isinstance(result, BaseException):
+                print(f"❌ Lỗi sinh ảnh: {result}")
+                result = None
+            images[description] = result
+        return images
+
+    def _render_and_save(self, item: PipelineItem, images: Dict[str, Optional[bytes]]):
+        from process.response2docx import render_document
+
+        item.doc = render_document(item.data, self.cancel_token, images=images)
+        if item.doc is None:
+            item.error = "Lỗi khi render DOCX"
+            return
+        save_item(item, self.output_root)
@@ -0,0 +1,285 @@
+import os
+import re
+import threading
+from typing import Dict, Iterable, List, Optional
+
+# ============================================================
+# KẾ TOÁN TOKEN / ẢNH / CHI PHÍ VÀ NGÂN SÁCH THEO LÔ
+# ============================================================
+#
+# Số liệu lấy từ bản ghi TaskMetrics (process.metrics): tokens_in / tokens_out / tokens_thinking
+# do callAPI ghi sau MỖI lần gọi model (sinh đề, bù câu, sửa JSON), images do text2Image ghi
+# mỗi ảnh sinh thành công. UsageLedger cộng dồn theo tác vụ -> nhóm (output_name) -> lô (batch).
+#
+# Ngân sách (để trống = không giới hạn):
+#   BUDGET_MAX_TOKENS   tổng token (in + out + thinking) của lô
+#   BUDGET_MAX_IMAGES   số ảnh sinh mới
+#   BUDGET_MAX_COST     chi phí ước tính (USD)
+#   BUDGET_ACTION       pause (mặc định): ngừng nhận job mới, job đang chạy làm nốt, phần còn lại
+#                       nằm trong hàng đợi chạy tiếp lần sau; stop: hủy luôn các job đang chạy
+# Đơn giá (USD, đổi bằng biến môi trường khi bảng giá thay đổi):
+#   PRICE_INPUT_PER_M / PRICE_OUTPUT_PER_M (thinking tính như output) / PRICE_PER_IMAGE
+
+TOKEN_KEYS = ("tokens_in", "tokens_out", "tokens_thinking")
+BUDGET_ACTIONS = ("pause", "stop")
+
+# Gemini 2.5 Pro (prompt <= 200k token) và gemini-3-pro-image-preview
+DEFAULT_PRICE_INPUT_PER_M = 1.25
+DEFAULT_PRICE_OUTPUT_PER_M = 10.0
+DEFAULT_PRICE_PER_IMAGE = 0.134
+
+# Ước tính trước khi chạy: Gemini tính ~258 token cho mỗi trang PDF
+TOKENS_PER_PDF_PAGE = 258
+# Không đếm được trang (PDF nén object stream) -> đoán theo dung lượng
+BYTES_PER_PDF_PAGE = 100 * 1024
+# Tiếng Việt có dấu: ~3 ký tự / token
+CHARS_PER_TOKEN = 3
+_PDF_PAGE_RE = re.compile(rb'/Type\s*/Page(?!s)')
+
+
+def _env_float(name: str, default: Optional[float] = None) -> Optional[float]:
+    value = os.getenv(name, "").strip()
+    if not value:
+        return default
+    try:
+        return float(value)
+    except ValueError:
+        print(f"⚠️ {name}={value!r} không phải số, bỏ qua")
+        return default
+
+
+class Pricing:
+    """Đơn giá token/ảnh -> chi phí ước tính"""
+
+    def __init__(self, input_per_m: float = DEFAULT_PRICE_INPUT_PER_M,
+                 output_per_m: float = DEFAULT_PRICE_OUTPUT_PER_M,
+                 per_image: float = DEFAULT_PRICE_PER_IMAGE):
+        self.input_per_m = input_per_m
+        self.output_per_m = output_per_m
+        self.per_image = per_image
+
+    @classmethod
+    def from_env(cls) -> "Pricing":
+        return cls(
+            _env_float("PRICE_INPUT_PER_M", DEFAULT_PRICE_INPUT_PER_M),
+            _env_float("PRICE_OUTPUT_PER_M", DEFAULT_PRICE_OUTPUT_PER_M),
+            _env_float("PRICE_PER_IMAGE", DEFAULT_PRICE_PER_IMAGE),
+        )
+
+    def cost(self, usage: Dict) -> float:
+        output = usage.get("tokens_out", 0) + usage.get("tokens_thinking", 0)
+        return (usage.get("tokens_in", 0) * self.input_per_m / 1e6
+                + output * self.output_per_m / 1e6
+                + usage.get("images", 0) * self.per_image)
+
+
+def usage_from_record(record: Dict) -> Dict[str, float]:
+    """Lấy phần token/ảnh từ một bản ghi TaskMetrics.to_dict()"""
+    values = record.get("values", {})
+    usage = {key: values.get(key, 0) for key in TOKEN_KEYS}
+    usage["images"] = values.get("images", 0)
+    return usage
+
+
+def total_tokens(usage: Dict) -> float:
+    return sum(usage.get(key, 0) for key in TOKEN_KEYS)
+
+
+class UsageLedger:
+    """Cộng dồn token/ảnh theo tác vụ, nhóm và lô; thread-safe"""
+
+    def __init__(self, pricing: Optional[Pricing] = None):
+        self.pricing = pricing or Pricing.from_env()
+        self.tasks: List[Dict] = []
+        self.groups: Dict[str, Dict[str, float]] = {}
+        self.batches: Dict[str, Dict[str, float]] = {}
+        self.total: Dict[str, float] = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _add(target: Dict[str, float], usage: Dict):
+        for key, value in usage.items():
+            target[key] = target.get(key, 0) + value
+
+    def add(self, record: Dict, group: str = "", batch: str = "") -> Dict:
+        """Ghi nhận một tác vụ đã kết thúc; trả về usage của tác vụ (kèm cost)"""
+        usage = usage_from_record(record)
+        usage["cost"] = self.pricing.cost(usage)
+        with self._lock:
+            self.tasks.append(dict(usage, label=record.get("label", ""), group=group, batch=batch))
+            self._add(self.groups.setdefault(group, {}), usage)
+            self._add(self.batches.setdefault(batch, {}), usage)
+            self._add(self.total, usage)
+        return usage
+
+    def snapshot(self) -> Dict[str, float]:
+        with self._lock:
+            return dict(self.total)
+
+    def format_summary(self, top_groups: int = 5) -> str:
+        with self._lock:
+            total = dict(self.total)
+            groups = {name: dict(usage) for name, usage in self.groups.items()}
+        if not total or not (total_tokens(total) or total.get("images")):
+            return ""
+        lines = [
+            f"💰 Token: in {int(total.get('tokens_in', 0)):,} | out {int(total.get('tokens_out', 0)):,}"
+            f" | thinking {int(total.get('tokens_thinking', 0)):,} | ảnh {int(total.get('images', 0))}"
+            f" | ước tính ${total.get('cost', 0):.2f}"
+        ]
+        if len(groups) > 1:
+            for name, usage in sorted(groups.items(), key=lambda kv: kv[1].get("cost", 0), reverse=True)[:top_groups]:
+                lines.append(f"   • {name}: {int(total_tokens(usage)):,} token | "
+                             f"{int(usage.get('images', 0))} ảnh | ${usage.get('cost', 0):.2f}")
+        return "\n".join(lines)
+
+
+class Budget:
+    """Giới hạn token / ảnh / chi phí cho một lần chạy; None = không giới hạn"""
+
+    def __init__(self, max_tokens: Optional[float] = None, max_images: Optional[float] = None,
+                 max_cost: Optional[float] = None, action: str = "pause"):
+        self.max_tokens = max_tokens
+        self.max_images = max_images
+        self.max_cost = max_cost
+        self.action = action if action in BUDGET_ACTIONS else "pause"
+
+    @classmethod
+    def from_env(cls) -> "Budget":
+        return cls(
+            _env_float("BUDGET_MAX_TOKENS"),
+            _env_float("BUDGET_MAX_IMAGES"),
+            _env_float("BUDGET_MAX_COST"),
+            os.getenv("BUDGET_ACTION", "pause").strip().lower(),
+        )
+
+    @property
+    def enabled(self) -> bool:
+        return any(limit is not None for limit in (self.max_tokens, self.max_images, self.max_cost))
+
+    def exceeded(self, usage: Dict) -> Optional[str]:
+        """Lý do vượt ngân sách (None nếu còn trong giới hạn); usage cần có cost"""
+        if self.max_tokens is not None and total_tokens(usage) >= self.max_tokens:
+            return f"token {int(total_tokens(usage)):,}/{int(self.max_tokens):,}"
+        if self.max_images is not None and usage.get("images", 0) >= self.max_images:
+            return f"ảnh {int(usage.get('images', 0))}/{int(self.max_images)}"
+        if self.max_cost is not None and usage.get("cost", 0) >= self.max_cost:
+            return f"chi phí ${usage.get('cost', 0):.2f}/${self.max_cost:.2f}"
+        return None
+
+    def describe(self) -> str:
+        limits = []
+        if self.max_tokens is not None:
+            limits.append(f"{int(self.max_tokens):,} token")
+        if self.max_images is not None:
+            limits.append(f"{int(self.max_images)} ảnh")
+        if self.max_cost is not None:
+            limits.append(f"${self.max_cost:.2f}")
+        return ", ".join(limits) + f" (vượt -> {self.action})"
+
+
+# ---------------- Ước tính trước khi chạy ----------------
+
+_page_cache = None
+_page_cache_guard = threading.Lock()
+
+
+def _get_page_cache():
+    """Số trang theo (đường dẫn, kích thước, mtime), bền vững trong PDF_PAGE_CACHE (mặc định ./.cache/pdf_pages.json)"""
+    global _page_cache
+    from process.dedupe import FileStatCache
+
+    with _page_cache_guard:
+        if _page_cache is None:
+            _page_cache = FileStatCache(
+                os.getenv("PDF_PAGE_CACHE") or os.path.join(os.getcwd(), ".cache", "pdf_pages.json"))
+        return _page_cache
+
+
+def _scan_pdf_pages(path: str) -> int:
+    """Dò '/Type /Page' theo từng khối 1 MB (không nạp cả file); không thấy -> đoán theo dung lượng"""
+    pages = 0
+    size = 0
+    tail = b""
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            size += len(chunk)
+            data = tail + chunk
+            # Match nằm trọn trong phần đuôi khối trước đã được đếm ở lượt trước
+            pages += sum(1 for m in _PDF_PAGE_RE.finditer(data) if m.end() > len(tail))
+            tail = data[-64:]
+    return pages or max(1, size // BYTES_PER_PDF_PAGE)
+
+
+def _read_pdf_pages(path: str) -> int:
+    try:
+        from pypdf import PdfReader
+    except ImportError:
+        return _scan_pdf_pages(path)
+    try:
+        # Truyền file đã mở: PdfReader(đường dẫn) sẽ đọc cả file vào bộ nhớ, file mở thì chỉ đọc xref + cây trang
+        with open(path, "rb") as f:
+            return len(PdfReader(f).pages)
+    except OSError:
+        raise
+    except Exception:
+        # PDF lỗi cấu trúc -> dò thô
+        return _scan_pdf_pages(path)
+
+
+def count_pdf_pages(path: str) -> int:
+    """Số trang PDF (pypdf, thiếu/lỗi thì dò '/Type /Page'); nhớ theo file nên chạy lại không phải đọc lại"""
+    try:
+        return _get_page_cache().get(path, _read_pdf_pages)
+    except OSError:
+        return 0
+
+
+def estimate_task_usage(pdf_files: Iterable[str], prompt: str,
+                        page_counts: Optional[Dict[str, int]] = None,
+                        page_ranges: Optional[Dict[str, str]] = None) -> Dict[str, float]:
+    """
+    Ước tính token một tác vụ: input = trang PDF + prompt, output = ESTIMATE_OUTPUT_TOKENS
+    (gồm cả thinking; chỉnh theo số liệu thật trong metrics.jsonl), ảnh = ESTIMATE_IMAGES_PER_TASK.
+    page_counts: cache số trang theo đường dẫn (một PDF thường có trong cả TN, DS, TLN).
+    page_ranges: chỉ tính các trang đã chọn (xem process.pdf_pages).
+    """
+    from process.pdf_pages import pages_for
+
+    pages = 0
+    for path in pdf_files:
+        if page_counts is not None:
+            if path not in page_counts:
+                page_counts[path] = count_pdf_pages(path)
+            file_pages = page_counts[path]
+        else:
+            file_pages = count_pdf_pages(path)
+        selected = pages_for(page_ranges, path)
+        pages += min(len(selected), file_pages) if selected else file_pages
+    return {
+        "tokens_in": pages * TOKENS_PER_PDF_PAGE + len(prompt) // CHARS_PER_TOKEN,
+        "tokens_out": _env_float("ESTIMATE_OUTPUT_TOKENS", 16000),
+        "tokens_thinking": 0,
+        "images": _env_float("ESTIMATE_IMAGES_PER_TASK", 0),
+    }
+
+
+def preflight_estimate(tasks: Iterable, pricing: Optional[Pricing] = None) -> Dict[str, float]:
+    """Tổng ước tính cho danh sách TaskInfo (cần .pdf_files, .prompt_content)"""
+    pricing = pricing or Pricing.from_env()
+    total: Dict[str, float] = {"tasks": 0}
+    page_counts: Dict[str, int] = {}
+    for task in tasks:
+        usage = estimate_task_usage(task.pdf_files, task.prompt_content, page_counts,
+                                    getattr(task, "page_ranges", None))
+        for key, value in usage.items():
+            total[key] = total.get(key, 0) + value
+        total["tasks"] += 1
+    total["cost"] = pricing.cost(total)
+    return total
+
+
+def format_estimate(estimate: Dict) -> str:
+    return (f"🧮 Ước tính {int(estimate.get('tasks', 0))} tác vụ: ~{int(total_tokens(estimate)):,} token"
+            f" (in {int(estimate.get('tokens_in', 0)):,} | out {int(estimate.get('tokens_out', 0)):,})"
+            f" | {int(estimate.get('images', 0))} ảnh | ~${estimate.get('cost', 0):.2f}")
@@ -0,0 +1,158 @@
+import subprocess
+import threading
+import time
+from typing import Callable, Optional
+
+# ============================================================
+# HỦY TÁC VỤ HỢP TÁC (COOPERATIVE CANCELLATION)
+# ============================================================
+
+
+class OperationCancelled(BaseException):
+    """
+    Tác vụ bị người dùng hủy.
+    Kế thừa BaseException (giống asyncio.CancelledError) để các khối
+    `except Exception` rải rác trong pipeline không nuốt mất tín hiệu hủy.
+    """
+
+
+class CancellationToken:
+    """
+    Cờ hủy dùng chung giữa ProcessingThread và các luồng con.
+    Có thể truyền một multiprocessing.Event để dùng trong tiến trình con.
+    """
+
+    def __init__(self, event=None):
+        self._event = event if event is not None else threading.Event()
+        self._lock = threading.Lock()
+        self._callbacks = []
+
+    @property
+    def is_cancelled(self) -> bool:
+        return self._event.is_set()
+
+    def cancel(self):
+        """Bật cờ hủy và gọi các callback đã đăng ký (VD: kill tiến trình pandoc)"""
+        with self._lock:
+            if self._event.is_set():
+                return
+            self._event.set()
+            callbacks = list(self._callbacks)
+            self._callbacks.clear()
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception as e:
+                print(f"⚠️ Lỗi callback hủy: {e}")
+
+    def raise_if_cancelled(self):
+        if self._event.is_set():
+            raise OperationCancelled()
+
+    def wait(self, timeout: Optional[float] = None) -> bool:
+        """Ngủ tối đa timeout giây, thức dậy ngay khi bị hủy. Trả về True nếu đã hủy."""
+        return self._event.wait(timeout)
+
+    def add_callback(self, callback: Callable[[], None]):
+        with self._lock:
+            if not self._event.is_set():
+                self._callbacks.append(callback)
+                return
+        callback()
+
+    def remove_callback(self, callback: Callable[[], None]):
+        with self._lock:
+            try:
+                self._callbacks.remove(callback)
+            except ValueError:
+                pass
+
+
+def raise_if_cancelled(cancel_token: Optional[CancellationToken]):
+    if cancel_token is not None:
+        cancel_token.raise_if_cancelled()
+
+
+def run_cancellable(fn, *args, cancel_token: Optional[CancellationToken] = None,
+                    poll_interval: float = 0.2, **kwargs):
+    """
+    Chạy một lời gọi blocking (VD: generate_content) trong luồng phụ và chờ kết quả.
+    Nếu token bị hủy, trả quyền điều khiển ngay bằng OperationCancelled; lời gọi đang
+    dở bị bỏ rơi ở luồng daemon (kết quả của nó bị bỏ qua).
+    """
+    if cancel_token is None:
+        return fn(*args, **kwargs)
+    cancel_token.raise_if_cancelled()
+
+    done = threading.Event()
+    outcome = {}
+
+    def target():
+        try:
+            outcome["result"] = fn(*args, **kwargs)
+        except BaseException as e:
+            outcome["error"] = e
+        finally:
+            done.set()
+
+    threading.Thread(target=target, daemon=True).start()
+
+    while not done.wait(poll_interval):
+        if cancel_token.is_cancelled:
+            raise OperationCancelled()
+
+    if "error" in outcome:
+        raise outcome["error"]
+    return outcome["result"]
+
+
+def run_subprocess_cancellable(args, input=None, timeout: Optional[float] = None,
+                               cancel_token: Optional[CancellationToken] = None,
+                               poll_interval: float = 0.2, **popen_kwargs) -> subprocess.CompletedProcess:
+    """
+    Tương đương subprocess.run(capture_output=True) nhưng kill tiến trình con
+    ngay khi token bị hủy (OperationCancelled) hoặc quá timeout (TimeoutExpired).
+    """
+    proc = subprocess.Popen(
+        args,
+        stdin=subprocess.PIPE if input is not None else None,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        **popen_kwargs
+    )
+    kill = proc.kill
+    if cancel_token is not None:
+        cancel_token.add_callback(kill)
+
+    deadline = time.monotonic() + timeout if timeout else None
+    pending_input = input
+    try:
+        while True:
+            if cancel_token is not None and cancel_token.is_cancelled:
+                proc.kill()
+                proc.communicate()
+                raise OperationCancelled()
+
+            wait = poll_interval
+            if deadline is not None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    proc.kill()
+                    proc.communicate()
+                    raise subprocess.TimeoutExpired(args, timeout)
+                wait = min(wait, remaining)
+
+            try:
+                stdout, stderr = proc.communicate(pending_input, timeout=wait)
+                break
+            except subprocess.TimeoutExpired:
+                # Input đã được gửi ở lần gọi đầu, các lần sau chỉ chờ tiếp
+                pending_input = None
+    finally:
+        if cancel_token is not None:
+            cancel_token.remove_callback(kill)
+
+    # Tiến trình kết thúc do callback hủy đã kill nó
+    if cancel_token is not None and cancel_token.is_cancelled:
+        raise OperationCancelled()
+    return subprocess.CompletedProcess(args, proc.returncode, stdout, stderr)
@@ -0,0 +1,231 @@
+import hashlib
+import json
+import os
+import shutil
+import threading
+from typing import Dict, List, Optional, Tuple
+
+from process.metrics import add_value
+
+# ============================================================
+# PHÁT HIỆN FILE / NHÓM TRÙNG NỘI DUNG (THEO SHA-256)
+# ============================================================
+#
+# Cùng một PDF hay nằm ở nhiều thư mục ("SGK" và "Tài liệu tham khảo"), trước đây chỉ loại trùng theo
+# đường dẫn nên đề bị sinh hai lần. Giờ mỗi file được băm SHA-256 nội dung:
+#   - Cache băm bền vững (đường dẫn, kích thước, mtime) -> SHA-256 trong FILE_HASH_CACHE
+#     (mặc định ./.cache/file_hashes.json): chạy lại không phải đọc lại cả cuốn sách.
+#   - File giống hệt nhau chỉ giữ một bản (đường dẫn nhỏ nhất) trước khi gom nhóm.
+#   - Các bản sao được gom nhóm riêng; nhóm nào có đúng cùng nội dung với một nhóm chính thì
+#     KHÔNG sinh lại mà trở thành tên phụ (alias): file kết quả của nhóm chính được link sang
+#     thư mục/tên của nhóm phụ sau khi lưu.
+
+
+class FileStatCache:
+    """Giá trị tính từ nội dung file, nhớ theo (đường dẫn, kích thước, mtime) trên đĩa; thread-safe"""
+
+    def __init__(self, cache_path: str):
+        self.cache_path = cache_path
+        self._entries: Optional[Dict[str, list]] = None
+        self._lock = threading.Lock()
+
+    def _load(self):
+        if self._entries is not None:
+            return
+        try:
+            with open(self.cache_path, "r", encoding="utf-8") as f:
+                self._entries = dict(json.load(f))
+        except (OSError, ValueError, TypeError):
+            self._entries = {}
+
+    def _save(self):
+        # Ghi file tạm rồi os.replace: nhiều tiến trình (GUI + worker) cùng ghi không làm hỏng cache
+        tmp_path = f"{self.cache_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            os.makedirs(os.path.dirname(self.cache_path) or ".", exist_ok=True)
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(self._entries, f, ensure_ascii=False)
+            os.replace(tmp_path, self.cache_path)
+        except OSError as e:
+            print(f"⚠️ Không ghi được cache {os.path.basename(self.cache_path)}: {e}")
+
+    def get(self, path: str, compute):
+        """Giá trị đã nhớ nếu file chưa đổi (cùng kích thước, mtime); không thì compute(path) rồi lưu"""
+        st = os.stat(path)
+        key = os.path.abspath(path)
+        with self._lock:
+            self._load()
+            entry = self._entries.get(key)
+            if entry and entry[0] == st.st_size and entry[1] == st.st_mtime:
+                return entry[2]
+
+        value = compute(path)
+
+        with self._lock:
+            self._entries[key] = [st.st_size, st.st_mtime, value]
+            self._save()
+        return value
+
+
+class FileHashCache(FileStatCache):
+    """SHA-256 theo nội dung file (đọc từng khối 1 MB)"""
+
+    def sha256(self, path: str) -> str:
+        return self.get(path, self._digest)
+
+    @staticmethod
+    def _digest(path: str) -> str:
+        sha = hashlib.sha256()
+        size = 0
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                sha.update(chunk)
+                size += len(chunk)
+        add_value("file_hash_bytes", size)
+        return sha.hexdigest()
+
+
+_hash_cache: Optional[FileHashCache] = None
+_hash_cache_guard = threading.Lock()
+
+
+def get_hash_cache() -> FileHashCache:
+    global _hash_cache
+    with _hash_cache_guard:
+        if _hash_cache is None:
+            _hash_cache = FileHashCache(
+                os.getenv("FILE_HASH_CACHE") or os.path.join(os.getcwd(), ".cache", "file_hashes.json"))
+        return _hash_cache
+
+
+def file_sha256(path: str) -> str:
+    """SHA-256 nội dung file (qua cache bền vững)"""
+    return get_hash_cache().sha256(path)
+
+
+# ---------------- Gộp file / nhóm trùng ----------------
+
+def _content_key(path: str, page_ranges: Optional[Dict[str, str]]) -> Tuple[str, str]:
+    # Cùng file nhưng chọn khoảng trang khác nhau -> đề khác nhau, không gộp
+    spec = "".join((page_ranges or {}).get(path, "").split())
+    return file_sha256(path), spec
+
+
+def collapse_identical_files(file_paths: List[str],
+                             page_ranges: Optional[Dict[str, str]] = None) -> Tuple[List[str], Dict[str, List[str]]]:
+    """
+    -> (các file đại diện, {file đại diện: [các bản sao cùng nội dung và cùng khoảng trang]}).
+    File không đọc được giữ nguyên như file riêng (lỗi sẽ báo ở bước gửi AI như cũ).
+    """
+    representatives: Dict[Tuple[str, str], str] = {}
+    unique = []
+    copies: Dict[str, List[str]] = {}
+    for path in sorted(set(file_paths)):
+        try:
+            key = _content_key(path, page_ranges)
+        except OSError as e:
+            print(f"⚠️ Không băm được {path}: {e}")
+            unique.append(path)
+            continue
+        kept = representatives.setdefault(key, path)
+        if kept == path:
+            unique.append(path)
+        else:
+            copies.setdefault(kept, []).append(path)
+    return unique, copies
+
+
+def _group_signature(files: List[str], page_ranges: Optional[Dict[str, str]]) -> Optional[tuple]:
+    try:
+        return tuple(sorted({_content_key(path, page_ranges) for path in files}))
+    except OSError:
+        return None
+
+
+def merge_identical_groups(groups: Dict[str, List[str]], copy_groups: Dict[str, List[str]],
+                           page_ranges: Optional[Dict[str, str]] = None
+                           ) -> Tuple[Dict[str, List[str]], Dict[str, List[str]]]:
+    """
+    groups: nhóm của các file đại diện; copy_groups: nhóm của các bản sao (gom riêng).
+    Nhóm bản sao trùng nội dung với một nhóm chính -> tên phụ của nhóm đó; không trùng -> nhóm mới.
+    -> (nhóm cần sinh, {tên nhóm chính: [tên phụ]}).
+    """
+    merged = dict(groups)
+    by_signature = {}
+    for name, files in groups.items():
+        signature = _group_signature(files, page_ranges)
+        if signature is not None:
+            by_signature.setdefault(signature, name)
+
+    aliases: Dict[str, List[str]] = {}
+    for name, files in copy_groups.items():
+        primary = by_signature.get(_group_signature(files, page_ranges))
+        if primary is not None:
+            # Trùng cả tên -> kết quả vốn đã nằm đúng chỗ
+            if name != primary and name not in aliases.get(primary, []):
+                aliases.setdefault(primary, []).append(name)
+            continue
+        base_name = name
+        counter = 1
+        while name in merged:
+            name = f"{base_name}_{counter}"
+            counter += 1
+        merged[name] = files
+    return merged, aliases
+
+
+def dedupe_selection(file_paths: List[str], group_files,
+                     page_ranges: Optional[Dict[str, str]] = None
+                     ) -> Tuple[Dict[str, List[str]], Dict[str, List[str]], int]:
+    """
+    Gộp file trùng rồi gom nhóm bằng group_files (hàm gom nhóm của GUI); bản sao gom nhóm riêng
+    và thành tên phụ nếu trùng nhóm chính. Băm cả file ở lần đầu -> gọi từ luồng nền, không từ UI.
+    -> (nhóm cần sinh, {tên nhóm chính: [tên phụ]}, số file bản sao).
+    """
+    unique, copies = collapse_identical_files(file_paths, page_ranges)
+    groups = group_files(unique)
+    if not copies:
+        return groups, {}, 0
+    copy_files = [path for paths in copies.values() for path in paths]
+    groups, aliases = merge_identical_groups(groups, group_files(copy_files), page_ranges)
+    return groups, aliases, len(copy_files)
+
+
+# ---------------- Link kết quả sang tên phụ ----------------
+
+def _link_or_copy(source: str, target: str):
+    """Hard link (không tốn thêm dung lượng), khác ổ đĩa / không hỗ trợ -> copy; thay file cũ nguyên tử"""
+    tmp_path = f"{target}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        os.link(source, tmp_path)
+    except OSError:
+        shutil.copy2(source, tmp_path)
+    os.replace(tmp_path, target)
+
+
+def link_alias_outputs(output_path: str, output_name: str, aliases: List[str]) -> List[str]:
+    """
+    <gốc>/<nhóm>/<nhóm>_TN.docx (+ file đi kèm) -> <gốc>/<tên phụ>/<tên phụ>_TN.docx cho mỗi tên phụ.
+    Trả về các file DOCX đã tạo; lỗi một tên phụ chỉ báo, không làm hỏng job.
+    """
+    from process.exporters import canonical_json_path_for
+    from process.preview_html import preview_path_for
+
+    output_root = os.path.dirname(os.path.dirname(output_path))
+    base_name = os.path.basename(output_path)
+    suffix = base_name[len(output_name):] if base_name.startswith(output_name) else f"_{base_name}"
+    linked = []
+    for alias in aliases:
+        target = os.path.join(output_root, alias, f"{alias}{suffix}")
+        try:
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            for source, dest in ((output_path, target),
+                                 (preview_path_for(output_path), preview_path_for(target)),
+                                 (canonical_json_path_for(output_path), canonical_json_path_for(target))):
+                if os.path.exists(source):
+                    _link_or_copy(source, dest)
+            linked.append(target)
+            print(f"🔗 Nội dung trùng {output_name} -> {target}")
+        except OSError as e:
+            print(f"⚠️ Không tạo được bản cho {alias}: {e}")
+    return linked
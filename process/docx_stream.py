@@ -0,0 +1,316 @@
+import os
+import re
+import shutil
+import struct
+import tempfile
+import zipfile
+from typing import List, Optional
+from xml.sax.saxutils import escape
+
+# ============================================================
+# GHI DOCX DẠNG STREAMING (CHO ĐỀ RẤT LỚN)
+# ============================================================
+#
+# python-docx giữ toàn bộ cây XML trong RAM và mỗi add_paragraph/add_run đều qua lxml.
+# StreamingDocument mô phỏng đúng phần API mà DynamicDocxRenderer dùng
+# (add_paragraph, add_heading, add_picture, paragraphs[-1], Run.bold/italic/font.color.rgb)
+# nhưng mỗi đoạn được ghi thẳng ra file tạm ngay khi đoạn kế tiếp bắt đầu.
+# Khi save(): ghép các part của template mặc định + document.xml (copy theo khối) + ảnh
+# vào file zip => bộ nhớ không tăng theo số câu hỏi.
+
+_R_NS = "http://schemas.openxmlformats.org/officeDocument/2006/relationships"
+_IMAGE_REL = "http://schemas.openxmlformats.org/officeDocument/2006/relationships/image"
+
+# WD_ALIGN_PARAGRAPH (LEFT=0, CENTER=1, RIGHT=2, JUSTIFY=3) -> giá trị w:jc
+_ALIGNMENT_VALUES = {0: "left", 1: "center", 2: "right", 3: "both"}
+
+# Ký tự điều khiển không hợp lệ trong XML 1.0 (python-docx sẽ báo lỗi, ở đây bỏ đi)
+_INVALID_XML_CHARS = re.compile(r"[\x00-\x08\x0b\x0c\x0e-\x1f]")
+_TEXT_SPECIALS = re.compile(r"(\n|\t)")
+
+_EMU_PER_INCH = 914400
+_DEFAULT_DPI = 72
+
+_BODY_COPY_CHUNK = 1024 * 1024
+
+
+def _default_template_path() -> str:
+    """default.docx đi kèm python-docx (styles Heading 1-3, sectPr A4...)"""
+    import docx
+    return os.path.join(os.path.dirname(docx.__file__), "templates", "default.docx")
+
+
+def _image_info(image_bytes: bytes):
+    """Trả về (đuôi file, content type, rộng px, cao px) từ header ảnh, không cần Pillow"""
+    if image_bytes[:8] == b"\x89PNG\r\n\x1a\n" and len(image_bytes) >= 24:
+        width, height = struct.unpack(">II", image_bytes[16:24])
+        return "png", "image/png", width, height
+    if image_bytes[:6] in (b"GIF87a", b"GIF89a") and len(image_bytes) >= 10:
+        width, height = struct.unpack("<HH", image_bytes[6:10])
+        return "gif", "image/gif", width, height
+    if image_bytes[:2] == b"\xff\xd8":
+        # Duyệt các segment tới SOFn để lấy kích thước
+        i = 2
+        while i + 9 < len(image_bytes):
+            if image_bytes[i] != 0xFF:
+                i += 1
+                continue
+            marker = image_bytes[i + 1]
+            if marker in (0xD8, 0x01) or 0xD0 <= marker <= 0xD7:
+                i += 2
+                continue
+            length = struct.unpack(">H", image_bytes[i + 2:i + 4])[0]
+            if 0xC0 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC):
+                height, width = struct.unpack(">HH", image_bytes[i + 5:i + 9])
+                return "jpeg", "image/jpeg", width, height
+            i += 2 + length
+        return "jpeg", "image/jpeg", 0, 0
+    return "png", "image/png", 0, 0
+
+
+def _text_to_xml(text: str) -> str:
+    """Giống python-docx: \\n -> <w:br/>, \\t -> <w:tab/>"""
+    parts = []
+    for piece in _TEXT_SPECIALS.split(_INVALID_XML_CHARS.sub("", text)):
+        if piece == "\n":
+            parts.append("<w:br/>")
+        elif piece == "\t":
+            parts.append("<w:tab/>")
+        elif piece:
+            parts.append(f'<w:t xml:space="preserve">{escape(piece)}</w:t>')
+    return "".join(parts)
+
+
+class _Color:
+    def __init__(self):
+        self.rgb = None
+
+
+class _Font:
+    def __init__(self):
+        self.color = _Color()
+
+
+class _RunElement:
+    """Thay cho run._r của python-docx: chỉ hỗ trợ append() phần tử OMML"""
+
+    def __init__(self, run):
+        self._run = run
+
+    def append(self, element):
+        from lxml import etree
+        self._run._raw.append(etree.tostring(element, encoding="unicode"))
+
+
+class StreamingRun:
+    def __init__(self, text: Optional[str] = None):
+        self.text = text
+        self.bold = None
+        self.italic = None
+        self.font = _Font()
+        self._raw: List[str] = []
+
+    @property
+    def _r(self):
+        return _RunElement(self)
+
+    def add_omml(self, omml_str: str):
+        """Chèn chuỗi OMML (<m:oMath ...>) trực tiếp, không qua lxml"""
+        self._raw.append(omml_str)
+
+    def to_xml(self) -> str:
+        props = []
+        if self.bold:
+            props.append("<w:b/>")
+        if self.italic:
+            props.append("<w:i/>")
+        rgb = self.font.color.rgb
+        if rgb is not None:
+            props.append('<w:color w:val="%02X%02X%02X"/>' % tuple(rgb))
+        rpr = f"<w:rPr>{''.join(props)}</w:rPr>" if props else ""
+        body = _text_to_xml(self.text) if self.text else ""
+        return f"<w:r>{rpr}{body}{''.join(self._raw)}</w:r>"
+
+
+class StreamingParagraph:
+    def __init__(self, document, style_id: Optional[str] = None):
+        self._document = document
+        self.style_id = style_id
+        self.alignment = None
+        self.runs: List[StreamingRun] = []
+        self._raw: List[str] = []
+        self._flushed = False
+
+    def add_run(self, text: Optional[str] = None, style=None) -> StreamingRun:
+        if self._flushed:
+            raise RuntimeError("Đoạn văn đã được ghi ra file, không thể thêm run")
+        run = StreamingRun(text)
+        self.runs.append(run)
+        return run
+
+    def add_omml(self, omml_str: str):
+        """Chèn công thức vào một run mới (cùng cấu trúc với run._r.append của python-docx)"""
+        self.add_run().add_omml(omml_str)
+
+    def _add_raw(self, xml: str):
+        self._raw.append(xml)
+
+    def to_xml(self) -> str:
+        props = []
+        if self.style_id:
+            props.append(f'<w:pStyle w:val="{self.style_id}"/>')
+        if self.alignment is not None:
+            props.append(f'<w:jc w:val="{_ALIGNMENT_VALUES.get(int(self.alignment), "left")}"/>')
+        ppr = f"<w:pPr>{''.join(props)}</w:pPr>" if props else ""
+        runs = "".join(run.to_xml() for run in self.runs)
+        return f"<w:p>{ppr}{runs}{''.join(self._raw)}</w:p>"
+
+
+class StreamingDocument:
+    """
+    Document ghi dần ra đĩa, dùng thay python-docx Document cho DynamicDocxRenderer.
+    Chỉ đoạn cuối cùng còn sửa được (đủ cho renderer: doc.paragraphs[-1].alignment = ...).
+    """
+
+    def __init__(self, template_path: Optional[str] = None):
+        self.template_path = template_path or _default_template_path()
+        self._tmpdir = tempfile.TemporaryDirectory(prefix="genques_docx_")
+        self._body_path = os.path.join(self._tmpdir.name, "body.xml")
+        self._body = open(self._body_path, "w", encoding="utf-8")
+        self._current: Optional[StreamingParagraph] = None
+        self._images = []  # (rel_id, đường dẫn ảnh tạm, tên trong word/media, content type)
+        self.paragraph_count = 0
+
+    # ---------------- API giống python-docx ----------------
+    @property
+    def paragraphs(self) -> List[StreamingParagraph]:
+        """Chỉ chứa đoạn cuối (các đoạn trước đã được ghi ra file)"""
+        return [self._current] if self._current is not None else []
+
+    def add_paragraph(self, text: Optional[str] = None, style=None) -> StreamingParagraph:
+        self._flush_current()
+        self._current = StreamingParagraph(self, style)
+        if text:
+            self._current.add_run(text)
+        return self._current
+
+    def add_heading(self, text: str = "", level: int = 1) -> StreamingParagraph:
+        style_id = "Title" if level == 0 else f"Heading{level}"
+        return self.add_paragraph(text, style_id)
+
+    def add_picture(self, image_stream, width: Optional[int] = None, height: Optional[int] = None):
+        image_bytes = image_stream.read() if hasattr(image_stream, "read") else bytes(image_stream)
+        ext, content_type, px_w, px_h = _image_info(image_bytes)
+
+        # Tính kích thước EMU giống python-docx: giữ tỉ lệ khi chỉ có width hoặc height
+        native_w = px_w * _EMU_PER_INCH // _DEFAULT_DPI if px_w else 4 * _EMU_PER_INCH
+        native_h = px_h * _EMU_PER_INCH // _DEFAULT_DPI if px_h else native_w
+        if width and not height:
+            height = int(native_h * width / native_w)
+        elif height and not width:
+            width = int(native_w * height / native_h)
+        width, height = int(width or native_w), int(height or native_h)
+
+        index = len(self._images) + 1
+        rel_id = f"rIdStreamImg{index}"
+        media_name = f"image{index}.{ext}"
+        image_path = os.path.join(self._tmpdir.name, media_name)
+        with open(image_path, "wb") as f:
+            f.write(image_bytes)
+        self._images.append((rel_id, image_path, media_name, content_type))
+
+        paragraph = self.add_paragraph()
+        paragraph._add_raw(self._inline_picture_xml(rel_id, index, media_name, width, height))
+        return paragraph
+
+    def save(self, path: str):
+        """Ghép template + document.xml + ảnh thành file .docx (có thể gọi lại khi retry)"""
+        self._flush_current()
+        self._body.flush()
+
+        with zipfile.ZipFile(self.template_path, "r") as template:
+            document_xml = template.read("word/document.xml").decode("utf-8")
+            prefix, suffix = self._split_template_body(document_xml)
+
+            with zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED) as out:
+                for info in template.infolist():
+                    name = info.filename
+                    if name == "word/document.xml":
+                        continue
+                    data = template.read(name)
+                    if name == "[Content_Types].xml":
+                        data = self._patch_content_types(data.decode("utf-8")).encode("utf-8")
+                    elif name == "word/_rels/document.xml.rels":
+                        data = self._patch_relationships(data.decode("utf-8")).encode("utf-8")
+                    out.writestr(info, data)
+
+                # document.xml: copy theo khối từ file tạm, không nạp cả body vào RAM
+                with out.open("word/document.xml", "w") as dst, open(self._body_path, "rb") as body:
+                    dst.write(prefix.encode("utf-8"))
+                    shutil.copyfileobj(body, dst, _BODY_COPY_CHUNK)
+                    dst.write(suffix.encode("utf-8"))
+
+                # Ảnh ghi sau document.xml (zipfile chỉ mở được một entry ghi tại một thời điểm)
+                for _, image_path, media_name, _ in self._images:
+                    out.write(image_path, f"word/media/{media_name}", zipfile.ZIP_STORED)
+
+    def close(self):
+        if not self._body.closed:
+            self._body.close()
+        self._tmpdir.cleanup()
+
+    # ---------------- Nội bộ ----------------
+    def _flush_current(self):
+        if self._current is None:
+            return
+        self._body.write(self._current.to_xml())
+        self._current._flushed = True
+        self._current = None
+        self.paragraph_count += 1
+
+    @staticmethod
+    def _split_template_body(document_xml: str):
+        """Tách document.xml của template thành phần trước/sau nội dung (giữ nguyên sectPr)"""
+        body_open = re.search(r"<w:body\s*>", document_xml)
+        if not body_open:
+            raise ValueError("Template không có <w:body>")
+        start = body_open.end()
+        sect = document_xml.rfind("<w:sectPr")
+        end = sect if sect != -1 else document_xml.rfind("</w:body>")
+        return document_xml[:start], document_xml[end:]
+
+    def _patch_content_types(self, xml: str) -> str:
+        additions = []
+        for ext, content_type in sorted({(m.rsplit(".", 1)[1], ct) for _, _, m, ct in self._images}):
+            if f'Extension="{ext}"' not in xml:
+                additions.append(f'<Default Extension="{ext}" ContentType="{content_type}"/>')
+        return xml.replace("</Types>", "".join(additions) + "</Types>", 1)
+
+    def _patch_relationships(self, xml: str) -> str:
+        rels = "".join(
+            f'<Relationship Id="{rel_id}" Type="{_IMAGE_REL}" Target="media/{media_name}"/>'
+            for rel_id, _, media_name, _ in self._images
+        )
+        return xml.replace("</Relationships>", rels + "</Relationships>", 1)
+
+    @staticmethod
+    def _inline_picture_xml(rel_id: str, index: int, name: str, cx: int, cy: int) -> str:
+        return (
+            '<w:r><w:drawing>'
+            '<wp:inline xmlns:wp="http://schemas.openxmlformats.org/drawingml/2006/wordprocessingDrawing">'
+            f'<wp:extent cx="{cx}" cy="{cy}"/>'
+            f'<wp:docPr id="{index}" name="Picture {index}"/>'
+            '<wp:cNvGraphicFramePr>'
+            '<a:graphicFrameLocks xmlns:a="http://schemas.openxmlformats.org/drawingml/2006/main" noChangeAspect="1"/>'
+            '</wp:cNvGraphicFramePr>'
+            '<a:graphic xmlns:a="http://schemas.openxmlformats.org/drawingml/2006/main">'
+            '<a:graphicData uri="http://schemas.openxmlformats.org/drawingml/2006/picture">'
+            '<pic:pic xmlns:pic="http://schemas.openxmlformats.org/drawingml/2006/picture">'
+            f'<pic:nvPicPr><pic:cNvPr id="{index}" name="{name}"/><pic:cNvPicPr/></pic:nvPicPr>'
+            f'<pic:blipFill><a:blip xmlns:r="{_R_NS}" r:embed="{rel_id}"/>'
+            '<a:stretch><a:fillRect/></a:stretch></pic:blipFill>'
+            f'<pic:spPr><a:xfrm><a:off x="0" y="0"/><a:ext cx="{cx}" cy="{cy}"/></a:xfrm>'
+            '<a:prstGeom prst="rect"/></pic:spPr>'
+            '</pic:pic></a:graphicData></a:graphic></wp:inline>'
+            '</w:drawing></w:r>'
+        )
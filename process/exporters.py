@@ -0,0 +1,450 @@
+import argparse
+import html
+import json
+import os
+import re
+import sys
+import uuid
+import zipfile
+from typing import Dict, Iterable, List, Optional
+
+# Cho phép chạy trực tiếp: python process/exporters.py ...
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# ============================================================
+# XUẤT ĐỀ RA NHIỀU ĐỊNH DẠNG (MOODLE XML, QTI, MARKDOWN, JSON)
+# ============================================================
+#
+# Mỗi file DOCX được lưu kèm <tên>.questions.json (JSON chuẩn hóa từ dict đã parse).
+# Từ file này có thể xuất lại sang mọi định dạng mà không cần gọi lại AI:
+#   python -m process.exporters --formats moodle,qti,md output/Bai1/Bai1_TN.questions.json
+#   python -m process.exporters output/        (mọi định dạng, quét cả thư mục)
+# Các exporter ghi từng câu ra file ngay khi xử lý xong (streaming), ghi file tạm rồi os.replace.
+
+CANONICAL_SUFFIX = ".questions.json"
+CANONICAL_VERSION = 1
+
+
+def canonical_json_path_for(docx_path: str) -> str:
+    return os.path.splitext(docx_path)[0] + CANONICAL_SUFFIX
+
+
+def _export_base(canonical_path: str) -> str:
+    if canonical_path.endswith(CANONICAL_SUFFIX):
+        return canonical_path[:-len(CANONICAL_SUFFIX)]
+    return os.path.splitext(canonical_path)[0]
+
+
+def _tokens(text) -> List[tuple]:
+    from process.response2docx import tokenize_latex_text
+    return tokenize_latex_text(str(text)) if text else []
+
+
+def _strip_math_delimiters(part: str) -> str:
+    if part.startswith("\\[") and part.endswith("\\]"):
+        return part[2:-2].strip()
+    return part.strip("$").strip()
+
+
+def _text_html(text) -> str:
+    """Text + LaTeX -> HTML dùng cho Moodle/QTI (công thức dạng \\( ... \\) cho MathJax)"""
+    parts = []
+    for is_math, part in _tokens(text):
+        if is_math:
+            parts.append(html.escape(f"\\({_strip_math_delimiters(part)}\\)"))
+        else:
+            parts.append(html.escape(part).replace("\n", "<br/>"))
+    return "".join(parts)
+
+
+def _text_plain(text) -> str:
+    return "".join(part for _, part in _tokens(text))
+
+
+def _short_answer(cau: Dict) -> str:
+    raw_ans = str(cau.get("dap_an", "")).strip()
+    if raw_ans.startswith("[[") and raw_ans.endswith("]]"):
+        raw_ans = raw_ans[2:-2].strip()
+    return raw_ans
+
+
+def _correct_index(cau: Dict) -> Optional[int]:
+    """dap_an_dung là số thứ tự 1-4 hoặc ký hiệu A-D -> chỉ số trong dap_an"""
+    value = cau.get("dap_an_dung")
+    dap_an = cau.get("dap_an") or []
+    if isinstance(value, int) and 1 <= value <= len(dap_an):
+        return value - 1
+    value = str(value or "").strip().upper()
+    if value.isdigit() and 1 <= int(value) <= len(dap_an):
+        return int(value) - 1
+    for index, item in enumerate(dap_an):
+        if str(item.get("ky_hieu", "")).strip().upper() == value:
+            return index
+    return None
+
+
+def _explanation_text(cau: Dict) -> str:
+    giai_thich = cau.get("giai_thich", "")
+    if isinstance(giai_thich, list):
+        return "\n".join(
+            f"{gt.get('y', '')}) {gt.get('ket_luan', '')}: {gt.get('giai_thich', '')}"
+            for gt in giai_thich if isinstance(gt, dict)
+        )
+    return str(giai_thich or "")
+
+
+def _statement_is_true(cau: Dict, index: int, y: Dict) -> bool:
+    if "dung" in y:
+        return bool(y["dung"])
+    code = str(cau.get("dap_an_dung_sai", ""))
+    return index < len(code) and code[index] == "1"
+
+
+def _question_stem(cau: Dict, loai_de: str) -> str:
+    if loai_de == "dung_sai":
+        return str(cau.get("doan_thong_tin", ""))
+    parts = [str(cau.get("noi_dung", ""))]
+    if cau.get("trich_dan"):
+        parts.append(f"{cau['trich_dan']} {cau.get('nguon_trich_dan', '')}".strip())
+    return "\n".join(parts)
+
+
+# ============================================================
+# EXPORTER CƠ SỞ + ĐĂNG KÝ
+# ============================================================
+
+EXPORTERS: Dict[str, type] = {}
+
+
+def register_exporter(cls):
+    """Decorator đăng ký exporter theo tên định dạng (thêm định dạng mới không cần sửa chỗ khác)"""
+    EXPORTERS[cls.format_name] = cls
+    return cls
+
+
+class Exporter:
+    """Ghi streaming: begin -> write_question (từng câu) -> end"""
+    format_name = ""
+    extension = ""
+    binary = False
+
+    def __init__(self, stream, meta: Dict):
+        self.stream = stream
+        self.meta = meta
+        self.loai_de = meta.get("loai_de", "")
+        self.count = 0
+
+    def begin(self):
+        pass
+
+    def write_question(self, cau: Dict):
+        raise NotImplementedError
+
+    def end(self):
+        pass
+
+
+@register_exporter
+class JsonExporter(Exporter):
+    """JSON chuẩn hóa (cùng cấu trúc với file .questions.json)"""
+    format_name = "json"
+    extension = ".json"
+
+    def begin(self):
+        header = {k: v for k, v in self.meta.items() if k != "cau_hoi"}
+        header.setdefault("version", CANONICAL_VERSION)
+        head = json.dumps(header, ensure_ascii=False)
+        # Mở object header rồi ghi mảng cau_hoi từng phần tử một
+        self.stream.write(head[:-1] + (", " if len(header) else "") + '"cau_hoi": [\n')
+
+    def write_question(self, cau: Dict):
+        if self.count:
+            self.stream.write(",\n")
+        self.stream.write(json.dumps(cau, ensure_ascii=False))
+        self.count += 1
+
+    def end(self):
+        self.stream.write("\n]}\n")
+
+
+@register_exporter
+class MarkdownExporter(Exporter):
+    format_name = "md"
+    extension = ".md"
+
+    def begin(self):
+        self.stream.write(f"# ĐỀ {self.loai_de.upper()}\n\n")
+
+    def write_question(self, cau: Dict):
+        w = self.stream.write
+        w(f"**Câu {cau.get('stt', '')}.** {_text_plain(_question_stem(cau, self.loai_de))}\n\n")
+        hinh_anh = cau.get("hinh_anh") or {}
+        if hinh_anh.get("co_hinh"):
+            w(f"> 🖼️ Hình: {hinh_anh.get('mo_ta', '')}\n\n")
+
+        if self.loai_de == "dung_sai":
+            for y in cau.get("cac_y", []):
+                w(f"- {y.get('ky_hieu', '')}) {_text_plain(y.get('noi_dung', ''))}\n")
+            w(f"\n**Đáp án:** {cau.get('dap_an_dung_sai', '')}\n\n")
+        elif self.loai_de == "tra_loi_ngan":
+            w(f"**Đáp án:** {_text_plain(_short_answer(cau))}\n\n")
+        else:
+            correct = _correct_index(cau)
+            for index, dap_an in enumerate(cau.get("dap_an", [])):
+                mark = " ✅" if index == correct else ""
+                w(f"- {dap_an.get('ky_hieu', '')}. {_text_plain(dap_an.get('noi_dung', ''))}{mark}\n")
+            w("\n")
+
+        explanation = _text_plain(_explanation_text(cau)).strip()
+        if explanation:
+            w("<details><summary>Lời giải</summary>\n\n" + explanation.replace("\n", "\n\n") + "\n\n</details>\n\n")
+        w("---\n\n")
+        self.count += 1
+
+
+@register_exporter
+class MoodleXmlExporter(Exporter):
+    """
+    Moodle XML: TN -> multichoice, TLN -> shortanswer,
+    Đúng/Sai -> mỗi ý một câu truefalse (Moodle không có dạng 4 ý đúng/sai).
+    """
+    format_name = "moodle"
+    extension = ".moodle.xml"
+
+    def begin(self):
+        category = html.escape(self.meta.get("category") or self.meta.get("loai_de", "GenQues"))
+        self.stream.write('<?xml version="1.0" encoding="UTF-8"?>\n<quiz>\n')
+        self.stream.write(
+            f'<question type="category"><category><text>$course$/{category}</text></category></question>\n'
+        )
+
+    @staticmethod
+    def _text(tag: str, content: str, fmt: str = "html") -> str:
+        return f'<{tag} format="{fmt}"><text><![CDATA[{content.replace("]]>", "]]]]><![CDATA[>")}]]></text></{tag}>'
+
+    def _header(self, qtype: str, name: str, stem_html: str, feedback: str) -> str:
+        return (
+            f'<question type="{qtype}"><name><text>{html.escape(name)}</text></name>'
+            + self._text("questiontext", stem_html)
+            + self._text("generalfeedback", _text_html(feedback))
+            + "<defaultgrade>1</defaultgrade>"
+        )
+
+    def write_question(self, cau: Dict):
+        stt = cau.get("stt", "")
+        stem = _text_html(_question_stem(cau, self.loai_de))
+        feedback = _explanation_text(cau)
+        out = []
+
+        if self.loai_de == "dung_sai":
+            for index, y in enumerate(cau.get("cac_y", [])):
+                is_true = _statement_is_true(cau, index, y)
+                statement = f"{stem}<p>{html.escape(str(y.get('ky_hieu', '')))}) {_text_html(y.get('noi_dung', ''))}</p>"
+                out.append(self._header("truefalse", f"Câu {stt} {y.get('ky_hieu', '')})", statement, feedback))
+                out.append(f'<answer fraction="{100 if is_true else 0}"><text>true</text></answer>')
+                out.append(f'<answer fraction="{0 if is_true else 100}"><text>false</text></answer>')
+                out.append("</question>\n")
+        elif self.loai_de == "tra_loi_ngan":
+            out.append(self._header("shortanswer", f"Câu {stt}", stem, feedback))
+            out.append("<usecase>0</usecase>")
+            out.append(f'<answer fraction="100" format="moodle_auto_format"><text>{html.escape(_short_answer(cau))}</text></answer>')
+            out.append("</question>\n")
+        else:
+            correct = _correct_index(cau)
+            out.append(self._header("multichoice", f"Câu {stt}", stem, feedback))
+            out.append("<single>true</single><shuffleanswers>0</shuffleanswers><answernumbering>ABCD</answernumbering>")
+            for index, dap_an in enumerate(cau.get("dap_an", [])):
+                fraction = 100 if index == correct else 0
+                out.append(f'<answer fraction="{fraction}" format="html">'
+                           f'<text><![CDATA[{_text_html(dap_an.get("noi_dung", ""))}]]></text></answer>')
+            out.append("</question>\n")
+
+        self.stream.write("".join(out))
+        self.count += 1
+
+    def end(self):
+        self.stream.write("</quiz>\n")
+
+
+@register_exporter
+class QtiExporter(Exporter):
+    """
+    Gói IMS QTI 2.1 (.zip): mỗi câu một assessmentItem, imsmanifest.xml ghi cuối cùng.
+    Đúng/Sai -> mỗi ý một item chọn Đúng/Sai.
+    """
+    format_name = "qti"
+    extension = ".qti.zip"
+    binary = True
+
+    _NS = ('xmlns="http://www.imsglobal.org/xsd/imsqti_v2p1" '
+           'xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" '
+           'xsi:schemaLocation="http://www.imsglobal.org/xsd/imsqti_v2p1 '
+           'http://www.imsglobal.org/xsd/qti/qtiv2p1/imsqti_v2p1.xsd"')
+
+    def begin(self):
+        self.zip = zipfile.ZipFile(self.stream, "w", zipfile.ZIP_DEFLATED)
+        self.item_files: List[str] = []
+
+    def _write_item(self, identifier: str, title: str, body: str, response_decl: str, template: str):
+        xml = (
+            '<?xml version="1.0" encoding="UTF-8"?>\n'
+            f'<assessmentItem {self._NS} identifier="{identifier}" title="{html.escape(title)}" '
+            'adaptive="false" timeDependent="false">'
+            f"{response_decl}"
+            '<outcomeDeclaration identifier="SCORE" cardinality="single" baseType="float"/>'
+            f"<itemBody>{body}</itemBody>"
+            f'<responseProcessing template="http://www.imsglobal.org/question/qti_v2p1/rptemplates/{template}"/>'
+            "</assessmentItem>\n"
+        )
+        file_name = f"items/{identifier}.xml"
+        self.zip.writestr(file_name, xml)
+        self.item_files.append(file_name)
+
+    @staticmethod
+    def _choice_decl(correct_id: Optional[str]) -> str:
+        correct = f"<correctResponse><value>{correct_id}</value></correctResponse>" if correct_id else ""
+        return f'<responseDeclaration identifier="RESPONSE" cardinality="single" baseType="identifier">{correct}</responseDeclaration>'
+
+    def write_question(self, cau: Dict):
+        stt = cau.get("stt", self.count + 1)
+        stem = f"<div>{_text_html(_question_stem(cau, self.loai_de))}</div>"
+
+        if self.loai_de == "dung_sai":
+            for index, y in enumerate(cau.get("cac_y", [])):
+                is_true = _statement_is_true(cau, index, y)
+                ky_hieu = re.sub(r"\W", "", str(y.get("ky_hieu", index))) or str(index)
+                body = (f"{stem}<p>{_text_html(y.get('noi_dung', ''))}</p>"
+                        '<choiceInteraction responseIdentifier="RESPONSE" shuffle="false" maxChoices="1">'
+                        '<simpleChoice identifier="TRUE">Đúng</simpleChoice>'
+                        '<simpleChoice identifier="FALSE">Sai</simpleChoice></choiceInteraction>')
+                self._write_item(f"Q{stt}_{ky_hieu}", f"Câu {stt} {ky_hieu})", body,
+                                 self._choice_decl("TRUE" if is_true else "FALSE"), "match_correct")
+        elif self.loai_de == "tra_loi_ngan":
+            decl = ('<responseDeclaration identifier="RESPONSE" cardinality="single" baseType="string">'
+                    f"<correctResponse><value>{html.escape(_short_answer(cau))}</value></correctResponse>"
+                    "</responseDeclaration>")
+            body = f'{stem}<p><textEntryInteraction responseIdentifier="RESPONSE" expectedLength="20"/></p>'
+            self._write_item(f"Q{stt}", f"Câu {stt}", body, decl, "match_correct")
+        else:
+            correct = _correct_index(cau)
+            choices = "".join(
+                f'<simpleChoice identifier="C{index}">{_text_html(dap_an.get("noi_dung", ""))}</simpleChoice>'
+                for index, dap_an in enumerate(cau.get("dap_an", []))
+            )
+            body = (f'{stem}<choiceInteraction responseIdentifier="RESPONSE" shuffle="false" maxChoices="1">'
+                    f"{choices}</choiceInteraction>")
+            self._write_item(f"Q{stt}", f"Câu {stt}", body,
+                             self._choice_decl(f"C{correct}" if correct is not None else None), "match_correct")
+        self.count += 1
+
+    def end(self):
+        resources = "".join(
+            f'<resource identifier="R{i}" type="imsqti_item_xmlv2p1" href="{name}"><file href="{name}"/></resource>'
+            for i, name in enumerate(self.item_files)
+        )
+        manifest = (
+            '<?xml version="1.0" encoding="UTF-8"?>\n'
+            f'<manifest xmlns="http://www.imsglobal.org/xsd/imscp_v1p1" identifier="M{uuid.uuid4().hex[:12]}">'
+            f"<organizations/><resources>{resources}</resources></manifest>\n"
+        )
+        self.zip.writestr("imsmanifest.xml", manifest)
+        self.zip.close()
+
+
+# ============================================================
+# API XUẤT FILE
+# ============================================================
+
+def export_questions(meta: Dict, questions: Iterable[Dict], output_path: str, fmt: str) -> int:
+    """Ghi streaming một định dạng ra output_path (file tạm + os.replace). Trả về số câu đã ghi."""
+    exporter_cls = EXPORTERS[fmt]
+    tmp_path = f"{output_path}.{uuid.uuid4().hex[:8]}.tmp"
+    try:
+        if exporter_cls.binary:
+            stream = open(tmp_path, "wb")
+        else:
+            stream = open(tmp_path, "w", encoding="utf-8", newline="\n")
+        with stream:
+            exporter = exporter_cls(stream, meta)
+            exporter.begin()
+            for cau in questions:
+                exporter.write_question(cau)
+            exporter.end()
+        os.replace(tmp_path, output_path)
+        return exporter.count
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+
+
+def write_canonical_json(data: Dict, docx_path: str) -> Optional[str]:
+    """Lưu <tên>.questions.json cạnh file DOCX để xuất lại định dạng khác mà không gọi AI"""
+    path = canonical_json_path_for(docx_path)
+    meta = {k: v for k, v in data.items() if k != "cau_hoi"}
+    meta["version"] = CANONICAL_VERSION
+    try:
+        export_questions(meta, data.get("cau_hoi", []), path, "json")
+        return path
+    except Exception as e:
+        print(f"⚠️ Không lưu được JSON chuẩn hóa: {e}")
+        return None
+
+
+def export_canonical_file(canonical_path: str, formats: Iterable[str]) -> List[str]:
+    """Xuất một file .questions.json ra các định dạng, đặt cạnh file nguồn"""
+    with open(canonical_path, "r", encoding="utf-8") as f:
+        data = json.load(f)
+    meta = {k: v for k, v in data.items() if k != "cau_hoi"}
+    base = _export_base(canonical_path)
+    outputs = []
+    for fmt in formats:
+        exporter_cls = EXPORTERS[fmt]
+        # Định dạng json: bản canonical đã là JSON, không ghi đè chính nó
+        output_path = base + (".export.json" if fmt == "json" else exporter_cls.extension)
+        count = export_questions(meta, data.get("cau_hoi", []), output_path, fmt)
+        print(f"📤 {os.path.basename(output_path)}: {count} câu")
+        outputs.append(output_path)
+    return outputs
+
+
+def find_canonical_files(paths: Iterable[str]) -> List[str]:
+    found = []
+    for path in paths:
+        if os.path.isdir(path):
+            for root, _, files in os.walk(path):
+                found.extend(os.path.join(root, name) for name in sorted(files) if name.endswith(CANONICAL_SUFFIX))
+        elif path.endswith(".docx"):
+            found.append(canonical_json_path_for(path))
+        else:
+            found.append(path)
+    return found
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Xuất đề GenQues sang Moodle XML / QTI / Markdown / JSON")
+    parser.add_argument("--formats", default="all",
+                        help=f"Danh sách cách nhau bởi dấu phẩy: {','.join(EXPORTERS)} hoặc all")
+    parser.add_argument("paths", nargs="+", help="File .questions.json, file .docx hoặc thư mục output")
+    args = parser.parse_args(argv)
+
+    formats = [f.strip() for f in args.formats.split(",") if f.strip()]
+    if "all" in formats:
+        formats = list(EXPORTERS)
+    unknown = [f for f in formats if f not in EXPORTERS]
+    if unknown:
+        parser.error(f"Định dạng không hỗ trợ: {', '.join(unknown)}")
+    failed = 0
+    for canonical_path in find_canonical_files(args.paths):
+        try:
+            export_canonical_file(canonical_path, formats)
+        except (OSError, ValueError, KeyError) as e:
+            failed += 1
+            print(f"❌ {canonical_path}: {e}")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,600 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, List, Optional
+
+# ============================================================
+# HÀNG ĐỢI CÔNG VIỆC BỀN VỮNG (SQLITE)
+# ============================================================
+
+# Thứ tự ưu tiên theo dạng đề: TN ra kết quả trước, TLN sau cùng
+TASK_TYPE_PRIORITY = {"TN": 0, "DS": 1, "TLN": 2}
+
+STATE_PENDING = "pending"
+STATE_LEASED = "leased"
+STATE_COMMITTING = "committing"
+STATE_DONE = "done"
+STATE_DEAD = "dead"
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    job_key TEXT NOT NULL,
+    batch_id TEXT,
+    task_type TEXT NOT NULL,
+    output_name TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    priority INTEGER NOT NULL DEFAULT 0,
+    size_hint INTEGER NOT NULL DEFAULT 0,
+    state TEXT NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    max_attempts INTEGER NOT NULL DEFAULT 3,
+    available_at REAL NOT NULL DEFAULT 0,
+    lease_owner TEXT,
+    lease_expires REAL,
+    result TEXT,
+    result_stamp TEXT,
+    last_error TEXT,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_jobs_ready ON jobs (state, priority, size_hint, id);
+CREATE INDEX IF NOT EXISTS idx_jobs_key ON jobs (job_key, state);
+CREATE TABLE IF NOT EXISTS workers (
+    worker_id TEXT PRIMARY KEY,
+    info TEXT,
+    last_seen REAL NOT NULL
+);
+"""
+
+
+def output_stamp(path: Optional[str]) -> Optional[str]:
+    """
+    Dấu nhận diện file output: kích thước + mtime (ns). os.replace giữ nguyên mtime của file staging,
+    nên sau khi worker chết giữa lúc commit, file cùng dấu = đúng file của lần commit đó
+    (file cũ của lần chạy trước cùng tên nhóm thì khác dấu). None nếu không có file.
+    """
+    try:
+        st = os.stat(path)
+    except (OSError, TypeError):
+        return None
+    return f"{st.st_size}:{st.st_mtime_ns}"
+
+
+def owner_is_live(owner: Optional[str], live_workers: Dict) -> bool:
+    """Owner của lease là một node đang sống (hoặc một luồng "<node>-<slot>" của node đó)"""
+    if not owner:
+        return False
+    return any(owner == worker_id or owner.startswith(f"{worker_id}-") for worker_id in live_workers)
+
+
+def task_priority(task_type: str) -> int:
+    """Độ ưu tiên của dạng đề (số nhỏ chạy trước)"""
+    return TASK_TYPE_PRIORITY.get(task_type, len(TASK_TYPE_PRIORITY))
+
+
+def estimate_group_size(pdf_files) -> int:
+    """Tổng dung lượng PDF của nhóm - nhóm nhỏ chạy trước để có kết quả sớm"""
+    total = 0
+    for path in pdf_files or []:
+        try:
+            total += os.path.getsize(path)
+        except OSError:
+            pass
+    return total
+
+
+class Job:
+    """Một công việc đã được lease từ hàng đợi"""
+    def __init__(self, row: sqlite3.Row):
+        self.id = row["id"]
+        self.job_key = row["job_key"]
+        self.batch_id = row["batch_id"]
+        self.task_type = row["task_type"]
+        self.output_name = row["output_name"]
+        self.payload = json.loads(row["payload"])
+        self.priority = row["priority"]
+        self.state = row["state"]
+        self.attempts = row["attempts"]
+        self.max_attempts = row["max_attempts"]
+        self.lease_owner = row["lease_owner"]
+        self.lease_expires = row["lease_expires"]
+        self.result = row["result"]
+        self.last_error = row["last_error"]
+
+    def __repr__(self):
+        return f"Job(id={self.id}, key={self.job_key!r}, state={self.state}, attempts={self.attempts})"
+
+
+class JobQueue:
+    """
+    Hàng đợi ưu tiên lưu trên SQLite, sống sót qua việc đóng cửa sổ.
+    - Ưu tiên: dạng đề (TN > DS > TLN), rồi nhóm nhỏ trước, rồi thứ tự thêm vào.
+    - Lease + visibility timeout: job bị giữ quá hạn sẽ tự quay lại hàng đợi.
+    - Dead-letter: job lỗi quá max_attempts lần chuyển sang trạng thái 'dead'.
+    - Commit: leased -> committing -> done, chỉ worker còn giữ lease mới commit được
+      (đảm bảo mỗi job chỉ ghi output đúng một lần dù có nhiều worker).
+    """
+
+    def __init__(self, db_path: str, visibility_timeout: float = 1800, max_attempts: int = 3,
+                 retry_delay: float = 30):
+        self.db_path = db_path
+        self.visibility_timeout = visibility_timeout
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self._local = threading.local()
+
+        folder = os.path.dirname(os.path.abspath(db_path))
+        os.makedirs(folder, exist_ok=True)
+
+        conn = self._conn()
+        conn.executescript(_SCHEMA)
+        # DB tạo từ bản cũ chưa có cột result_stamp
+        columns = {row["name"] for row in conn.execute("PRAGMA table_info(jobs)")}
+        if "result_stamp" not in columns:
+            conn.execute("ALTER TABLE jobs ADD COLUMN result_stamp TEXT")
+
+    # ---------------- Kết nối ----------------
+    def _conn(self) -> sqlite3.Connection:
+        """Mỗi luồng dùng một connection riêng (sqlite3 không chia sẻ được giữa các luồng)"""
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    @contextmanager
+    def _transaction(self):
+        """BEGIN IMMEDIATE để lease nguyên tử giữa nhiều luồng/tiến trình"""
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def close(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+
+    # ---------------- Producer ----------------
+    def enqueue(self, task_type: str, output_name: str, payload: Dict, batch_id: Optional[str] = None,
+                priority: Optional[int] = None, size_hint: int = 0,
+                max_attempts: Optional[int] = None) -> int:
+        """
+        Thêm job vào hàng đợi. Nếu đã có job cùng (output_name, task_type) và cùng payload đang
+        chờ/đang chạy thì trả về id của job đó thay vì tạo trùng. Payload khác (sửa prompt, đổi
+        khoảng trang...) -> job đang chờ được cập nhật payload mới (tính lại lượt thử); job cùng
+        key chỉ đang chạy với payload cũ -> thêm job mới để chạy lại sau nó.
+        """
+        job_key = f"{output_name}:{task_type}"
+        now = time.time()
+        if priority is None:
+            priority = task_priority(task_type)
+        if max_attempts is None:
+            max_attempts = self.max_attempts
+        payload_json = json.dumps(payload, ensure_ascii=False)
+        # So sánh sau khi qua JSON (tuple -> list...) để không coi là khác chỉ vì kiểu
+        normalized = json.loads(payload_json)
+
+        with self._transaction() as conn:
+            rows = conn.execute(
+                "SELECT id, state, payload FROM jobs WHERE job_key = ? AND state IN (?, ?) ORDER BY id",
+                (job_key, STATE_PENDING, STATE_LEASED)
+            ).fetchall()
+            for row in rows:
+                if json.loads(row["payload"]) == normalized:
+                    return row["id"]
+
+            pending = next((row for row in rows if row["state"] == STATE_PENDING), None)
+            if pending is not None:
+                conn.execute(
+                    "UPDATE jobs SET batch_id = ?, payload = ?, priority = ?, size_hint = ?, attempts = 0, "
+                    "max_attempts = ?, available_at = ?, last_error = NULL, updated_at = ? WHERE id = ?",
+                    (batch_id, payload_json, priority, size_hint, max_attempts, now, now, pending["id"])
+                )
+                return pending["id"]
+
+            cur = conn.execute(
+                """INSERT INTO jobs (job_key, batch_id, task_type, output_name, payload, priority,
+                                     size_hint, state, attempts, max_attempts, available_at,
+                                     created_at, updated_at)
+                   VALUES (?, ?, ?, ?, ?, ?, ?, ?, 0, ?, ?, ?, ?)""",
+                (job_key, batch_id, task_type, output_name,
+                 payload_json, priority, size_hint,
+                 STATE_PENDING, max_attempts, now, now, now)
+            )
+            return cur.lastrowid
+
+    # ---------------- Consumer ----------------
+    def lease(self, owner: str, visibility_timeout: Optional[float] = None) -> Optional[Job]:
+        """
+        Lấy job ưu tiên cao nhất đang sẵn sàng (hoặc job có lease đã hết hạn).
+        Trả về None nếu hiện không có job nào.
+        """
+        timeout = visibility_timeout or self.visibility_timeout
+
+        with self._transaction() as conn:
+            while True:
+                now = time.time()
+                row = conn.execute(
+                    """SELECT * FROM jobs
+                       WHERE (state = ? AND available_at <= ?)
+                          OR (state = ? AND lease_expires <= ?)
+                       ORDER BY priority, size_hint, id
+                       LIMIT 1""",
+                    (STATE_PENDING, now, STATE_LEASED, now)
+                ).fetchone()
+                if row is None:
+                    self._recover_stale_commits(conn, now)
+                    return None
+
+                # Lease hết hạn mà đã dùng hết lượt thử -> dead-letter
+                if row["state"] == STATE_LEASED and row["attempts"] >= row["max_attempts"]:
+                    conn.execute(
+                        "UPDATE jobs SET state = ?, lease_owner = NULL, lease_expires = NULL, "
+                        "last_error = ?, updated_at = ? WHERE id = ?",
+                        (STATE_DEAD, "Lease hết hạn (worker không phản hồi)", now, row["id"])
+                    )
+                    continue
+
+                conn.execute(
+                    "UPDATE jobs SET state = ?, lease_owner = ?, lease_expires = ?, "
+                    "attempts = attempts + 1, updated_at = ? WHERE id = ?",
+                    (STATE_LEASED, owner, now + timeout, now, row["id"])
+                )
+                leased = conn.execute("SELECT * FROM jobs WHERE id = ?", (row["id"],)).fetchone()
+                return Job(leased)
+
+    def heartbeat(self, job_id: int, owner: str, visibility_timeout: Optional[float] = None) -> bool:
+        """Gia hạn lease. Trả về False nếu job không còn thuộc về owner này."""
+        timeout = visibility_timeout or self.visibility_timeout
+        now = time.time()
+        with self._transaction() as conn:
+            cur = conn.execute(
+                "UPDATE jobs SET lease_expires = ?, updated_at = ? "
+                "WHERE id = ? AND state = ? AND lease_owner = ?",
+                (now + timeout, now, job_id, STATE_LEASED, owner)
+            )
+            return cur.rowcount == 1
+
+    def heartbeat_many(self, job_ids: List[int], owner: str,
+                       visibility_timeout: Optional[float] = None) -> List[int]:
+        """Gia hạn lease của nhiều job trong một transaction. Trả về các job owner vẫn còn giữ."""
+        job_ids = list(job_ids)
+        if not job_ids:
+            return []
+        timeout = visibility_timeout or self.visibility_timeout
+        now = time.time()
+        marks = ",".join("?" * len(job_ids))
+        with self._transaction() as conn:
+            conn.execute(
+                f"UPDATE jobs SET lease_expires = ?, updated_at = ? "
+                f"WHERE id IN ({marks}) AND state = ? AND lease_owner = ?",
+                (now + timeout, now, *job_ids, STATE_LEASED, owner)
+            )
+            rows = conn.execute(
+                f"SELECT id FROM jobs WHERE id IN ({marks}) AND state = ? AND lease_owner = ?",
+                (*job_ids, STATE_LEASED, owner)
+            ).fetchall()
+            return [row["id"] for row in rows]
+
+    def begin_commit(self, job_id: int, owner: str, result: str, staged_path: Optional[str] = None) -> bool:
+        """
+        Điểm tuyến tính hóa của việc ghi output: chỉ thành công nếu owner vẫn giữ lease.
+        Sau khi trả về True, worker được phép đưa file staged_path vào vị trí cuối (result)
+        rồi gọi complete(). Dấu của staged_path được lưu để khôi phục commit dở dang.
+        """
+        now = time.time()
+        with self._transaction() as conn:
+            cur = conn.execute(
+                "UPDATE jobs SET state = ?, result = ?, result_stamp = ?, lease_expires = ?, updated_at = ? "
+                "WHERE id = ? AND state = ? AND lease_owner = ?",
+                (STATE_COMMITTING, result, output_stamp(staged_path), now + self.visibility_timeout, now,
+                 job_id, STATE_LEASED, owner)
+            )
+            return cur.rowcount == 1
+
+    def complete(self, job_id: int, owner: str, result: Optional[str] = None) -> bool:
+        """Đánh dấu job hoàn thành"""
+        now = time.time()
+        with self._transaction() as conn:
+            cur = conn.execute(
+                "UPDATE jobs SET state = ?, result = COALESCE(?, result), lease_owner = NULL, "
+                "lease_expires = NULL, updated_at = ? "
+                "WHERE id = ? AND state IN (?, ?) AND lease_owner = ?",
+                (STATE_DONE, result, now, job_id, STATE_LEASED, STATE_COMMITTING, owner)
+            )
+            return cur.rowcount == 1
+
+    def _recover_stale_commits(self, conn, now):
+        """
+        Worker chết giữa lúc commit: file output đúng là file của commit này (cùng dấu) -> done,
+        chưa có / là file cũ của lần chạy trước -> chạy lại
+        """
+        rows = conn.execute(
+            "SELECT id, result, result_stamp FROM jobs WHERE state = ? AND lease_expires <= ?",
+            (STATE_COMMITTING, now)
+        ).fetchall()
+        for row in rows:
+            finished = bool(row["result_stamp"]) and output_stamp(row["result"]) == row["result_stamp"]
+            conn.execute(
+                "UPDATE jobs SET state = ?, lease_owner = NULL, lease_expires = NULL, available_at = ?, "
+                "updated_at = ? WHERE id = ?",
+                (STATE_DONE if finished else STATE_PENDING, now, now, row["id"])
+            )
+
+    def fail(self, job_id: int, owner: str, error: str) -> str:
+        """
+        Ghi nhận job lỗi. Còn lượt thử -> quay lại 'pending' (backoff tăng dần),
+        hết lượt -> 'dead'. Trả về trạng thái mới.
+        Nhận cả job 'committing' của chính owner (lỗi khi đưa file vào vị trí cuối, VD file đang mở
+        trong Word) để job không nằm chờ hết visibility timeout.
+        """
+        now = time.time()
+        with self._transaction() as conn:
+            row = conn.execute(
+                "SELECT attempts, max_attempts FROM jobs WHERE id = ? AND state IN (?, ?) AND lease_owner = ?",
+                (job_id, STATE_LEASED, STATE_COMMITTING, owner)
+            ).fetchone()
+            if row is None:
+                return ""
+
+            if row["attempts"] >= row["max_attempts"]:
+                new_state = STATE_DEAD
+                available_at = now
+            else:
+                new_state = STATE_PENDING
+                available_at = now + self.retry_delay * (2 ** (row["attempts"] - 1))
+
+            conn.execute(
+                "UPDATE jobs SET state = ?, last_error = ?, available_at = ?, lease_owner = NULL, "
+                "lease_expires = NULL, updated_at = ? WHERE id = ?",
+                (new_state, str(error)[:2000], available_at, now, job_id)
+            )
+            return new_state
+
+    def release(self, job_id: int, owner: str) -> bool:
+        """Trả job về hàng đợi mà không tính là một lần thử (VD: người dùng bấm dừng)"""
+        now = time.time()
+        with self._transaction() as conn:
+            cur = conn.execute(
+                "UPDATE jobs SET state = ?, attempts = MAX(attempts - 1, 0), available_at = ?, "
+                "lease_owner = NULL, lease_expires = NULL, updated_at = ? "
+                "WHERE id = ? AND state = ? AND lease_owner = ?",
+                (STATE_PENDING, now, now, job_id, STATE_LEASED, owner)
+            )
+            return cur.rowcount == 1
+
+    # ---------------- Quản trị ----------------
+    def has_active(self) -> bool:
+        """Còn job đang chờ hoặc đang chạy không"""
+        row = self._conn().execute(
+            "SELECT 1 FROM jobs WHERE state IN (?, ?, ?) LIMIT 1",
+            (STATE_PENDING, STATE_LEASED, STATE_COMMITTING)
+        ).fetchone()
+        return row is not None
+
+    def count_active(self) -> int:
+        row = self._conn().execute(
+            "SELECT COUNT(*) AS n FROM jobs WHERE state IN (?, ?, ?)",
+            (STATE_PENDING, STATE_LEASED, STATE_COMMITTING)
+        ).fetchone()
+        return row["n"]
+
+    def stats(self) -> Dict[str, int]:
+        """Số job theo từng trạng thái"""
+        result = {STATE_PENDING: 0, STATE_LEASED: 0, STATE_COMMITTING: 0, STATE_DONE: 0, STATE_DEAD: 0}
+        for row in self._conn().execute("SELECT state, COUNT(*) AS n FROM jobs GROUP BY state"):
+            result[row["state"]] = row["n"]
+        return result
+
+    def dead_letters(self) -> List[Job]:
+        rows = self._conn().execute(
+            "SELECT * FROM jobs WHERE state = ? ORDER BY updated_at DESC", (STATE_DEAD,)
+        ).fetchall()
+        return [Job(r) for r in rows]
+
+    def requeue_dead(self, job_id: Optional[int] = None) -> int:
+        """Đưa job trong dead-letter trở lại hàng đợi (tất cả nếu job_id=None)"""
+        now = time.time()
+        with self._transaction() as conn:
+            if job_id is None:
+                cur = conn.execute(
+                    "UPDATE jobs SET state = ?, attempts = 0, available_at = ?, updated_at = ? WHERE state = ?",
+                    (STATE_PENDING, now, now, STATE_DEAD)
+                )
+            else:
+                cur = conn.execute(
+                    "UPDATE jobs SET state = ?, attempts = 0, available_at = ?, updated_at = ? "
+                    "WHERE state = ? AND id = ?",
+                    (STATE_PENDING, now, now, STATE_DEAD, job_id)
+                )
+            return cur.rowcount
+
+    def reclaim_orphaned(self, max_age: float = 120) -> int:
+        """
+        Thu hồi ngay lease của owner không còn sống (GUI bị tắt ngang, worker bị kill) thay vì chờ
+        hết visibility timeout. Owner sống = có trong live_workers() (worker "<id>-<slot>" thuộc node
+        "<id>"). leased -> pending (không tính lượt thử); committing -> done nếu output đúng là của
+        commit đó (xem output_stamp), không thì pending.
+        """
+        live = self.live_workers(max_age)
+        now = time.time()
+        count = 0
+        with self._transaction() as conn:
+            rows = conn.execute(
+                "SELECT id, state, lease_owner, result, result_stamp FROM jobs WHERE state IN (?, ?)",
+                (STATE_LEASED, STATE_COMMITTING)
+            ).fetchall()
+            for row in rows:
+                if owner_is_live(row["lease_owner"], live):
+                    continue
+                if row["state"] == STATE_COMMITTING:
+                    finished = bool(row["result_stamp"]) and output_stamp(row["result"]) == row["result_stamp"]
+                    conn.execute(
+                        "UPDATE jobs SET state = ?, lease_owner = NULL, lease_expires = NULL, available_at = ?, "
+                        "updated_at = ? WHERE id = ?",
+                        (STATE_DONE if finished else STATE_PENDING, now, now, row["id"])
+                    )
+                else:
+                    conn.execute(
+                        "UPDATE jobs SET state = ?, attempts = MAX(attempts - 1, 0), available_at = ?, "
+                        "lease_owner = NULL, lease_expires = NULL, updated_at = ? WHERE id = ?",
+                        (STATE_PENDING, now, now, row["id"])
+                    )
+                count += 1
+        return count
+
+    def discard_active(self) -> int:
+        """
+        Bỏ các job còn tồn của phiên cũ (người dùng không muốn chạy tiếp). Job đang được worker
+        còn sống giữ lease/commit thì để nguyên cho worker đó làm xong.
+        """
+        self.reclaim_orphaned()
+        with self._transaction() as conn:
+            cur = conn.execute("DELETE FROM jobs WHERE state = ?", (STATE_PENDING,))
+            return cur.rowcount
+
+    def register_worker(self, worker_id: str, info: Optional[Dict] = None):
+        """Heartbeat của worker (để theo dõi node nào còn sống)"""
+        with self._transaction() as conn:
+            conn.execute(
+                "INSERT INTO workers (worker_id, info, last_seen) VALUES (?, ?, ?) "
+                "ON CONFLICT(worker_id) DO UPDATE SET info = excluded.info, last_seen = excluded.last_seen",
+                (worker_id, json.dumps(info or {}, ensure_ascii=False), time.time())
+            )
+
+    def live_workers(self, max_age: float = 120) -> Dict[str, Dict]:
+        cutoff = time.time() - max_age
+        rows = self._conn().execute(
+            "SELECT worker_id, info, last_seen FROM workers WHERE last_seen >= ?", (cutoff,)
+        ).fetchall()
+        return {r["worker_id"]: dict(json.loads(r["info"] or "{}"), last_seen=r["last_seen"]) for r in rows}
+
+    def purge_finished(self, older_than: float = 7 * 24 * 3600) -> int:
+        """Dọn các job đã xong lâu ngày để file DB không phình to"""
+        cutoff = time.time() - older_than
+        with self._transaction() as conn:
+            cur = conn.execute(
+                "DELETE FROM jobs WHERE state = ? AND updated_at < ?", (STATE_DONE, cutoff)
+            )
+            return cur.rowcount
+
+
+class LeaseKeeper:
+    """
+    Luồng nền tự động gia hạn lease trong lúc job đang chạy (tránh bị worker khác lấy mất).
+    Dùng: with LeaseKeeper(queue, job.id, owner): ...
+    """
+
+    def __init__(self, queue, job_id, owner, interval: Optional[float] = None):
+        self.queue = queue
+        self.job_id = job_id
+        self.owner = owner
+        self.interval = interval or max(5.0, queue.visibility_timeout / 3)
+        self.lost = False
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        try:
+            while not self._stop.wait(self.interval):
+                try:
+                    if not self.queue.heartbeat(self.job_id, self.owner):
+                        self.lost = True
+                        return
+                except Exception as e:
+                    print(f"⚠️ Lỗi heartbeat job {self.job_id}: {e}")
+        finally:
+            # Đóng connection riêng của luồng heartbeat
+            self.queue.close()
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self._stop.set()
+        self._thread.join(timeout=5)
+        return False
+
+
+class SharedLeaseKeeper:
+    """
+    MỘT luồng nền gia hạn lease cho mọi job đang chạy của một owner (thay vì mỗi job một
+    LeaseKeeper). Dùng khi số job đồng thời lớn, VD pipeline asyncio giữ hàng trăm job.
+    Dùng: with SharedLeaseKeeper(queue, owner) as keeper: keeper.add(job.id) ... keeper.discard(job.id)
+    """
+
+    def __init__(self, queue, owner, interval: Optional[float] = None, node_info: Optional[Dict] = None):
+        self.queue = queue
+        self.owner = owner
+        self.interval = interval or max(5.0, queue.visibility_timeout / 3)
+        # Có node_info -> owner tự đăng ký như một node sống mỗi lượt (reclaim_orphaned không thu hồi nhầm)
+        self.node_info = node_info
+        self.lost = set()
+        self._job_ids = set()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True, name="lease-keeper")
+
+    def add(self, job_id):
+        with self._lock:
+            self._job_ids.add(job_id)
+
+    def discard(self, job_id):
+        with self._lock:
+            self._job_ids.discard(job_id)
+            self.lost.discard(job_id)
+
+    def _register(self):
+        if self.node_info is None:
+            return
+        try:
+            self.queue.register_worker(self.owner, self.node_info)
+        except Exception as e:
+            print(f"⚠️ Lỗi heartbeat {self.owner}: {e}")
+
+    def _run(self):
+        try:
+            self._register()
+            while not self._stop.wait(self.interval):
+                self._register()
+                with self._lock:
+                    job_ids = list(self._job_ids)
+                if not job_ids:
+                    continue
+                try:
+                    held = set(self.queue.heartbeat_many(job_ids, self.owner))
+                except Exception as e:
+                    print(f"⚠️ Lỗi heartbeat {len(job_ids)} job: {e}")
+                    continue
+                with self._lock:
+                    for job_id in job_ids:
+                        # Job đã xong/bị bỏ trong lúc gia hạn thì không tính là mất lease
+                        if job_id not in held and job_id in self._job_ids:
+                            self._job_ids.discard(job_id)
+                            self.lost.add(job_id)
+        finally:
+            # Đóng connection riêng của luồng heartbeat
+            self.queue.close()
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self._stop.set()
+        self._thread.join(timeout=5)
+        return False
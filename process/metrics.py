@@ -0,0 +1,204 @@
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterable, List, Optional
+
+# ============================================================
+# ĐO THỜI GIAN / BỘ ĐẾM THEO TỪNG TÁC VỤ
+# ============================================================
+#
+# Mỗi tác vụ (một file đề) có một TaskMetrics. Luồng đang xử lý tác vụ "gắn" (bind)
+# TaskMetrics đó vào thread-local, nên các chỗ nằm sâu bên trong (pandoc, sinh ảnh,
+# gọi AI) chỉ cần gọi timed("pandoc") / add_value("tokens_in", n) mà không phải
+# truyền đối tượng qua mọi hàm. Không có metrics nào được gắn -> các hàm này không làm gì.
+# Kết thúc tác vụ: ghi một dòng JSON (JSONL) và gộp vào bảng tổng kết.
+
+_local = threading.local()
+# Hàm nhận mỗi bản ghi tác vụ vừa kết thúc (VD: endpoint /metrics cộng dồn bộ đếm)
+_OBSERVERS: List[Callable[[Dict], None]] = []
+
+
+class TaskMetrics:
+    """Bộ đếm của một tác vụ: timers = {tên: [số lần, tổng giây, lâu nhất]}, values = {tên: tổng}"""
+
+    def __init__(self, label: str = "", **fields):
+        self.label = label
+        self.fields = dict(fields)
+        self.timers: Dict[str, List[float]] = {}
+        self.values: Dict[str, float] = {}
+        self.started = time.time()
+        self._lock = threading.Lock()
+
+    def add_time(self, name: str, seconds: float, count: int = 1):
+        with self._lock:
+            timer = self.timers.setdefault(name, [0, 0.0, 0.0])
+            timer[0] += count
+            timer[1] += seconds
+            timer[2] = max(timer[2], seconds)
+
+    def add_value(self, name: str, value: float = 1):
+        with self._lock:
+            self.values[name] = self.values.get(name, 0) + value
+
+    def merge(self, other: Dict):
+        """Gộp kết quả to_dict() từ nơi khác (VD: tiến trình render con)"""
+        for name, timer in other.get("timers", {}).items():
+            with self._lock:
+                mine = self.timers.setdefault(name, [0, 0.0, 0.0])
+                mine[0] += timer["count"]
+                mine[1] += timer["seconds"]
+                mine[2] = max(mine[2], timer["max"])
+        for name, value in other.get("values", {}).items():
+            self.add_value(name, value)
+
+    def to_dict(self) -> Dict:
+        with self._lock:
+            data = dict(self.fields)
+            data.update(
+                label=self.label,
+                started=round(self.started, 3),
+                wall_seconds=round(time.time() - self.started, 4),
+                timers={
+                    name: {"count": int(t[0]), "seconds": round(t[1], 4), "max": round(t[2], 4)}
+                    for name, t in self.timers.items()
+                },
+                values=dict(self.values),
+            )
+            return data
+
+
+# ---------------- Thread-local ----------------
+
+def current() -> Optional[TaskMetrics]:
+    return getattr(_local, "metrics", None)
+
+
+@contextmanager
+def bind(metrics: Optional[TaskMetrics]):
+    """Gắn metrics cho luồng hiện tại trong phạm vi with (lồng nhau được)"""
+    previous = current()
+    _local.metrics = metrics
+    try:
+        yield metrics
+    finally:
+        _local.metrics = previous
+
+
+@contextmanager
+def timed(name: str):
+    """Đo thời gian một đoạn code vào metrics đang gắn (kể cả khi đoạn đó raise)"""
+    metrics = current()
+    if metrics is None:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        metrics.add_time(name, time.perf_counter() - started)
+
+
+def add_value(name: str, value: float = 1):
+    metrics = current()
+    if metrics is not None and value:
+        metrics.add_value(name, value)
+
+
+def record_usage(response, kind: str = "generate"):
+    """
+    Lấy số token từ usage_metadata của response GenAI (nếu có).
+    Ngoài tổng tokens_in/out/thinking còn ghi calls_<kind> và tokens_<kind> (tổng 3 loại)
+    để biết phần nào tốn token: generate (sinh đề, bù câu) hay repair (sửa JSON).
+    """
+    add_value(f"calls_{kind}")
+    usage = getattr(response, "usage_metadata", None)
+    if usage is None:
+        return
+    tokens_in = getattr(usage, "prompt_token_count", 0) or 0
+    tokens_out = getattr(usage, "candidates_token_count", 0) or 0
+    tokens_thinking = getattr(usage, "thoughts_token_count", 0) or 0
+    add_value("tokens_in", tokens_in)
+    add_value("tokens_out", tokens_out)
+    add_value("tokens_thinking", tokens_thinking)
+    add_value(f"tokens_{kind}", tokens_in + tokens_out + tokens_thinking)
+
+
+# ---------------- Ghi JSONL ----------------
+
+def add_observer(fn: Callable[[Dict], None]):
+    if fn not in _OBSERVERS:
+        _OBSERVERS.append(fn)
+
+
+def remove_observer(fn: Callable[[Dict], None]):
+    if fn in _OBSERVERS:
+        _OBSERVERS.remove(fn)
+
+
+def default_metrics_path() -> str:
+    return os.getenv("METRICS_LOG") or os.path.join(os.getcwd(), "metrics.jsonl")
+
+
+class MetricsLog:
+    """Ghi mỗi tác vụ thành một dòng JSON (append, thread-safe); path rỗng = tắt ghi file"""
+
+    def __init__(self, path: Optional[str] = None):
+        self.path = default_metrics_path() if path is None else path
+        self.records: List[Dict] = []
+        self._lock = threading.Lock()
+
+    def write(self, metrics: TaskMetrics, **fields) -> Dict:
+        record = metrics.to_dict()
+        record.update(fields)
+        with self._lock:
+            self.records.append(record)
+            if self.path:
+                try:
+                    os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+                    with open(self.path, "a", encoding="utf-8") as f:
+                        f.write(json.dumps(record, ensure_ascii=False) + "\n")
+                except OSError as e:
+                    print(f"⚠️ Không ghi được metrics: {e}")
+        for observer in list(_OBSERVERS):
+            try:
+                observer(record)
+            except Exception as e:
+                print(f"⚠️ Lỗi observer metrics: {e}")
+        return record
+
+
+# ---------------- Tổng hợp ----------------
+
+def aggregate(records: Iterable[Dict]) -> Dict:
+    """Gộp nhiều bản ghi: mỗi timer -> tổng số lần / tổng giây / lâu nhất; mỗi value -> tổng"""
+    timers: Dict[str, Dict] = {}
+    values: Dict[str, float] = {}
+    tasks = 0
+    for record in records:
+        tasks += 1
+        for name, t in record.get("timers", {}).items():
+            agg = timers.setdefault(name, {"count": 0, "seconds": 0.0, "max": 0.0, "tasks": 0})
+            agg["count"] += t["count"]
+            agg["seconds"] += t["seconds"]
+            agg["max"] = max(agg["max"], t["max"])
+            agg["tasks"] += 1
+        for name, value in record.get("values", {}).items():
+            values[name] = values.get(name, 0) + value
+    return {"tasks": tasks, "timers": timers, "values": values}
+
+
+def format_summary(agg: Dict) -> str:
+    """Bảng tổng kết ngắn gọn, timer tốn nhiều thời gian nhất lên đầu"""
+    if not agg.get("tasks"):
+        return ""
+    lines = [f"⏱️ Thời gian theo công đoạn ({agg['tasks']} tác vụ):"]
+    for name, t in sorted(agg["timers"].items(), key=lambda kv: kv[1]["seconds"], reverse=True):
+        avg = t["seconds"] / t["tasks"] if t["tasks"] else 0
+        lines.append(
+            f"   • {name}: {t['seconds']:.1f}s tổng | {avg:.2f}s/tác vụ | {t['count']} lần | max {t['max']:.2f}s"
+        )
+    if agg["values"]:
+        lines.append("   • " + " | ".join(f"{k}: {int(v):,}" for k, v in sorted(agg["values"].items())))
+    return "\n".join(lines)
@@ -0,0 +1,240 @@
+import threading
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, Optional, Tuple
+
+from process.metrics import add_observer, remove_observer
+
+# ============================================================
+# ENDPOINT /metrics KIỂU PROMETHEUS (CHO WORKER CHẠY NỀN)
+# ============================================================
+#
+# Không cần thư viện prometheus_client: bộ đếm/histogram tự cài, xuất theo định dạng text
+# exposition 0.0.4 để Prometheus/Grafana hoặc curl đọc trực tiếp.
+#   python -m process.worker run ... --metrics-port 9108
+#   curl http://127.0.0.1:9108/metrics
+# Số liệu lấy từ bản ghi TaskMetrics của mỗi tác vụ (MetricsLog.write -> observer),
+# gauge (hàng đợi, số job đang chạy) được đọc tại thời điểm scrape qua callback.
+
+# Giây - model thường mất vài chục giây tới vài phút
+LATENCY_BUCKETS = (1, 2, 5, 10, 20, 30, 60, 120, 180, 300, 600)
+
+LabelKey = Tuple[Tuple[str, str], ...]
+
+
+def _labels(labels: Dict) -> LabelKey:
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(key: LabelKey, extra: Optional[Tuple[str, str]] = None) -> str:
+    items = list(key) + ([extra] if extra else [])
+    if not items:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in items) + "}"
+
+
+def _format_value(value: float) -> str:
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+class MetricsRegistry:
+    """Bộ đếm (counter), histogram và gauge-callback; thread-safe"""
+
+    def __init__(self, prefix: str = "genques"):
+        self.prefix = prefix
+        self._lock = threading.Lock()
+        self._help: Dict[str, Tuple[str, str]] = {}
+        self._counters: Dict[str, Dict[LabelKey, float]] = {}
+        self._histograms: Dict[str, Dict[LabelKey, list]] = {}
+        self._buckets: Dict[str, Tuple[float, ...]] = {}
+        self._gauges: Dict[str, Callable[[], object]] = {}
+
+    def _name(self, name: str) -> str:
+        return f"{self.prefix}_{name}"
+
+    def counter(self, name: str, help_text: str):
+        self._help[self._name(name)] = ("counter", help_text)
+        self._counters.setdefault(self._name(name), {})
+
+    def histogram(self, name: str, help_text: str, buckets=LATENCY_BUCKETS):
+        self._help[self._name(name)] = ("histogram", help_text)
+        self._histograms.setdefault(self._name(name), {})
+        self._buckets[self._name(name)] = tuple(buckets)
+
+    def gauge(self, name: str, help_text: str, fn: Callable[[], object]):
+        """fn() trả về số, hoặc dict {state: số} (VD: queue.stats)"""
+        self._help[self._name(name)] = ("gauge", help_text)
+        self._gauges[self._name(name)] = fn
+
+    def inc(self, name: str, value: float = 1, **labels):
+        if not value:
+            return
+        full = self._name(name)
+        with self._lock:
+            series = self._counters.setdefault(full, {})
+            key = _labels(labels)
+            series[key] = series.get(key, 0) + value
+
+    def observe(self, name: str, value: float, **labels):
+        full = self._name(name)
+        buckets = self._buckets.get(full, LATENCY_BUCKETS)
+        with self._lock:
+            series = self._histograms.setdefault(full, {})
+            # [đếm theo bucket..., +Inf, tổng]
+            state = series.setdefault(_labels(labels), [0] * (len(buckets) + 1) + [0.0])
+            state[bisect_left(buckets, value)] += 1
+            state[-1] += value
+
+    def render(self) -> str:
+        lines = []
+        with self._lock:
+            counters = {k: dict(v) for k, v in self._counters.items()}
+            histograms = {k: {lk: list(st) for lk, st in v.items()} for k, v in self._histograms.items()}
+
+        for name, series in counters.items():
+            lines.append(f"# HELP {name} {self._help[name][1]}")
+            lines.append(f"# TYPE {name} counter")
+            for key, value in series.items():
+                lines.append(f"{name}{_format_labels(key)} {_format_value(value)}")
+
+        for name, series in histograms.items():
+            buckets = self._buckets[name]
+            lines.append(f"# HELP {name} {self._help[name][1]}")
+            lines.append(f"# TYPE {name} histogram")
+            for key, state in series.items():
+                cumulative = 0
+                for bound, count in zip(buckets, state):
+                    cumulative += count
+                    lines.append(f"{name}_bucket{_format_labels(key, ('le', _format_value(bound)))} {cumulative}")
+                cumulative += state[len(buckets)]
+                lines.append(f"{name}_bucket{_format_labels(key, ('le', '+Inf'))} {cumulative}")
+                lines.append(f"{name}_sum{_format_labels(key)} {_format_value(round(state[-1], 4))}")
+                lines.append(f"{name}_count{_format_labels(key)} {cumulative}")
+
+        for name, fn in self._gauges.items():
+            try:
+                value = fn()
+            except Exception as e:
+                print(f"⚠️ Lỗi đọc gauge {name}: {e}")
+                continue
+            lines.append(f"# HELP {name} {self._help[name][1]}")
+            lines.append(f"# TYPE {name} gauge")
+            if isinstance(value, dict):
+                for label_value, number in value.items():
+                    lines.append(f"{name}{_format_labels(_labels({'state': label_value}))} {_format_value(number)}")
+            else:
+                lines.append(f"{name} {_format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+
+def _pdf_buffer_megabytes() -> float:
+    from process.pdf_buffers import get_pdf_pool
+    return get_pdf_pool().stats()["loaded_mb"]
+
+
+def build_generation_registry(job_queue=None, in_flight: Optional[Callable[[], int]] = None) -> MetricsRegistry:
+    """Registry với các số liệu của pipeline sinh đề (tên ổn định để dựng dashboard)"""
+    registry = MetricsRegistry()
+    registry.counter("tasks_total", "Tác vụ đã kết thúc theo loại đề và kết quả")
+    registry.histogram("task_duration_seconds", "Thời gian chạy một tác vụ")
+    registry.histogram("model_latency_seconds", "Độ trễ một lần gọi model sinh đề")
+    registry.counter("model_requests_total", "Số request model (sinh đề + bù câu + sửa JSON)")
+    registry.counter("tokens_total", "Token đã dùng theo loại (in/out/thinking)")
+    registry.counter("json_parse_total", "Số lần parse JSON từ model")
+    registry.counter("json_repair_total", "Số lần phải nhờ model sửa JSON")
+    registry.counter("pandoc_calls_total", "Số lần gọi pandoc thật sự")
+    registry.counter("pandoc_cache_hits_total", "Số công thức lấy từ cache OMML")
+    registry.counter("image_calls_total", "Số lần gọi model sinh ảnh")
+    registry.counter("image_cache_hits_total", "Số ảnh lấy từ cache")
+    registry.gauge("pdf_buffer_megabytes", "Dung lượng PDF đang nạp trong bộ nhớ (dùng chung giữa các tác vụ)",
+                   _pdf_buffer_megabytes)
+    if in_flight is not None:
+        registry.gauge("tasks_in_flight", "Số tác vụ đang xử lý", in_flight)
+    if job_queue is not None:
+        def queue_stats():
+            # Mỗi lần scrape chạy trên một luồng HTTP mới -> đóng connection SQLite của luồng đó
+            try:
+                return job_queue.stats()
+            finally:
+                job_queue.close()
+
+        registry.gauge("queue_jobs", "Số job trong hàng đợi theo trạng thái", queue_stats)
+    return registry
+
+
+def observe_task(registry: MetricsRegistry, record: Dict):
+    """Cộng dồn một bản ghi TaskMetrics (xem process.metrics) vào registry"""
+    task_type = record.get("task_type") or "unknown"
+    timers = record.get("timers", {})
+    values = record.get("values", {})
+
+    def count(name):
+        return timers.get(name, {}).get("count", 0)
+
+    registry.inc("tasks_total", type=task_type, outcome=record.get("status") or "unknown")
+    registry.observe("task_duration_seconds", record.get("wall_seconds", 0), type=task_type)
+
+    model = timers.get("model")
+    if model and model["count"]:
+        # Một tác vụ thường gọi model sinh đề đúng một lần -> trung bình ~ giá trị thật
+        for _ in range(model["count"]):
+            registry.observe("model_latency_seconds", model["seconds"] / model["count"], type=task_type)
+    registry.inc("model_requests_total", count("model") + count("gap_fill") + count("json_repair"), type=task_type)
+    for kind in ("in", "out", "thinking"):
+        registry.inc("tokens_total", values.get(f"tokens_{kind}", 0), type=task_type, kind=kind)
+    registry.inc("json_parse_total", count("json_parse"), type=task_type)
+    registry.inc("json_repair_total", count("json_repair"), type=task_type)
+    registry.inc("pandoc_calls_total", count("pandoc"))
+    registry.inc("pandoc_cache_hits_total", values.get("pandoc_cache_hits", 0))
+    registry.inc("image_calls_total", count("image"))
+    registry.inc("image_cache_hits_total", values.get("image_cache_hits", 0))
+
+
+class MetricsServer:
+    """HTTP server nhỏ chạy nền: GET /metrics trả về registry.render()"""
+
+    def __init__(self, registry: MetricsRegistry, port: int, host: str = "127.0.0.1"):
+        self.registry = registry
+        self.host = host
+        self.port = port
+        self._server = None
+        self._thread = None
+        self._observer = lambda record: observe_task(self.registry, record)
+
+    def start(self):
+        registry = self.registry
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] not in ("/metrics", "/"):
+                    self.send_error(404)
+                    return
+                body = registry.render().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass  # Không in log mỗi lần Prometheus scrape
+
+        self._server = ThreadingHTTPServer((self.host, self.port), Handler)
+        self._server.daemon_threads = True
+        self.port = self._server.server_address[1]
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True, name="metrics-http")
+        self._thread.start()
+        add_observer(self._observer)
+        print(f"📈 Metrics: http://{self.host}:{self.port}/metrics")
+        return self
+
+    def stop(self):
+        remove_observer(self._observer)
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
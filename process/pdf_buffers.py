@@ -0,0 +1,241 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Dict, List, Optional, Tuple
+
+from process.cancellation import raise_if_cancelled
+from process.metrics import add_value
+
+# ============================================================
+# BỘ ĐỆM PDF DÙNG CHUNG, ĐẾM THAM CHIẾU, CÓ TRẦN BỘ NHỚ
+# ============================================================
+#
+# Trước đây mỗi tác vụ f.read() nguyên PDF vào một bytes riêng: nhóm TN/DS/TLN của cùng bộ sách
+# chạy song song = ba bản sao, nhóm vài trăm MB x max_workers làm RSS phình to.
+# PdfBufferPool nạp mỗi file MỘT lần cho cả tiến trình (khóa: đường dẫn + mtime + kích thước),
+# các tác vụ cùng dùng chung object bytes đó (bytes bất biến -> chia sẻ không cần copy).
+# SDK GenAI (types.Part.from_bytes) chỉ nhận bytes nên không dùng mmap/memoryview được:
+# bản mmap sẽ bị copy ngay khi tạo Part, chẳng tiết kiệm được gì.
+#
+# PDF_MEMORY_LIMIT_MB (mặc định 1024, 0 = không giới hạn): tổng dung lượng PDF đang nạp.
+#   - Tác vụ mới cần nạp thêm mà vượt trần -> CHỜ (trong stage model) tới khi tác vụ khác trả bộ đệm,
+#     tức là tự giới hạn số tác vụ được gửi đi cùng lúc theo bộ nhớ.
+#   - Không tác vụ nào khác đang giữ bộ đệm -> luôn cho qua (một nhóm lớn hơn trần vẫn chạy được).
+#   - File không còn ai giữ được để lại làm cache (TN xong thì DS dùng lại) cho tới khi cần chỗ.
+
+DEFAULT_MEMORY_LIMIT_MB = 1024
+
+BufferKey = Tuple[str, float, int]
+
+
+def _buffer_key(path: str) -> BufferKey:
+    st = os.stat(path)
+    return os.path.abspath(path), st.st_mtime, st.st_size
+
+
+class PdfBuffer:
+    """Nội dung một PDF đã nạp; data dùng chung giữa các tác vụ, KHÔNG được sửa"""
+
+    def __init__(self, key: BufferKey, data: bytes):
+        self.key = key
+        self.path = key[0]
+        self.data = data
+        self.refs = 0
+
+    @property
+    def size(self) -> int:
+        return len(self.data)
+
+
+class PdfBufferPool:
+    """Nạp PDF một lần cho cả tiến trình, đếm tham chiếu, giới hạn tổng bộ nhớ"""
+
+    def __init__(self, limit_bytes: int = DEFAULT_MEMORY_LIMIT_MB * 1024 * 1024):
+        self.limit_bytes = limit_bytes
+        self._buffers: Dict[BufferKey, PdfBuffer] = {}
+        # Bộ đệm không còn ai giữ, cũ nhất đứng đầu (bỏ trước khi cần chỗ)
+        self._idle: "OrderedDict[BufferKey, PdfBuffer]" = OrderedDict()
+        self._loading: Dict[BufferKey, threading.Event] = {}
+        self._loaded_bytes = 0
+        self._cond = threading.Condition()
+
+    # ---------------- Thống kê ----------------
+
+    @property
+    def loaded_bytes(self) -> int:
+        return self._loaded_bytes
+
+    def stats(self) -> Dict:
+        with self._cond:
+            return {
+                "files": len(self._buffers),
+                "idle_files": len(self._idle),
+                "loaded_mb": round(self._loaded_bytes / 1024 / 1024, 1),
+                "limit_mb": round(self.limit_bytes / 1024 / 1024, 1),
+            }
+
+    # ---------------- Nội bộ (gọi khi đang giữ self._cond) ----------------
+
+    def _in_use_bytes(self) -> int:
+        return self._loaded_bytes - sum(buffer.size for buffer in self._idle.values())
+
+    def _evict_idle(self, needed: int):
+        """Bỏ bộ đệm rảnh cũ nhất cho tới khi đủ chỗ cho needed byte"""
+        while self._idle and self._loaded_bytes + needed > self.limit_bytes:
+            key, buffer = self._idle.popitem(last=False)
+            del self._buffers[key]
+            self._loaded_bytes -= buffer.size
+
+    def _admit(self, keys: List[BufferKey]) -> bool:
+        """Đủ chỗ để nạp các file còn thiếu (hoặc không có ai khác đang giữ) -> True"""
+        if not self.limit_bytes:
+            return True
+        needed = sum(key[2] for key in keys if key not in self._buffers and key not in self._loading)
+        if self._loaded_bytes + needed <= self.limit_bytes:
+            return True
+        self._evict_idle(needed)
+        if self._loaded_bytes + needed <= self.limit_bytes:
+            return True
+        # Không ai khác đang giữ / đang nạp -> cho qua để không kẹt vĩnh viễn với nhóm quá lớn
+        return self._in_use_bytes() == 0 and not self._loading
+
+    # ---------------- API ----------------
+
+    def acquire(self, paths, cancel_token=None) -> List[PdfBuffer]:
+        """
+        Giữ bộ đệm của tất cả file trong nhóm (nguyên cả nhóm hoặc chờ, không giữ dở dang
+        để hai tác vụ không chặn nhau). Phải gọi release() với đúng danh sách trả về.
+        """
+        if isinstance(paths, str):
+            paths = [paths]
+        keys = [_buffer_key(path) for path in paths]
+
+        waited_from = None
+        with self._cond:
+            while not self._admit(keys):
+                if waited_from is None:
+                    waited_from = time.perf_counter()
+                    print(f"⏳ Chờ bộ nhớ PDF ({self._loaded_bytes // 1024 // 1024}MB/"
+                          f"{self.limit_bytes // 1024 // 1024}MB đang dùng)...")
+                self._cond.wait(0.5)
+                raise_if_cancelled(cancel_token)
+            # File chưa có: nhận việc nạp và giữ chỗ ngay (luồng khác tính cả phần đang nạp dở)
+            to_load = []
+            for key in keys:
+                if key not in self._buffers and key not in self._loading:
+                    self._loading[key] = threading.Event()
+                    self._loaded_bytes += key[2]
+                    to_load.append(key)
+        if waited_from is not None:
+            add_value("pdf_buffer_wait_seconds", time.perf_counter() - waited_from)
+
+        held: List[PdfBuffer] = []
+        loaded: Dict[BufferKey, PdfBuffer] = {}
+        remaining = list(to_load)
+        try:
+            while remaining:
+                key = remaining.pop(0)
+                loaded[key] = self._load(key)
+                held.append(loaded[key])
+            result = []
+            for key in keys:
+                buffer = loaded.pop(key, None)
+                if buffer is None:
+                    buffer = self._take(key, cancel_token)
+                    held.append(buffer)
+                result.append(buffer)
+        except BaseException:
+            # File lỗi đã tự trả chỗ trong _load; các file nhận nạp mà chưa kịp đọc phải trả lại
+            # (không thì luồng khác chờ mãi trong _take và _admit luôn thấy "đang nạp")
+            self._abandon_loading(remaining)
+            self.release(held)
+            raise
+        return result
+
+    def _abandon_loading(self, keys: List[BufferKey]):
+        if not keys:
+            return
+        with self._cond:
+            for key in keys:
+                self._loaded_bytes -= key[2]
+                self._loading.pop(key).set()
+            self._cond.notify_all()
+
+    def _load(self, key: BufferKey) -> PdfBuffer:
+        """Đọc file (ngoài khóa), trả về bộ đệm đã được giữ 1 tham chiếu; chỗ đã giữ sẵn theo stat"""
+        try:
+            with open(key[0], "rb") as f:
+                data = f.read()
+        except BaseException:
+            with self._cond:
+                self._loaded_bytes -= key[2]
+                self._loading.pop(key).set()
+                self._cond.notify_all()
+            raise
+        with self._cond:
+            buffer = PdfBuffer(key, data)
+            self._buffers[key] = buffer
+            # File vừa bị ghi đè giữa stat và read -> chỉnh lại theo kích thước thật
+            self._loaded_bytes += buffer.size - key[2]
+            buffer.refs = 1
+            self._loading.pop(key).set()
+            self._cond.notify_all()
+        add_value("pdf_buffer_loads")
+        return buffer
+
+    def _take(self, key: BufferKey, cancel_token=None) -> PdfBuffer:
+        """Tăng tham chiếu bộ đệm của key (chờ nếu luồng khác đang nạp; nạp hộ nếu luồng đó lỗi)"""
+        while True:
+            with self._cond:
+                while key in self._loading:
+                    self._cond.wait(0.5)
+                    raise_if_cancelled(cancel_token)
+                buffer = self._buffers.get(key)
+                if buffer is not None:
+                    if buffer.refs == 0:
+                        self._idle.pop(key, None)
+                    buffer.refs += 1
+                    return buffer
+                # Luồng nạp bị lỗi (hoặc bộ đệm vừa bị bỏ khỏi cache) -> tự nạp
+                self._loading[key] = threading.Event()
+                self._loaded_bytes += key[2]
+            return self._load(key)
+
+    def release(self, buffers: List[PdfBuffer]):
+        with self._cond:
+            for buffer in buffers:
+                buffer.refs -= 1
+                if buffer.refs > 0:
+                    continue
+                if self._buffers.get(buffer.key) is buffer and self.limit_bytes:
+                    self._idle[buffer.key] = buffer
+                elif self._buffers.get(buffer.key) is buffer:
+                    # Không giới hạn bộ nhớ -> không giữ cache (giữ hành vi cũ: xong là giải phóng)
+                    del self._buffers[buffer.key]
+                    self._loaded_bytes -= buffer.size
+            self._evict_idle(0)
+            self._cond.notify_all()
+
+    @contextmanager
+    def hold(self, paths, cancel_token=None):
+        buffers = self.acquire(paths, cancel_token)
+        try:
+            yield buffers
+        finally:
+            self.release(buffers)
+
+
+_pool: Optional[PdfBufferPool] = None
+_pool_guard = threading.Lock()
+
+
+def get_pdf_pool() -> PdfBufferPool:
+    """Pool dùng chung của tiến trình (trần đọc từ PDF_MEMORY_LIMIT_MB lần đầu gọi)"""
+    global _pool
+    with _pool_guard:
+        if _pool is None:
+            limit_mb = float(os.getenv("PDF_MEMORY_LIMIT_MB", str(DEFAULT_MEMORY_LIMIT_MB)) or 0)
+            _pool = PdfBufferPool(int(limit_mb * 1024 * 1024))
+        return _pool
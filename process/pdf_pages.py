@@ -0,0 +1,133 @@
+import os
+import re
+import threading
+from typing import Dict, List, Optional
+
+from process.metrics import add_value, timed
+from process.dedupe import file_sha256
+
+# ============================================================
+# CHỌN KHOẢNG TRANG VÀ CẮT PDF TRƯỚC KHI GỬI
+# ============================================================
+#
+# Giáo viên thường chỉ cần câu hỏi từ vài chục trang của cả cuốn SGK. Khoảng trang viết dạng
+# "40-62" hoặc "40-62, 70, 75-80" (đánh số từ 1, theo trang của file PDF), gắn cho từng file
+# (payload["page_ranges"] = {đường dẫn: khoảng trang}). File được cắt tại máy thành PDF con chỉ
+# gồm các trang đó, cache theo (SHA-256 file gốc, khoảng trang) trong PDF_SLICE_CACHE_DIR
+# (mặc định ./.cache/pdf_slices) -> chạy lại cùng khoảng trang không phải cắt lại.
+
+_RANGE_PART_RE = re.compile(r'^\s*(\d+)\s*(?:-\s*(\d+)\s*)?$')
+# Chặn khoảng trang gõ nhầm kiểu "1-9999999" (không sách nào dày thế)
+MAX_PAGE_NUMBER = 10000
+
+
+class PageRangeError(ValueError):
+    pass
+
+
+def parse_page_ranges(spec: Optional[str]) -> List[int]:
+    """'40-62, 70' -> [40, 41, ..., 62, 70] (tăng dần, không trùng); rỗng -> [] (cả file)"""
+    if not spec or not spec.strip():
+        return []
+    pages = set()
+    for part in spec.replace(";", ",").split(","):
+        if not part.strip():
+            continue
+        match = _RANGE_PART_RE.match(part)
+        if not match:
+            raise PageRangeError(f"Khoảng trang không hợp lệ: {part.strip()!r}")
+        start = int(match.group(1))
+        end = int(match.group(2) or start)
+        if start < 1 or end < start or end > MAX_PAGE_NUMBER:
+            raise PageRangeError(f"Khoảng trang không hợp lệ: {part.strip()!r}")
+        pages.update(range(start, end + 1))
+    return sorted(pages)
+
+
+def format_page_ranges(pages: List[int]) -> str:
+    """[40, 41, 42, 70] -> '40-42,70' (dạng chuẩn, dùng làm khóa cache)"""
+    parts = []
+    start = prev = None
+    for page in pages:
+        if prev is not None and page == prev + 1:
+            prev = page
+            continue
+        if start is not None:
+            parts.append(f"{start}-{prev}" if prev != start else str(start))
+        start = prev = page
+    if start is not None:
+        parts.append(f"{start}-{prev}" if prev != start else str(start))
+    return ",".join(parts)
+
+
+def pdf_slice_cache_dir() -> str:
+    return os.getenv("PDF_SLICE_CACHE_DIR") or os.path.join(os.getcwd(), ".cache", "pdf_slices")
+
+
+def slice_pdf(path: str, pages: List[int]) -> Optional[str]:
+    """
+    PDF con chỉ gồm các trang đã chọn (bỏ trang vượt quá số trang của file).
+    Trả về đường dẫn file cắt (trong cache), None nếu không cắt được (thiếu pypdf, PDF lỗi).
+    """
+    try:
+        digest = file_sha256(path)
+    except OSError as e:
+        print(f"⚠️ Không đọc được {path}: {e}")
+        return None
+
+    key = format_page_ranges(pages)
+    cache_path = os.path.join(pdf_slice_cache_dir(), f"{digest}_{key.replace(',', '_')}.pdf")
+    if os.path.exists(cache_path):
+        add_value("pdf_slice_cache_hits")
+        return cache_path
+
+    try:
+        from pypdf import PdfReader, PdfWriter
+    except ImportError:
+        print("⚠️ Chưa cài pypdf (pip install pypdf) - không cắt được PDF, gửi cả file")
+        return None
+
+    tmp_path = f"{cache_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        with timed("pdf_slice"):
+            reader = PdfReader(path)
+            total = len(reader.pages)
+            selected = [page for page in pages if page <= total]
+            if not selected:
+                print(f"⚠️ {os.path.basename(path)} chỉ có {total} trang, không có trang nào trong {key}")
+                return None
+            writer = PdfWriter()
+            for page in selected:
+                writer.add_page(reader.pages[page - 1])
+            os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+            with open(tmp_path, "wb") as f:
+                writer.write(f)
+            os.replace(tmp_path, cache_path)
+    except Exception as e:
+        print(f"⚠️ Không cắt được {os.path.basename(path)} ({key}): {e}")
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        return None
+
+    try:
+        add_value("pdf_slice_bytes_saved", os.path.getsize(path) - os.path.getsize(cache_path))
+    except OSError:
+        pass
+    print(f"✂️ Đã cắt {os.path.basename(path)}: trang {key} ({len(selected)}/{total} trang)")
+    return cache_path
+
+
+def pages_for(page_ranges: Optional[Dict[str, str]], path: str) -> List[int]:
+    """Các trang đã chọn của một file ([] = cả file); khoảng trang sai -> báo và dùng cả file"""
+    if not page_ranges:
+        return []
+    spec = page_ranges.get(path)
+    if spec is None:
+        spec = page_ranges.get(os.path.abspath(path))
+    try:
+        return parse_page_ranges(spec)
+    except PageRangeError as e:
+        print(f"⚠️ {os.path.basename(path)}: {e} - dùng cả file")
+        return []
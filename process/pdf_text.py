@@ -0,0 +1,212 @@
+import json
+import os
+import threading
+from typing import Dict, List, Optional, Tuple
+
+from process.dedupe import file_sha256
+from process.metrics import add_value, timed
+
+# ============================================================
+# TRÍCH TEXT PDF TẠI MÁY (GỬI TEXT GỌN THAY CHO FILE PDF)
+# ============================================================
+#
+# Prompt chỉ cần chữ trong sách và số trang (cho nguon_trich_dan), nhưng gửi nguyên PDF thì kèm cả
+# font, ảnh scan, tài nguyên nhúng. Bật PDF_TEXT_MODE=auto: mỗi PDF được trích text theo từng trang
+# (có dấu "--- Trang N ---"), cache theo SHA-256 nội dung file, rồi gửi text thay cho PDF.
+# File nào không trích được (PDF scan, font lỗi mã hóa, thiếu thư viện pypdf) -> gửi PDF gốc như cũ,
+# quyết định theo TỪNG file trong nhóm.
+#
+#   PDF_TEXT_MODE=off|auto        mặc định off
+#   PDF_TEXT_CACHE_DIR=...        mặc định ./.cache/pdf_text
+#   PDF_TEXT_MIN_CHARS=80         trang có ít ký tự hơn coi như trang ảnh
+#   PDF_TEXT_MIN_PAGE_RATIO=0.9   tỉ lệ trang có chữ tối thiểu để dùng text cho cả file
+
+PDF_TEXT_MODES = ("off", "auto")
+# Tăng khi đổi cách trích -> cache cũ tự bị bỏ qua
+EXTRACTOR_VERSION = 1
+# Ký tự thay thế / vùng private-use: dấu hiệu font không có bảng ToUnicode (text ra là rác)
+_GARBAGE_MAX_RATIO = 0.05
+
+_WARNED_NO_PYPDF = False
+
+
+def pdf_text_mode() -> str:
+    mode = os.getenv("PDF_TEXT_MODE", "off").strip().lower()
+    return mode if mode in PDF_TEXT_MODES else "off"
+
+
+def pdf_text_cache_dir() -> str:
+    return os.getenv("PDF_TEXT_CACHE_DIR") or os.path.join(os.getcwd(), ".cache", "pdf_text")
+
+
+class ExtractedPdf:
+    """Text từng trang của một PDF và kết luận có nên gửi text thay cho PDF hay không"""
+
+    def __init__(self, sha256: str, pages: List[str], extractable: bool, reason: str = ""):
+        self.sha256 = sha256
+        self.pages = pages
+        self.extractable = extractable
+        self.reason = reason
+
+    def to_dict(self) -> Dict:
+        return {"version": EXTRACTOR_VERSION, "sha256": self.sha256, "pages": self.pages,
+                "extractable": self.extractable, "reason": self.reason}
+
+    @classmethod
+    def from_dict(cls, data: Dict) -> "ExtractedPdf":
+        return cls(data["sha256"], data["pages"], data["extractable"], data.get("reason", ""))
+
+    def as_text(self, name: str, page_numbers: Optional[List[int]] = None) -> str:
+        """Text có dấu trang; page_numbers: chỉ lấy các trang này (số trang gốc, từ 1)"""
+        numbers = [n for n in page_numbers if n <= len(self.pages)] if page_numbers else \
+            range(1, len(self.pages) + 1)
+        blocks = [f"===== TÀI LIỆU: {name} ({len(numbers)}/{len(self.pages)} trang) ====="]
+        for number in numbers:
+            blocks.append(f"--- Trang {number} ---\n{self.pages[number - 1].strip()}")
+        return "\n".join(blocks)
+
+
+def judge_pages(pages: List[str]) -> Tuple[bool, str]:
+    """Đủ chữ trên (gần) mọi trang và không phải text rác -> dùng text được"""
+    if not pages:
+        return False, "không có trang"
+    min_chars = int(os.getenv("PDF_TEXT_MIN_CHARS", "80"))
+    min_ratio = float(os.getenv("PDF_TEXT_MIN_PAGE_RATIO", "0.9"))
+    text_pages = sum(1 for text in pages if len(text.strip()) >= min_chars)
+    if text_pages < len(pages) * min_ratio:
+        return False, f"chỉ {text_pages}/{len(pages)} trang có chữ (PDF scan?)"
+    total = sum(len(text) for text in pages)
+    garbage = sum(1 for text in pages for ch in text if ch == "\ufffd" or "\ue000" <= ch <= "\uf8ff")
+    if total and garbage / total > _GARBAGE_MAX_RATIO:
+        return False, "font không giải mã được (text rác)"
+    return True, ""
+
+
+def _extract_pages(path: str) -> Optional[List[str]]:
+    global _WARNED_NO_PYPDF
+    try:
+        from pypdf import PdfReader
+    except ImportError:
+        if not _WARNED_NO_PYPDF:
+            _WARNED_NO_PYPDF = True
+            print("⚠️ Chưa cài pypdf (pip install pypdf) - gửi PDF gốc")
+        return None
+    try:
+        reader = PdfReader(path)
+        return [page.extract_text() or "" for page in reader.pages]
+    except Exception as e:
+        print(f"⚠️ Không trích được text {os.path.basename(path)}: {e}")
+        return None
+
+
+def extract_pdf_text(path: str) -> Optional[ExtractedPdf]:
+    """Text từng trang của PDF (cache trên đĩa theo SHA-256); None nếu không trích được"""
+    try:
+        digest = file_sha256(path)
+    except OSError as e:
+        print(f"⚠️ Không đọc được {path}: {e}")
+        return None
+
+    cache_path = os.path.join(pdf_text_cache_dir(), f"{digest}.json")
+    try:
+        with open(cache_path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        if data.get("version") == EXTRACTOR_VERSION:
+            add_value("pdf_text_cache_hits")
+            return ExtractedPdf.from_dict(data)
+    except (OSError, ValueError, KeyError):
+        pass
+
+    with timed("pdf_text"):
+        pages = _extract_pages(path)
+    if pages is None:
+        return None
+    extractable, reason = judge_pages(pages)
+    extracted = ExtractedPdf(digest, pages, extractable, reason)
+
+    # Ghi file tạm rồi os.replace: hai luồng cùng trích một PDF không làm hỏng cache
+    tmp_path = f"{cache_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(extracted.to_dict(), f, ensure_ascii=False)
+        os.replace(tmp_path, cache_path)
+    except OSError as e:
+        print(f"⚠️ Không ghi được cache text PDF: {e}")
+    return extracted
+
+
+def warm_pdf_text(file_paths, page_ranges: Optional[Dict[str, str]] = None) -> None:
+    """Trích/cắt trước (stage riêng của pipeline) để luồng gọi model chỉ còn đọc cache"""
+    if pdf_text_mode() == "off" or not file_paths:
+        return
+    from process.pdf_pages import pages_for, slice_pdf
+    for path in [file_paths] if isinstance(file_paths, str) else file_paths:
+        extracted = extract_pdf_text(path)
+        pages = pages_for(page_ranges, path)
+        if pages and (extracted is None or not extracted.extractable):
+            slice_pdf(path, pages)
+
+
+def prepare_model_input(prompt: str, file_paths,
+                        page_ranges: Optional[Dict[str, str]] = None) -> Tuple[str, List[str]]:
+    """
+    (prompt, danh sách PDF) -> (prompt đã kèm text các PDF trích được, các PDF còn phải gửi nguyên).
+    page_ranges: {đường dẫn: "40-62"} - chỉ gửi các trang đó (text của các trang, hoặc PDF đã cắt).
+    PDF_TEXT_MODE=off và không chọn trang -> trả về nguyên như cũ.
+    """
+    from process.pdf_pages import format_page_ranges, pages_for, slice_pdf
+
+    if isinstance(file_paths, str):
+        file_paths = [file_paths]
+    file_paths = list(file_paths or [])
+    text_mode = pdf_text_mode() != "off"
+    if not file_paths or (not text_mode and not page_ranges):
+        return prompt, file_paths
+
+    text_blocks = []
+    notes = []
+    raw_files = []
+    for path in file_paths:
+        name = os.path.basename(path)
+        pages = pages_for(page_ranges, path)
+        extracted = extract_pdf_text(path) if text_mode else None
+        if extracted is None or not extracted.extractable:
+            if text_mode:
+                if extracted is not None:
+                    print(f"📄 Gửi PDF gốc {name}: {extracted.reason}")
+                add_value("pdf_sent_raw")
+            if not pages:
+                raw_files.append(path)
+                continue
+            spec = format_page_ranges(pages)
+            sliced = slice_pdf(path, pages)
+            if sliced:
+                raw_files.append(sliced)
+                notes.append(f"- File \"{name}\" chỉ gồm các trang {spec} của tài liệu gốc, theo đúng thứ tự "
+                             f"(trang 1 của file là trang {pages[0]}); nguon_trich_dan ghi theo số trang gốc.")
+            else:
+                raw_files.append(path)
+                notes.append(f"- File \"{name}\": CHỈ dùng nội dung các trang {spec}.")
+            continue
+        text = extracted.as_text(name, pages)
+        text_blocks.append(text)
+        sent_pages = len([n for n in pages if n <= len(extracted.pages)]) if pages else len(extracted.pages)
+        add_value("pdf_sent_as_text")
+        add_value("pdf_text_pages", sent_pages)
+        try:
+            add_value("pdf_bytes_saved", os.path.getsize(path) - len(text.encode("utf-8")))
+        except OSError:
+            pass
+        print(f"📝 Gửi text thay PDF: {name} ({sent_pages}/{len(extracted.pages)} trang)")
+
+    parts = []
+    if text_blocks:
+        parts.append("NỘI DUNG SÁCH (trích từ PDF; mỗi trang bắt đầu bằng dòng \"--- Trang N ---\", "
+                     "dùng số trang này cho nguon_trich_dan):")
+        parts.extend(text_blocks)
+    if notes:
+        parts.append("PHẠM VI TRANG:\n" + "\n".join(notes))
+    if not parts:
+        return prompt, raw_files
+    return "\n\n".join(parts + [prompt]), raw_files
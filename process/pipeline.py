@@ -0,0 +1,290 @@
+import os
+import queue
+import threading
+import time
+from typing import Callable, Dict, List, Optional
+
+from process.cancellation import OperationCancelled
+from process.metrics import TaskMetrics, bind
+from process.profiling import new_task_profiler, section
+
+# ============================================================
+# PIPELINE THEO STAGE: MODEL (I/O) -> PARSE -> RENDER (CPU) -> SAVE (DISK)
+# ============================================================
+#
+# Mỗi stage có pool luồng riêng và hàng đợi vào có giới hạn (bounded queue).
+# Stage sau đầy -> stage trước bị chặn ở put() (backpressure), nên bộ nhớ
+# không phình ra và thông lượng bị giới hạn bởi stage chậm nhất thay vì
+# tổng thời gian của cả chuỗi.
+
+# task_type -> (question_type cho response2docx, hậu tố tên file)
+TASK_TYPES = {
+    "TN": ("trac_nghiem_4_dap_an", "_TN"),
+    "DS": ("dung_sai", "_DS"),
+    "TLN": ("tra_loi_ngan", "_TLN"),
+}
+
+_STOP = object()
+
+
+class PipelineItem:
+    """Một tác vụ đi qua các stage; mỗi stage ghi kết quả trung gian vào đây"""
+    def __init__(self, key, payload: Dict, context=None):
+        self.key = key
+        self.payload = payload
+        self.context = context
+        self.client = None
+        self.ai_response = None
+        self.data = None  # Exam đã kiểm tra (sau stage parse)
+        self.doc = None
+        self.result = None
+        # Bản link của result cho các nhóm trùng nội dung (payload["aliases"])
+        self.linked_results = []
+        self.error = None
+        self.cancelled = False
+        self.stage_times = {}
+        # Bộ đếm chi tiết (model/pandoc/ảnh/token...) - các stage gắn vào luồng khi xử lý item
+        self.metrics = TaskMetrics(self.label, task_type=payload.get("task_type"))
+        # Chỉ có khi bật GENQUES_PROFILE (xem process/profiling.py)
+        self.profiler = new_task_profiler(self.label)
+
+    @property
+    def label(self):
+        return f"{self.payload.get('output_name')} ({self.payload.get('task_type')})"
+
+
+class Stage:
+    """Một stage: hàm xử lý + số luồng + kích thước hàng đợi vào"""
+    def __init__(self, name: str, fn: Callable[[PipelineItem], None], workers: int = 1, queue_size: int = 2):
+        self.name = name
+        self.fn = fn
+        self.workers = max(1, workers)
+        self.queue = queue.Queue(maxsize=max(1, queue_size))
+        self.threads: List[threading.Thread] = []
+        self._alive = 0
+        self._lock = threading.Lock()
+
+
+class StagedPipeline:
+    """
+    Chạy chuỗi stage với backpressure. Kết quả (thành công/lỗi/hủy) được đẩy vào
+    self.results để luồng điều phối tự xử lý (complete/fail job trong hàng đợi).
+    Hàm stage báo lỗi bằng cách raise Exception hoặc gán item.error.
+    """
+
+    def __init__(self, stages: List[Stage], cancel_token=None):
+        self.stages = stages
+        self.cancel_token = cancel_token
+        self.results = queue.Queue()
+        # Tài nguyên cần giải phóng sau khi pipeline dừng (VD: pool tiến trình render)
+        self.cleanups: List[Callable[[], None]] = []
+
+    @property
+    def capacity(self) -> int:
+        """Số item tối đa có thể nằm trong pipeline cùng lúc"""
+        return sum(s.workers + s.queue.maxsize for s in self.stages)
+
+    def start(self):
+        for index, stage in enumerate(self.stages):
+            stage._alive = stage.workers
+            for i in range(stage.workers):
+                t = threading.Thread(
+                    target=self._stage_loop, args=(index,), daemon=True,
+                    name=f"pipeline-{stage.name}-{i}"
+                )
+                stage.threads.append(t)
+                t.start()
+        return self
+
+    def submit(self, item: PipelineItem, timeout: Optional[float] = None):
+        """Đưa item vào stage đầu (chặn nếu stage đầu đầy)"""
+        self.stages[0].queue.put(item, timeout=timeout)
+
+    def close(self):
+        """Không nhận thêm item; các stage dừng lần lượt sau khi xử lý hết"""
+        first = self.stages[0]
+        for _ in range(first.workers):
+            first.queue.put(_STOP)
+
+    def join(self, timeout: Optional[float] = None):
+        deadline = time.monotonic() + timeout if timeout else None
+        for stage in self.stages:
+            for t in stage.threads:
+                remaining = None if deadline is None else max(0, deadline - time.monotonic())
+                t.join(remaining)
+        for cleanup in self.cleanups:
+            try:
+                cleanup()
+            except Exception as e:
+                print(f"⚠️ Lỗi khi dọn pipeline: {e}")
+        self.cleanups = []
+
+    def _finish(self, item: PipelineItem):
+        self.results.put(item)
+
+    def _stage_loop(self, index: int):
+        stage = self.stages[index]
+        next_stage = self.stages[index + 1] if index + 1 < len(self.stages) else None
+        try:
+            while True:
+                item = stage.queue.get()
+                if item is _STOP:
+                    break
+
+                if self.cancel_token is not None and self.cancel_token.is_cancelled:
+                    item.cancelled = True
+                    self._finish(item)
+                    continue
+
+                started = time.perf_counter()
+                try:
+                    with bind(item.metrics), section(item.profiler):
+                        stage.fn(item)
+                except OperationCancelled:
+                    item.cancelled = True
+                except Exception as e:
+                    item.error = f"[{stage.name}] {e}"
+                item.stage_times[stage.name] = time.perf_counter() - started
+                item.metrics.add_time(f"stage.{stage.name}", item.stage_times[stage.name])
+
+                if item.cancelled or item.error or next_stage is None:
+                    self._finish(item)
+                else:
+                    # Chặn tại đây khi stage sau đầy -> backpressure
+                    next_stage.queue.put(item)
+        finally:
+            # Luồng cuối cùng của stage chuyển tín hiệu dừng cho stage sau
+            with stage._lock:
+                stage._alive -= 1
+                last = stage._alive == 0
+            if last and next_stage is not None:
+                for _ in range(next_stage.workers):
+                    next_stage.queue.put(_STOP)
+
+
+# ============================================================
+# CÁC STAGE SINH ĐỀ
+# ============================================================
+
+# Các bước dùng chung cho pipeline theo luồng và bản asyncio (process/async_pipeline.py)
+
+def parse_item(item: PipelineItem, cancel_token=None):
+    """Parse response của model (có thể gọi AI sửa JSON) rồi bù câu thiếu"""
+    from process.response2docx import parse_ai_response, fill_missing_questions
+
+    question_type, _ = TASK_TYPES.get(item.payload["task_type"], TASK_TYPES["TN"])
+    item.data = parse_ai_response(item.ai_response, item.client, cancel_token, question_type)
+    # Giải phóng response thô sớm để giảm bộ nhớ khi nhiều item xếp hàng
+    item.ai_response = None
+    if item.data is None:
+        item.error = "Không thể parse JSON từ AI"
+        return
+    item.data = fill_missing_questions(
+        item.data, item.client, item.payload["pdf_files"], item.payload["prompt_content"],
+        question_type, cancel_token, item.payload.get("page_ranges")
+    )
+
+
+def link_aliases(item: PipelineItem):
+    """Nhóm trùng nội dung (payload["aliases"]) nhận bản link của file kết quả"""
+    from process.dedupe import link_alias_outputs
+
+    aliases = item.payload.get("aliases")
+    if aliases and item.result:
+        item.linked_results = link_alias_outputs(item.result, item.payload["output_name"], aliases)
+
+
+def save_item(item: PipelineItem, output_root=None):
+    """Lưu item.doc + file đi kèm, link sang các nhóm trùng nội dung"""
+    from process.response2docx import save_document_securely, save_sidecars
+
+    _, suffix = TASK_TYPES.get(item.payload["task_type"], TASK_TYPES["TN"])
+    batch_name = item.payload["output_name"]
+    print("💾 Đang lưu file...")
+    item.result = save_document_securely(item.doc, batch_name, f"{batch_name}{suffix}", output_root)
+    item.doc = None
+    if not item.result or not os.path.exists(item.result):
+        item.result = None
+        item.error = "Không thể lưu file"
+        return
+    save_sidecars(item.data, item.result)
+    link_aliases(item)
+
+
+def build_generation_pipeline(project_id, creds, model_name, cancel_token=None,
+                              model_workers=3, parse_workers=2, render_workers=None,
+                              save_workers=1, output_root=None, render_processes=0,
+                              client_factory=None) -> StagedPipeline:
+    """
+    Pipeline sinh đề: payload cần các khóa output_name, pdf_files, task_type, prompt_content
+    (tùy chọn page_ranges: {đường dẫn PDF: "40-62"}; aliases: tên các nhóm trùng nội dung,
+    nhận bản link của file kết quả thay vì sinh lại).
+    - extract (chỉ khi PDF_TEXT_MODE=auto): trích text PDF vào cache.
+    - model: I/O-bound, số luồng = số request AI song song (thread_spinbox).
+    - parse/render: CPU-bound, ít luồng để không tranh GIL vô ích
+      (parse có thể gọi AI thêm một lần nhỏ để sửa JSON hoặc bù câu thiếu).
+    - save: ghi đĩa.
+    render_processes > 0: gộp render+save thành một stage chạy trong pool tiến trình.
+    client_factory: hàm trả về client AI cho mỗi item (mặc định VertexClient) - dùng cho benchmark offline.
+    """
+    from process.pdf_text import pdf_text_mode, warm_pdf_text
+    from process.response2docx import request_ai_response, render_document
+
+    if render_workers is None:
+        render_workers = max(1, min(4, (os.cpu_count() or 2) // 2))
+
+    def extract_stage(item):
+        # CPU: trích text PDF vào cache trước, luồng model không bị chiếm bởi việc parse PDF
+        warm_pdf_text(item.payload["pdf_files"], item.payload.get("page_ranges"))
+
+    def model_stage(item):
+        question_type, _ = TASK_TYPES.get(item.payload["task_type"], TASK_TYPES["TN"])
+        item.client, item.ai_response = request_ai_response(
+            item.payload["pdf_files"], item.payload["prompt_content"],
+            project_id, creds, model_name, question_type, cancel_token,
+            client=client_factory() if client_factory else None,
+            page_ranges=item.payload.get("page_ranges")
+        )
+
+    def parse_stage(item):
+        parse_item(item, cancel_token)
+
+    def render_stage(item):
+        item.doc = render_document(item.data, cancel_token)
+        if item.doc is None:
+            item.error = "Lỗi khi render DOCX"
+
+    def save_stage(item):
+        save_item(item, output_root)
+
+    stages = []
+    if pdf_text_mode() != "off":
+        stages.append(Stage("extract", extract_stage, workers=parse_workers, queue_size=parse_workers))
+    stages += [
+        Stage("model", model_stage, workers=model_workers, queue_size=model_workers),
+        Stage("parse", parse_stage, workers=parse_workers, queue_size=parse_workers),
+    ]
+    cleanups = []
+
+    if render_processes:
+        from process.render_pool import RenderProcessPool
+
+        pool = RenderProcessPool(render_processes, cancel_token).warm_up()
+        cleanups.append(pool.shutdown)
+
+        def render_save_stage(item):
+            _, suffix = TASK_TYPES.get(item.payload["task_type"], TASK_TYPES["TN"])
+            batch_name = item.payload["output_name"]
+            # Ranh giới tiến trình: gửi dict (tiến trình con kiểm tra lại thành Exam)
+            item.result = pool.render_and_save(item.data.to_dict(), batch_name, f"{batch_name}{suffix}", output_root)
+            link_aliases(item)
+
+        # Mỗi luồng chỉ gửi việc và chờ, CPU thật sự nằm ở tiến trình con
+        stages.append(Stage("render", render_save_stage, workers=pool.workers, queue_size=pool.workers))
+    else:
+        stages.append(Stage("render", render_stage, workers=render_workers, queue_size=render_workers))
+        stages.append(Stage("save", save_stage, workers=save_workers, queue_size=2))
+
+    pipeline = StagedPipeline(stages, cancel_token)
+    pipeline.cleanups.extend(cleanups)
+    return pipeline
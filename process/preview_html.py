@@ -0,0 +1,180 @@
+import html
+import os
+import uuid
+from typing import Dict, List, Optional
+
+# ============================================================
+# HTML XEM TRƯỚC SINH TRỰC TIẾP TỪ JSON ĐÃ PARSE
+# ============================================================
+#
+# Thay vì mở lại .docx và chạy mammoth trên luồng UI, pipeline ghi kèm mỗi file
+# <tên>.docx một file <tên>.preview.html dựng từ cùng dict câu hỏi.
+# HTML thuần (không MathML/KaTeX): công thức hiển thị nguyên dạng LaTeX trong khung riêng,
+# hình ảnh hiển thị bằng mô tả. Bố cục giống DynamicDocxRenderer (mức độ -> phần -> câu).
+
+PREVIEW_SUFFIX = ".preview.html"
+
+_STYLE = """
+body { font-family: 'Segoe UI', Arial, sans-serif; padding: 30px; line-height: 1.6; color: #333; }
+h1 { text-align: center; color: #1565C0; }
+h2 { color: #2E7D32; border-bottom: 1px solid #ddd; padding-bottom: 4px; }
+h3 { color: #6A1B9A; }
+p { margin: 0 0 8px 0; }
+.q { margin-bottom: 22px; }
+.math { font-family: Consolas, 'Courier New', monospace; background: #F3F6FA; border: 1px solid #DDE3EA;
+        border-radius: 3px; padding: 0 4px; color: #0D47A1; }
+.img { text-align: center; color: #C62828; font-style: italic; font-weight: bold; }
+.sol { color: #555; }
+"""
+
+
+def preview_path_for(docx_path: str) -> str:
+    return os.path.splitext(docx_path)[0] + PREVIEW_SUFFIX
+
+
+def _inline(text, bold: bool = False) -> str:
+    """Text có LaTeX -> HTML (công thức bọc trong span.math)"""
+    from process.response2docx import tokenize_latex_text
+
+    if not text:
+        return ""
+    parts = []
+    for is_math, part in tokenize_latex_text(str(text)):
+        if is_math:
+            parts.append(f'<span class="math">{html.escape(part)}</span>')
+        else:
+            parts.append(html.escape(part).replace("\n", "<br>"))
+    content = "".join(parts)
+    return f"<b>{content}</b>" if bold else content
+
+
+def _image_html(cau: Dict) -> str:
+    hinh_anh = cau.get("hinh_anh") or {}
+    if not hinh_anh.get("co_hinh"):
+        return ""
+    mo_ta = str(hinh_anh.get("mo_ta", hinh_anh.get("description", ""))).strip()
+    return f'<p class="img">🖼️ [Hình: {html.escape(mo_ta)}]</p>'
+
+
+def _render_trac_nghiem(cau: Dict, out: List[str]):
+    out.append(f"<p><b>Câu {html.escape(str(cau.get('stt', '')))}. </b>{_inline(cau.get('noi_dung'))}</p>")
+    out.append(_image_html(cau))
+    for dap_an in cau.get("dap_an", []):
+        out.append(f"<p>{html.escape(str(dap_an.get('ky_hieu', '')))}. {_inline(dap_an.get('noi_dung'))}</p>")
+    out.append('<div class="sol"><p><b>Lời giải</b></p>')
+    if "dap_an_dung" in cau:
+        out.append(f"<p><b>{html.escape(str(cau['dap_an_dung']))}</b></p><p>####</p>")
+    for line in str(cau.get("giai_thich", "")).split("\n"):
+        if line.strip():
+            out.append(f"<p>{_inline(line.strip())}</p>")
+    try:
+        noi_dung_dap_an = cau["dap_an"][cau["dap_an_dung"] - 1]["noi_dung"]
+        out.append(f"<p><b>Vậy đáp án đúng là: </b>{_inline(noi_dung_dap_an, bold=True)}</p>")
+    except (KeyError, IndexError, TypeError):
+        pass
+    out.append("</div>")
+
+
+def _render_dung_sai(cau: Dict, out: List[str]):
+    out.append(f"<p><b>Câu {html.escape(str(cau.get('stt', '')))}.</b></p>")
+    if cau.get("doan_thong_tin"):
+        out.append(f"<p>{_inline(cau['doan_thong_tin'])}</p>")
+    out.append(_image_html(cau))
+    for y in cau.get("cac_y", []):
+        out.append(f"<p>{html.escape(str(y.get('ky_hieu', '')))}) {_inline(y.get('noi_dung'))}</p>")
+    out.append('<div class="sol"><p><b>Lời giải</b></p>')
+    out.append(f"<p><b>{html.escape(str(cau.get('dap_an_dung_sai', '')))}</b></p><p>####</p>")
+    for gt in cau.get("giai_thich", []) or []:
+        if not isinstance(gt, dict):
+            continue
+        ket_luan = html.escape(str(gt.get("ket_luan", "SAI")))
+        out.append(
+            f'<p>+) "{_inline(gt.get("noi_dung_y", ""))}" <b>- {ket_luan}. </b>{_inline(gt.get("giai_thich", ""))}</p>'
+        )
+    out.append("</div>")
+
+
+def _render_tra_loi_ngan(cau: Dict, out: List[str]):
+    out.append(f"<p><b>Câu {html.escape(str(cau.get('stt', '')))}. </b></p>")
+    out.append(f"<p>{_inline(cau.get('noi_dung'))}</p>")
+    out.append(_image_html(cau))
+    raw_ans = str(cau.get("dap_an", "")).strip()
+    final_ans = raw_ans if raw_ans.startswith("[[") and raw_ans.endswith("]]") else f"[[{raw_ans}]]"
+    out.append(f"<p><b>Đáp án: </b>{_inline(final_ans, bold=True)}</p>")
+    out.append('<div class="sol"><p><b>Lời giải</b></p><p>####</p>')
+    for line in str(cau.get("giai_thich", "")).replace("\\n", "\n").split("\n"):
+        text = line.strip()
+        if not text or text == "####":
+            continue
+        is_bold = False
+        if text.startswith("**") and text.endswith("**"):
+            text, is_bold = text[2:-2], True
+        if text.replace("*", "").strip().lower().startswith("vậy"):
+            text, is_bold = text.replace("**", ""), True
+        out.append(f"<p>{_inline(text, bold=is_bold)}</p>")
+    out.append("</div>")
+
+
+def render_preview_html(data: Dict) -> str:
+    """Dựng trang HTML xem trước từ dict câu hỏi (cùng thứ tự nhóm với DOCX)"""
+    from process.response2docx import DynamicDocxRenderer
+
+    # Chỉ dùng các hàm nhóm/đặt tiêu đề, không đụng tới document
+    grouper = DynamicDocxRenderer(None)
+    loai_de = data.get("loai_de", "")
+    render_question = {
+        "dung_sai": _render_dung_sai,
+        "tra_loi_ngan": _render_tra_loi_ngan,
+    }.get(loai_de, _render_trac_nghiem)
+
+    out = [
+        '<!DOCTYPE html><html><head><meta charset="utf-8">',
+        f"<style>{_STYLE}</style></head><body>",
+        f"<h1>ĐỀ {html.escape(loai_de.upper())}</h1>",
+    ]
+    grouped = grouper.auto_group_questions(data)
+    for muc_do in ["nhan_biet", "thong_hieu", "van_dung", "van_dung_cao"]:
+        questions = grouped.get(muc_do)
+        if not questions:
+            continue
+        out.append(f"<h2>{html.escape(grouper.get_section_title(muc_do))}</h2>")
+        current_phan = None
+        for cau in questions:
+            phan_cua_cau = str(cau.get("phan", "")).strip()
+            if phan_cua_cau and phan_cua_cau != current_phan:
+                out.append(f"<h3>{html.escape(phan_cua_cau.upper())}</h3>")
+                current_phan = phan_cua_cau
+            out.append('<div class="q">')
+            render_question(cau, out)
+            out.append("</div>")
+    out.append("</body></html>")
+    return "\n".join(part for part in out if part)
+
+
+def write_preview_sidecar(data: Dict, docx_path: str) -> Optional[str]:
+    """Ghi <tên>.preview.html cạnh file DOCX (nguyên tử). Lỗi preview không làm hỏng job."""
+    preview_path = preview_path_for(docx_path)
+    tmp_path = f"{preview_path}.{uuid.uuid4().hex[:8]}.tmp"
+    try:
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(render_preview_html(data))
+        os.replace(tmp_path, preview_path)
+        return preview_path
+    except Exception as e:
+        print(f"⚠️ Không tạo được HTML xem trước: {e}")
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        return None
+
+
+def load_fresh_preview(docx_path: str) -> Optional[str]:
+    """Đường dẫn preview nếu tồn tại và không cũ hơn file DOCX, ngược lại None"""
+    preview_path = preview_path_for(docx_path)
+    try:
+        if os.path.getmtime(preview_path) >= os.path.getmtime(docx_path):
+            return preview_path
+    except OSError:
+        pass
+    return None
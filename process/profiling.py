@@ -0,0 +1,169 @@
+import cProfile
+import os
+import pstats
+import re
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from typing import Dict, List, Optional
+
+# ============================================================
+# PROFILE THEO TỪNG TÁC VỤ (BẬT BẰNG BIẾN MÔI TRƯỜNG)
+# ============================================================
+#
+#   GENQUES_PROFILE=cprofile  -> <thư mục>/<tác vụ>.prof  (xem: python -m pstats / snakeviz)
+#   GENQUES_PROFILE=sample    -> <thư mục>/<tác vụ>.folded (flamegraph.pl / speedscope)
+#   GENQUES_PROFILE_DIR=...   -> thư mục ghi (mặc định ./profiles)
+#   GENQUES_PROFILE_INTERVAL  -> chu kỳ lấy mẫu (giây, mặc định 0.005)
+#
+# Một tác vụ đi qua nhiều stage trên nhiều luồng: mỗi lần stage xử lý item thì bọc trong
+# TaskProfiler.section(). cProfile: mỗi section một Profile riêng (cProfile chỉ đo luồng hiện tại),
+# gộp lại bằng pstats khi dump. sample: một luồng nền chụp stack các luồng đang ở trong section
+# (không làm chậm code được đo như cProfile, dùng được khi nhiều tác vụ chạy song song).
+# Không bật -> new_task_profiler() trả về None và section(None) không làm gì.
+
+PROFILE_MODES = ("cprofile", "sample")
+_UNSAFE_NAME_RE = re.compile(r'[^\w.-]+', re.UNICODE)
+
+
+def profile_mode() -> str:
+    mode = os.getenv("GENQUES_PROFILE", "").strip().lower()
+    return mode if mode in PROFILE_MODES else ""
+
+
+def profile_dir() -> str:
+    return os.getenv("GENQUES_PROFILE_DIR") or os.path.join(os.getcwd(), "profiles")
+
+
+class _Sampler:
+    """Luồng nền dùng chung: chụp stack của các luồng đã đăng ký theo chu kỳ"""
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self._targets: Dict[int, "TaskProfiler"] = {}
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def register(self, thread_id: int, profiler: "TaskProfiler"):
+        with self._lock:
+            self._targets[thread_id] = profiler
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, daemon=True, name="profile-sampler")
+                self._thread.start()
+
+    def unregister(self, thread_id: int):
+        with self._lock:
+            self._targets.pop(thread_id, None)
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            with self._lock:
+                targets = dict(self._targets)
+            if not targets:
+                continue
+            frames = sys._current_frames()
+            for thread_id, profiler in targets.items():
+                frame = frames.get(thread_id)
+                if frame is not None:
+                    profiler._add_sample(frame)
+
+
+_sampler: Optional[_Sampler] = None
+_sampler_guard = threading.Lock()
+
+
+def _get_sampler() -> _Sampler:
+    global _sampler
+    with _sampler_guard:
+        if _sampler is None:
+            _sampler = _Sampler(float(os.getenv("GENQUES_PROFILE_INTERVAL", "0.005")))
+        return _sampler
+
+
+class TaskProfiler:
+    """Profile của một tác vụ, gom qua mọi stage/luồng đã xử lý tác vụ đó"""
+
+    def __init__(self, label: str, mode: str = "cprofile", output_dir: Optional[str] = None):
+        self.label = label
+        self.mode = mode
+        self.output_dir = output_dir or profile_dir()
+        self._profiles: List[cProfile.Profile] = []
+        self._samples: Counter = Counter()
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def section(self):
+        if self.mode == "cprofile":
+            profile = cProfile.Profile()
+            profile.enable()
+            try:
+                yield
+            finally:
+                profile.disable()
+                with self._lock:
+                    self._profiles.append(profile)
+        else:
+            thread_id = threading.get_ident()
+            sampler = _get_sampler()
+            sampler.register(thread_id, self)
+            try:
+                yield
+            finally:
+                sampler.unregister(thread_id)
+
+    def _add_sample(self, frame):
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+            frame = frame.f_back
+        with self._lock:
+            self._samples[";".join(reversed(stack))] += 1
+
+    def dump(self) -> Optional[str]:
+        """Ghi file profile, trả về đường dẫn (None nếu chưa đo được gì)"""
+        base = _UNSAFE_NAME_RE.sub("_", self.label).strip("_") or "task"
+        base = f"{base}-{time.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}"
+        try:
+            os.makedirs(self.output_dir, exist_ok=True)
+            if self.mode == "cprofile":
+                with self._lock:
+                    profiles = list(self._profiles)
+                if not profiles:
+                    return None
+                stats = pstats.Stats(profiles[0])
+                for profile in profiles[1:]:
+                    stats.add(profile)
+                path = os.path.join(self.output_dir, f"{base}.prof")
+                stats.dump_stats(path)
+            else:
+                with self._lock:
+                    samples = dict(self._samples)
+                if not samples:
+                    return None
+                path = os.path.join(self.output_dir, f"{base}.folded")
+                with open(path, "w", encoding="utf-8") as f:
+                    for stack, count in sorted(samples.items()):
+                        f.write(f"{stack} {count}\n")
+            return path
+        except Exception as e:
+            print(f"⚠️ Không ghi được profile {self.label}: {e}")
+            return None
+
+
+def new_task_profiler(label: str) -> Optional[TaskProfiler]:
+    mode = profile_mode()
+    return TaskProfiler(label, mode) if mode else None
+
+
+@contextmanager
+def section(profiler: Optional[TaskProfiler]):
+    """Bọc một đoạn xử lý của tác vụ; profiler None -> không làm gì"""
+    if profiler is None:
+        yield
+        return
+    with profiler.section():
+        yield
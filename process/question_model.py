@@ -0,0 +1,449 @@
+import re
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional, Tuple, Union
+
+# ============================================================
+# MÔ HÌNH CÂU HỎI CÓ KIỂU + KIỂM TRA DỮ LIỆU
+# ============================================================
+#
+# JSON từ AI được kiểm tra MỘT LẦN ngay sau parse_json_safely:
+# - Câu hợp lệ -> dataclass (slots) nhỏ gọn, renderer chỉ đọc thuộc tính, không còn
+#   cau['dap_an'][n-1]['noi_dung'] có thể KeyError/IndexError giữa chừng.
+# - Câu lỗi -> cách ly (quarantine) riêng từng câu kèm lý do, file vẫn được tạo với các câu còn lại.
+# to_dict() trả về dict đã chuẩn hóa (cùng cấu trúc JSON gốc) cho preview/exporter.
+
+MUC_DO_ORDER = ("nhan_biet", "thong_hieu", "van_dung", "van_dung_cao")
+
+# Key lưu danh sách câu bị cách ly trong dict đề (được ghi cả vào .questions.json)
+QUARANTINE_KEY = "cau_hoi_loi"
+
+
+class QuestionValidationError(ValueError):
+    """Một câu hỏi không đúng cấu trúc tối thiểu để render"""
+
+
+def normalize_muc_do(raw) -> str:
+    """
+    Chuẩn hóa mức độ từ Tiếng Việt sang code ("Vận dụng cao" -> van_dung_cao...).
+    Ưu tiên check "cao" trước để phân biệt "Vận dụng" và "Vận dụng cao";
+    nội dung lạ mặc định vào Vận dụng để câu hỏi vẫn hiện ra trong file.
+    """
+    raw_muc_do = str(raw if raw is not None else "unknown").lower().strip()
+    if "cao" in raw_muc_do:
+        return "van_dung_cao"
+    if "dụng" in raw_muc_do or "dung" in raw_muc_do:
+        return "van_dung"
+    if "thông" in raw_muc_do or "thong" in raw_muc_do:
+        return "thong_hieu"
+    if "nhận" in raw_muc_do or "nhan" in raw_muc_do:
+        return "nhan_biet"
+    return "van_dung"
+
+
+# ---------------- Helper ép kiểu ----------------
+
+def _text(value, default: str = "") -> str:
+    if value is None:
+        return default
+    if isinstance(value, (list, tuple)):
+        return "\n".join(str(v) for v in value if v is not None)
+    return str(value)
+
+
+def _required_text(raw: Dict, key: str) -> str:
+    value = _text(raw.get(key)).strip()
+    if not value:
+        raise QuestionValidationError(f"thiếu '{key}'")
+    return value
+
+
+def _stt(raw: Dict) -> int:
+    try:
+        return int(str(raw.get("stt")).strip())
+    except (TypeError, ValueError):
+        raise QuestionValidationError(f"stt không hợp lệ: {raw.get('stt')!r}")
+
+
+def _list_of_dicts(raw: Dict, key: str) -> List[Dict]:
+    value = raw.get(key)
+    if not isinstance(value, list):
+        raise QuestionValidationError(f"'{key}' phải là danh sách")
+    items = [item for item in value if isinstance(item, dict)]
+    if len(items) != len(value):
+        raise QuestionValidationError(f"'{key}' có phần tử không phải object")
+    return items
+
+
+def _bool_or_none(value) -> Optional[bool]:
+    if value is None or isinstance(value, bool):
+        return value
+    text = str(value).strip().lower()
+    if text in ("true", "1", "đúng", "dung", "d", "đ"):
+        return True
+    if text in ("false", "0", "sai", "s"):
+        return False
+    return None
+
+
+# ---------------- Các thành phần ----------------
+
+@dataclass(slots=True)
+class ImageSpec:
+    co_hinh: bool = False
+    loai: str = "tu_mo_ta"
+    mo_ta: str = ""
+
+    @classmethod
+    def from_raw(cls, raw) -> Optional["ImageSpec"]:
+        if not isinstance(raw, dict):
+            return None
+        return cls(
+            co_hinh=bool(_bool_or_none(raw.get("co_hinh"))),
+            loai=_text(raw.get("loai"), "tu_mo_ta"),
+            mo_ta=_text(raw.get("mo_ta", raw.get("description", ""))).strip(),
+        )
+
+    def to_dict(self) -> Dict:
+        return {"co_hinh": self.co_hinh, "loai": self.loai, "mo_ta": self.mo_ta}
+
+
+@dataclass(slots=True)
+class AnswerOption:
+    ky_hieu: str
+    noi_dung: str
+
+
+@dataclass(slots=True)
+class Statement:
+    ky_hieu: str
+    noi_dung: str
+    dung: Optional[bool] = None
+
+
+@dataclass(slots=True)
+class StatementExplanation:
+    y: str = ""
+    noi_dung_y: str = ""
+    ket_luan: str = "SAI"
+    giai_thich: str = ""
+
+
+# ---------------- Câu hỏi ----------------
+
+@dataclass(slots=True)
+class BaseQuestion:
+    stt: int
+    muc_do: str
+    phan: str = ""
+    trich_dan: str = ""
+    nguon_trich_dan: str = ""
+    hinh_anh: Optional[ImageSpec] = None
+
+    @staticmethod
+    def _common(raw: Dict) -> Dict[str, Any]:
+        return {
+            "stt": _stt(raw),
+            "muc_do": normalize_muc_do(raw.get("muc_do")),
+            "phan": _text(raw.get("phan")).strip(),
+            "trich_dan": _text(raw.get("trich_dan")),
+            "nguon_trich_dan": _text(raw.get("nguon_trich_dan")),
+            "hinh_anh": ImageSpec.from_raw(raw.get("hinh_anh")),
+        }
+
+    @property
+    def has_image(self) -> bool:
+        return self.hinh_anh is not None and self.hinh_anh.co_hinh
+
+    def _common_dict(self) -> Dict:
+        data = {
+            "stt": self.stt,
+            "muc_do": self.muc_do,
+            "phan": self.phan,
+            "trich_dan": self.trich_dan,
+            "nguon_trich_dan": self.nguon_trich_dan,
+        }
+        data["hinh_anh"] = self.hinh_anh.to_dict() if self.hinh_anh else {"co_hinh": False}
+        return data
+
+
+@dataclass(slots=True)
+class MultipleChoiceQuestion(BaseQuestion):
+    noi_dung: str = ""
+    dap_an: Tuple[AnswerOption, ...] = ()
+    dap_an_dung: Optional[int] = None  # 1-based, None nếu AI không ghi
+    giai_thich: str = ""
+
+    @classmethod
+    def from_raw(cls, raw: Dict) -> "MultipleChoiceQuestion":
+        options = tuple(
+            AnswerOption(_text(item.get("ky_hieu")).strip(), _text(item.get("noi_dung")))
+            for item in _list_of_dicts(raw, "dap_an")
+        )
+        if len(options) < 2:
+            raise QuestionValidationError("cần ít nhất 2 đáp án")
+
+        dap_an_dung = None
+        if raw.get("dap_an_dung") not in (None, ""):
+            value = str(raw["dap_an_dung"]).strip().upper()
+            letters = [o.ky_hieu.upper() for o in options]
+            if value.isdigit():
+                dap_an_dung = int(value)
+            elif value in letters:
+                dap_an_dung = letters.index(value) + 1
+            if dap_an_dung is None or not 1 <= dap_an_dung <= len(options):
+                raise QuestionValidationError(f"dap_an_dung không khớp đáp án nào: {raw['dap_an_dung']!r}")
+
+        return cls(
+            **cls._common(raw),
+            noi_dung=_required_text(raw, "noi_dung"),
+            dap_an=options,
+            dap_an_dung=dap_an_dung,
+            giai_thich=_text(raw.get("giai_thich")),
+        )
+
+    @property
+    def correct_option(self) -> Optional[AnswerOption]:
+        return self.dap_an[self.dap_an_dung - 1] if self.dap_an_dung else None
+
+    def to_dict(self) -> Dict:
+        data = self._common_dict()
+        data["noi_dung"] = self.noi_dung
+        data["dap_an"] = [{"ky_hieu": o.ky_hieu, "noi_dung": o.noi_dung} for o in self.dap_an]
+        if self.dap_an_dung is not None:
+            data["dap_an_dung"] = self.dap_an_dung
+        data["giai_thich"] = self.giai_thich
+        return data
+
+
+@dataclass(slots=True)
+class TrueFalseQuestion(BaseQuestion):
+    doan_thong_tin: str = ""
+    cac_y: Tuple[Statement, ...] = ()
+    dap_an_dung_sai: str = ""
+    giai_thich: Union[str, Tuple[StatementExplanation, ...]] = ()
+
+    @classmethod
+    def from_raw(cls, raw: Dict) -> "TrueFalseQuestion":
+        statements = tuple(
+            Statement(_text(item.get("ky_hieu")).strip(), _text(item.get("noi_dung")), _bool_or_none(item.get("dung")))
+            for item in _list_of_dicts(raw, "cac_y")
+        )
+        if not statements:
+            raise QuestionValidationError("'cac_y' rỗng")
+
+        raw_giai_thich = raw.get("giai_thich")
+        if isinstance(raw_giai_thich, list):
+            giai_thich = tuple(
+                StatementExplanation(
+                    _text(gt.get("y")), _text(gt.get("noi_dung_y")),
+                    _text(gt.get("ket_luan"), "SAI"), _text(gt.get("giai_thich"))
+                )
+                for gt in raw_giai_thich if isinstance(gt, dict)
+            )
+        else:
+            giai_thich = _text(raw_giai_thich)
+
+        return cls(
+            **cls._common(raw),
+            doan_thong_tin=_text(raw.get("doan_thong_tin")),
+            cac_y=statements,
+            dap_an_dung_sai=_text(raw.get("dap_an_dung_sai")),
+            giai_thich=giai_thich,
+        )
+
+    def to_dict(self) -> Dict:
+        data = self._common_dict()
+        data["doan_thong_tin"] = self.doan_thong_tin
+        data["cac_y"] = [
+            {"ky_hieu": s.ky_hieu, "noi_dung": s.noi_dung, **({"dung": s.dung} if s.dung is not None else {})}
+            for s in self.cac_y
+        ]
+        data["dap_an_dung_sai"] = self.dap_an_dung_sai
+        if isinstance(self.giai_thich, str):
+            data["giai_thich"] = self.giai_thich
+        else:
+            data["giai_thich"] = [
+                {"y": gt.y, "noi_dung_y": gt.noi_dung_y, "ket_luan": gt.ket_luan, "giai_thich": gt.giai_thich}
+                for gt in self.giai_thich
+            ]
+        return data
+
+
+@dataclass(slots=True)
+class ShortAnswerQuestion(BaseQuestion):
+    noi_dung: str = ""
+    dap_an: str = ""
+    giai_thich: str = ""
+
+    @classmethod
+    def from_raw(cls, raw: Dict) -> "ShortAnswerQuestion":
+        return cls(
+            **cls._common(raw),
+            noi_dung=_required_text(raw, "noi_dung"),
+            dap_an=_required_text(raw, "dap_an"),
+            giai_thich=_text(raw.get("giai_thich")),
+        )
+
+    def to_dict(self) -> Dict:
+        data = self._common_dict()
+        data.update(noi_dung=self.noi_dung, dap_an=self.dap_an, giai_thich=self.giai_thich)
+        return data
+
+
+QUESTION_TYPES = {
+    "trac_nghiem_4_dap_an": MultipleChoiceQuestion,
+    "dung_sai": TrueFalseQuestion,
+    "tra_loi_ngan": ShortAnswerQuestion,
+}
+
+
+# ---------------- Đề ----------------
+
+@dataclass(slots=True)
+class Exam:
+    loai_de: str
+    tong_so_cau: int
+    questions: List[BaseQuestion] = field(default_factory=list)
+    quarantined: List[Dict] = field(default_factory=list)
+    extra: Dict = field(default_factory=dict)
+
+    def grouped(self) -> Dict[str, List[BaseQuestion]]:
+        """Nhóm theo mức độ (đã chuẩn hóa), mỗi nhóm sắp theo stt"""
+        groups: Dict[str, List[BaseQuestion]] = {}
+        for question in self.questions:
+            groups.setdefault(question.muc_do, []).append(question)
+        for questions in groups.values():
+            questions.sort(key=lambda q: q.stt)
+        return groups
+
+    def to_dict(self) -> Dict:
+        data = dict(self.extra)
+        data.update(loai_de=self.loai_de, tong_so_cau=self.tong_so_cau,
+                    cau_hoi=[q.to_dict() for q in self.questions])
+        if self.quarantined:
+            data[QUARANTINE_KEY] = list(self.quarantined)
+        return data
+
+
+def validate_exam(data: Dict, question_type: Optional[str] = None) -> Exam:
+    """
+    Kiểm tra toàn bộ đề: trả về Exam gồm câu hợp lệ + danh sách câu bị cách ly.
+    question_type: loại đề đã yêu cầu (dùng khi AI không ghi/ghi sai loai_de).
+    """
+    if not isinstance(data, dict):
+        raise QuestionValidationError("JSON gốc không phải object")
+
+    loai_de = _text(data.get("loai_de")).strip()
+    if loai_de not in QUESTION_TYPES:
+        loai_de = question_type if question_type in QUESTION_TYPES else "trac_nghiem_4_dap_an"
+    question_cls = QUESTION_TYPES[loai_de]
+
+    raw_questions = data.get("cau_hoi")
+    if not isinstance(raw_questions, list):
+        raw_questions = []
+
+    exam = Exam(
+        loai_de=loai_de,
+        tong_so_cau=0,
+        quarantined=list(data.get(QUARANTINE_KEY) or []),
+        extra={k: v for k, v in data.items() if k not in ("loai_de", "tong_so_cau", "cau_hoi", QUARANTINE_KEY)},
+    )
+    for index, raw in enumerate(raw_questions):
+        try:
+            if not isinstance(raw, dict):
+                raise QuestionValidationError("không phải object")
+            exam.questions.append(question_cls.from_raw(raw))
+        except QuestionValidationError as e:
+            stt = raw.get("stt") if isinstance(raw, dict) else None
+            exam.quarantined.append({"stt": stt, "vi_tri": index, "ly_do": str(e), "du_lieu": raw})
+            print(f"⚠️ Cách ly câu {stt if stt is not None else f'#{index + 1}'}: {e}")
+
+    try:
+        exam.tong_so_cau = int(data.get("tong_so_cau") or 0)
+    except (TypeError, ValueError):
+        exam.tong_so_cau = 0
+    if not exam.tong_so_cau:
+        exam.tong_so_cau = len(raw_questions)
+    return exam
+
+
+# ---------------- Bù câu thiếu ----------------
+
+def count_by_muc_do(questions) -> Dict[str, int]:
+    counts = {muc_do: 0 for muc_do in MUC_DO_ORDER}
+    for question in questions:
+        counts[question.muc_do] = counts.get(question.muc_do, 0) + 1
+    return counts
+
+
+_MUC_DO_PATTERNS = {
+    "nhan_biet": r"nh[ậa]n\s*bi[ếe]t",
+    "thong_hieu": r"th[ôo]ng\s*hi[ểe]u",
+    "van_dung_cao": r"v[ậa]n\s*d[ụu]ng\s*cao",
+    "van_dung": r"v[ậa]n\s*d[ụu]ng(?!\s*cao)",
+}
+_MUC_DO_COUNT_RES = {k: re.compile(p + r"\W{0,6}(\d+)\s*câu", re.IGNORECASE) for k, p in _MUC_DO_PATTERNS.items()}
+_MUC_DO_PERCENT_RES = {
+    k: (re.compile(p + r"\W{0,6}(\d+)\s*%", re.IGNORECASE), re.compile(r"(\d+)\s*%\W{0,6}" + p, re.IGNORECASE))
+    for k, p in _MUC_DO_PATTERNS.items()
+}
+
+
+def parse_muc_do_targets(prompt: str, total: int) -> Dict[str, int]:
+    """
+    Số câu yêu cầu theo mức độ đọc từ prompt: "NHẬN BIẾT (24 câu)" / "Thông hiểu (20 câu)",
+    không có thì theo tỉ lệ "Nhận biết (30%)" / "50% - Vận dụng" nhân với total.
+    Mức độ prompt không nhắc tới thì không có trong kết quả ({} nếu prompt không ghi gì).
+    """
+    targets = {}
+    for muc_do in MUC_DO_ORDER:
+        match = _MUC_DO_COUNT_RES[muc_do].search(prompt or "")
+        if match:
+            targets[muc_do] = int(match.group(1))
+            continue
+        for pattern in _MUC_DO_PERCENT_RES[muc_do]:
+            match = pattern.search(prompt or "")
+            if match and total:
+                targets[muc_do] = round(total * int(match.group(1)) / 100)
+                break
+    return targets
+
+
+def find_missing_questions(exam: Exam) -> Dict[int, str]:
+    """
+    Các stt còn thiếu (không có hoặc bị cách ly) trong 1..tong_so_cau -> mức độ dự kiến.
+    Mức độ lấy từ câu bị cách ly nếu có, ngược lại theo câu hợp lệ liền trước
+    (đề được sinh theo khối mức độ liên tiếp).
+    """
+    present = {q.stt: q.muc_do for q in exam.questions}
+    hinted = {}
+    for item in exam.quarantined:
+        raw = item.get("du_lieu")
+        if isinstance(raw, dict) and isinstance(item.get("stt"), int) and raw.get("muc_do"):
+            hinted[item["stt"]] = normalize_muc_do(raw.get("muc_do"))
+
+    missing = {}
+    previous = MUC_DO_ORDER[0]
+    for stt in range(1, exam.tong_so_cau + 1):
+        if stt in present:
+            previous = present[stt]
+        else:
+            missing[stt] = hinted.get(stt, previous)
+    return missing
+
+
+def merge_filled_questions(exam: Exam, filled: Exam, wanted) -> List[int]:
+    """Gộp các câu của 'filled' có stt nằm trong 'wanted' vào exam. Trả về các stt đã bù."""
+    wanted = set(wanted)
+    existing = {q.stt for q in exam.questions}
+    merged = []
+    for question in filled.questions:
+        if question.stt in wanted and question.stt not in existing:
+            exam.questions.append(question)
+            existing.add(question.stt)
+            merged.append(question.stt)
+    if merged:
+        done = set(merged)
+        exam.quarantined = [item for item in exam.quarantined if item.get("stt") not in done]
+        exam.questions.sort(key=lambda q: q.stt)
+    return sorted(merged)
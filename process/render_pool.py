@@ -0,0 +1,87 @@
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FutureTimeout
+from typing import Dict, Optional
+
+from process.cancellation import CancellationToken, OperationCancelled
+from process.metrics import TaskMetrics, bind, current
+
+# ============================================================
+# RENDER DOCX BẰNG ĐA TIẾN TRÌNH (THOÁT KHỎI GIL)
+# ============================================================
+#
+# DynamicDocxRenderer / process_text_with_latex thuần Python + lxml nên các luồng
+# render tranh nhau GIL. Ở chế độ này, stage render+save chạy trong ProcessPoolExecutor:
+# chỉ gửi dict câu hỏi đã parse sang tiến trình con và nhận lại đường dẫn file.
+# Tiến trình con sống suốt phiên chạy nên cache OMML / ảnh trong response2docx luôn "ấm".
+
+_worker_cancel_token: Optional[CancellationToken] = None
+
+
+def _init_worker(cancel_event):
+    """Chạy một lần khi tiến trình con khởi động: import sẵn thư viện nặng"""
+    global _worker_cancel_token
+    _worker_cancel_token = CancellationToken(cancel_event)
+    import process.response2docx  # noqa: F401  (nạp docx/lxml một lần)
+
+
+def _warmup():
+    return os.getpid()
+
+
+def _render_and_save(data: Dict, batch_name: str, file_name: str, output_root: Optional[str]):
+    """Trả về (đường dẫn, metrics đo trong tiến trình con) để tiến trình cha gộp lại"""
+    from process.response2docx import render_and_save
+    with bind(TaskMetrics()) as metrics:
+        output_path = render_and_save(data, batch_name, file_name, output_root, _worker_cancel_token)
+    return output_path, metrics.to_dict()
+
+
+def default_process_count() -> int:
+    return max(1, (os.cpu_count() or 2) - 1)
+
+
+class RenderProcessPool:
+    """Pool tiến trình render; hủy từ luồng chính được chuyển sang tiến trình con qua Event"""
+
+    def __init__(self, workers: Optional[int] = None, cancel_token: Optional[CancellationToken] = None):
+        self.workers = workers or default_process_count()
+        self.cancel_token = cancel_token
+        # spawn: giống hành vi trên Windows và an toàn với luồng đang chạy ở tiến trình cha
+        ctx = multiprocessing.get_context("spawn")
+        self._cancel_event = ctx.Event()
+        self._executor = ProcessPoolExecutor(
+            max_workers=self.workers, mp_context=ctx,
+            initializer=_init_worker, initargs=(self._cancel_event,)
+        )
+        if cancel_token is not None:
+            cancel_token.add_callback(self._cancel_event.set)
+
+    def warm_up(self):
+        """Khởi động sẵn toàn bộ tiến trình con để task đầu tiên không phải chờ import"""
+        futures = [self._executor.submit(_warmup) for _ in range(self.workers)]
+        pids = {f.result() for f in futures}
+        print(f"🔥 Đã khởi động {len(pids)} tiến trình render")
+        return self
+
+    def render_and_save(self, data: Dict, batch_name: str, file_name: str,
+                        output_root: Optional[str] = None, poll_interval: float = 0.2) -> str:
+        """Gửi dict sang tiến trình con, chờ đường dẫn output (có kiểm tra hủy)"""
+        future = self._executor.submit(_render_and_save, data, batch_name, file_name, output_root)
+        while True:
+            if self.cancel_token is not None and self.cancel_token.is_cancelled:
+                future.cancel()
+                raise OperationCancelled()
+            try:
+                output_path, child_metrics = future.result(timeout=poll_interval)
+            except FutureTimeout:
+                continue
+            metrics = current()
+            if metrics is not None:
+                metrics.merge(child_metrics)
+            return output_path
+
+    def shutdown(self):
+        if self.cancel_token is not None:
+            self.cancel_token.remove_callback(self._cancel_event.set)
+        self._executor.shutdown(wait=True, cancel_futures=True)
@@ -14,10 +14,63 @@ import subprocess
 import re
 from tempfile import NamedTemporaryFile
 from docx.oxml import parse_xml
+from docx.oxml.ns import nsdecls
+from docx.text.paragraph import Paragraph
+from copy import deepcopy
 import traceback
+from process.cancellation import raise_if_cancelled, run_subprocess_cancellable
+from process.metrics import timed, add_value
+from process.pdf_text import prepare_model_input
+from process.question_model import (
+    Exam, BaseQuestion, MultipleChoiceQuestion, TrueFalseQuestion, ShortAnswerQuestion, ImageSpec,
+    MUC_DO_ORDER, QUARANTINE_KEY, QuestionValidationError, normalize_muc_do, validate_exam,
+    count_by_muc_do, find_missing_questions, merge_filled_questions, parse_muc_do_targets
+)
 
-_FILE_LOCK = threading.RLock()
-_OUTPUT_DIR_LOCK = threading.RLock()
+# Khóa theo từng file đích (không dùng khóa toàn cục): các file khác nhau lưu song song
+_PATH_LOCKS: Dict[str, threading.Lock] = {}
+_PATH_LOCKS_GUARD = threading.Lock()
+
+# Đề từ chừng này câu trở lên được render bằng StreamingDocument (bộ nhớ không tăng theo số câu)
+STREAMING_MIN_QUESTIONS = int(os.getenv("STREAMING_MIN_QUESTIONS", "150"))
+
+# Bù câu thiếu: số lần gọi bổ sung tối đa và tỉ lệ thiếu tối đa còn đáng để bù (0 = tắt)
+GAP_FILL_ROUNDS = int(os.getenv("GAP_FILL_ROUNDS", "1"))
+GAP_FILL_MAX_RATIO = float(os.getenv("GAP_FILL_MAX_RATIO", "0.5"))
+
+class LruCache:
+    """Cache LRU có giới hạn, thread-safe (sống theo tiến trình - worker càng chạy lâu càng 'ấm')"""
+    def __init__(self, max_size: int = 2048):
+        from collections import OrderedDict
+        self.max_size = max_size
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self._lock:
+            if key in self._data:
+                self._data.move_to_end(key)
+                self.hits += 1
+                return self._data[key]
+            self.misses += 1
+            return None
+
+    def put(self, key, value):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def __len__(self):
+        return len(self._data)
+
+# LaTeX -> OMML (tránh gọi pandoc lại cho công thức đã gặp)
+_OMML_CACHE = LruCache(4096)
+# Mô tả hình -> bytes ảnh đã sinh (giới hạn nhỏ vì ảnh nặng)
+_IMAGE_CACHE = LruCache(64)
 
 def get_app_path():
     """Lấy đường dẫn chứa file .exe hoặc script"""
@@ -49,7 +102,7 @@ def find_pandoc_executable():
     print("❌ KHÔNG TÌM THẤY PANDOC!")
     return None
 
-def latex_to_omml_via_pandoc(latex_math_dollar):
+def latex_to_omml_via_pandoc(latex_math_dollar, cancel_token=None):
     """Chuyển đổi LaTeX sang OMML qua Pandoc"""
     pandoc_exe = find_pandoc_executable()
     
@@ -57,6 +110,12 @@ def latex_to_omml_via_pandoc(latex_math_dollar):
         print("❌ Pandoc không khả dụng, bỏ qua equation")
         return None
     
+    cached = _OMML_CACHE.get(latex_math_dollar.strip())
+    if cached is not None:
+        add_value("pandoc_cache_hits")
+        return cached
+    
+    temp_path = None
     try:
         # Chuẩn hóa input (loại bỏ ký tự lạ)
         latex_clean = latex_math_dollar.strip()
@@ -65,16 +124,17 @@ def latex_to_omml_via_pandoc(latex_math_dollar):
         with NamedTemporaryFile(mode='w', suffix=".docx", delete=False, encoding='utf-8') as temp_docx:
             temp_path = temp_docx.name
         
-        # Chạy Pandoc với error handling tốt hơn
-        result = subprocess.run(
-            [pandoc_exe, '--from=latex', '--to=docx', '-o', temp_path],
-            input=latex_clean,
-            text=True,
-            encoding='utf-8',
-            capture_output=True,
-            timeout=10,  # Timeout 10s để tránh treo
-            creationflags=subprocess.CREATE_NO_WINDOW if hasattr(subprocess, 'CREATE_NO_WINDOW') else 0
-        )
+        # Chạy Pandoc với error handling tốt hơn (bị kill ngay nếu người dùng bấm dừng)
+        with timed("pandoc"):
+            result = run_subprocess_cancellable(
+                [pandoc_exe, '--from=latex', '--to=docx', '-o', temp_path],
+                input=latex_clean,
+                text=True,
+                encoding='utf-8',
+                timeout=10,  # Timeout 10s để tránh treo
+                cancel_token=cancel_token,
+                creationflags=subprocess.CREATE_NO_WINDOW if hasattr(subprocess, 'CREATE_NO_WINDOW') else 0
+            )
  
         if result.returncode != 0:
             error_msg = result.stderr.strip() if result.stderr else "Unknown error"
@@ -97,12 +157,6 @@ def latex_to_omml_via_pandoc(latex_math_dollar):
         with zipfile.ZipFile(temp_path, 'r') as z:
             xml_content = z.read('word/document.xml').decode('utf-8')
         
-        # Dọn dẹp file tạm
-        try:
-            os.remove(temp_path)
-        except:
-            pass
-       
         # Tìm equation XML
         match = re.search(r'(<m:oMath[^>]*>.*?</m:oMath>)', xml_content, re.DOTALL)
         
@@ -110,6 +164,7 @@ def latex_to_omml_via_pandoc(latex_math_dollar):
             print(f"⚠️ Không tìm thấy equation trong output: {latex_clean[:30]}...")
             return None
             
+        _OMML_CACHE.put(latex_clean, match.group(1))
         return match.group(1)
    
     except subprocess.TimeoutExpired:
@@ -120,10 +175,121 @@ def latex_to_omml_via_pandoc(latex_math_dollar):
         import traceback
         traceback.print_exc()
         return None
+    finally:
+        # Dọn dẹp file tạm (cả khi Pandoc lỗi, timeout hay người dùng bấm dừng)
+        if temp_path:
+            try:
+                os.remove(temp_path)
+            except OSError:
+                pass
 
 
 
-def process_text_with_latex(text, paragraph, bold=False):
+# ============================================================================
+# TÁCH TEXT / LATEX VÀ KHUÔN ĐOẠN VĂN DỰNG SẴN
+# ============================================================================
+#
+# Regex được compile một lần; mỗi trường text chỉ qua 1 lượt làm sạch HTML + 1 lượt tách LaTeX.
+# Với python-docx, run/đoạn văn được deepcopy từ phần tử mẫu rồi gắn thẳng vào cây XML,
+# tránh add_paragraph/add_run/bold (mỗi lệnh đều dò vị trí chèn qua xmlchemy).
+
+# <br> -> xuống dòng; thẻ định dạng rồi &nbsp;, &lt;, &gt; -> bỏ. Từng lượt theo đúng thứ tự bản gốc
+# (gộp một lượt thì chuỗi kiểu "&<b>lt;", "<b<br>>", "&&nbsp;lt;" ra kết quả khác)
+_HTML_BR_RE = re.compile(r'<[bB]r/?>')
+_HTML_TAG_RE = re.compile(r'</?(?:div|p|u|span|font|i|b)\b[^>]*>')
+_LATEX_SPLIT_RE = re.compile(r'(\$[^$]+\$|\\\[.*?\\\])')
+_LEADING_SLASH_RE = re.compile(r'^\s*/')
+
+def tokenize_latex_text(text: str) -> List[tuple]:
+    """
+    Tách text thành các token (is_math, nội dung):
+    - (False, text đã làm sạch)
+    - (True, công thức gốc dạng $...$ hoặc \\[...\\])
+    """
+    text = _HTML_TAG_RE.sub('', _HTML_BR_RE.sub('\n', text))
+    text = text.replace("&nbsp;", "").replace("&lt;", "").replace("&gt;", "")
+    tokens = []
+    for index, part in enumerate(_LATEX_SPLIT_RE.split(text)):
+        if not part:
+            continue
+        # re.split với 1 nhóm bắt: phần tử lẻ là công thức. Phần tử chẵn mở bằng $ hoặc \[ mà không
+        # đóng (VD \[ ... \] qua nhiều dòng: '.' không khớp xuống dòng) vẫn coi là công thức như bản gốc
+        if index % 2 or part.startswith('$') or part.startswith('\\['):
+            tokens.append((True, part))
+        else:
+            part = _LEADING_SLASH_RE.sub('', part)
+            if part:
+                tokens.append((False, part))
+    return tokens
+
+_RUN_TEMPLATES = {
+    False: parse_xml(f'<w:r {nsdecls("w")}><w:t xml:space="preserve"/></w:r>'),
+    True: parse_xml(f'<w:r {nsdecls("w")}><w:rPr><w:b/></w:rPr><w:t xml:space="preserve"/></w:r>'),
+}
+
+def append_text_run(paragraph, text: str, bold: bool = False):
+    """Thêm run text vào paragraph (nhanh với python-docx, fallback add_run cho backend khác)"""
+    p_element = getattr(paragraph, "_p", None)
+    if p_element is None or "\n" in text or "\t" in text:
+        # Backend khác (StreamingDocument) hoặc text cần <w:br/>/<w:tab/> -> để add_run xử lý
+        run = paragraph.add_run(text)
+        if bold:
+            run.bold = True
+        return
+    r_element = deepcopy(_RUN_TEMPLATES[bool(bold)])
+    r_element[-1].text = text
+    p_element.append(r_element)
+
+class ParagraphTemplate:
+    """
+    Đoạn văn cố định của đề (VD: "Câu N.", "Lời giải", "####") dựng sẵn một lần.
+    runs: danh sách (format, bold); giá trị biến đổi được điền bằng str.format(*values).
+    """
+    def __init__(self, *runs):
+        self.runs = runs
+        xml_runs = "".join(
+            '<w:r>' + ('<w:rPr><w:b/></w:rPr>' if bold else '') + '<w:t xml:space="preserve"/></w:r>'
+            for _, bold in runs
+        )
+        self._element = parse_xml(f'<w:p {nsdecls("w")}>{xml_runs}</w:p>')
+
+    def add_to(self, doc, *values):
+        """Thêm đoạn văn vào cuối document, trả về paragraph để nối tiếp run"""
+        texts = [fmt.format(*values) for fmt, _ in self.runs]
+        body = getattr(getattr(doc, "element", None), "body", None)
+        if body is None:
+            paragraph = doc.add_paragraph()
+            for text, (_, bold) in zip(texts, self.runs):
+                run = paragraph.add_run(text)
+                if bold:
+                    run.bold = True
+            return paragraph
+
+        p_element = deepcopy(self._element)
+        for r_element, text in zip(p_element, texts):
+            r_element[-1].text = text
+        # Chèn trước sectPr (giống add_paragraph) mà không dò lại vị trí qua xmlchemy
+        sect_pr = body.sectPr
+        if sect_pr is not None:
+            sect_pr.addprevious(p_element)
+        else:
+            body.append(p_element)
+        return Paragraph(p_element, doc._body)
+
+# Khuôn đoạn văn dùng chung cho 3 dạng đề
+TPL_CAU_PREFIX = ParagraphTemplate(("Câu {0}. ", True))
+TPL_CAU_PREFIX_DS = ParagraphTemplate(("Câu {0}.", True))
+TPL_DAP_AN = ParagraphTemplate(("{0}. ", False))
+TPL_Y_DUNG_SAI = ParagraphTemplate(("{0}) ", False))
+TPL_LOI_GIAI = ParagraphTemplate(("Lời giải", True))
+TPL_SEPARATOR = ParagraphTemplate(("####", False))
+TPL_DAP_AN_DUNG = ParagraphTemplate(("{0}", True))
+TPL_KET_LUAN = ParagraphTemplate(("Vậy đáp án đúng là: ", True))
+TPL_DAP_AN_TLN = ParagraphTemplate(("Đáp án: ", True))
+TPL_GIAI_THICH_Y = ParagraphTemplate(('+) "', False))
+TPL_EMPTY = ParagraphTemplate()
+
+def process_text_with_latex(text, paragraph, bold=False, cancel_token=None):
     """
     Xử lý text có công thức LaTeX
     VERSION ỔN ĐỊNH - Copy từ test_res.py (KHÔNG có repair_broken_latex)
@@ -131,45 +297,27 @@ def process_text_with_latex(text, paragraph, bold=False):
     if not text:
         return
     
-    # Làm sạch HTML tags
-    text = text.replace("<br>", "\n").replace("<br/>", "\n") \
-               .replace("<Br>", "\n").replace("<Br/>", "\n")
-    text = re.sub(r'</?(div|p|u|span|font|i|b)\b[^>]*>', '', text)
-    text = text.replace("&nbsp;", "").replace("&lt;", "").replace("&gt;", "")
-    
-    # Tách text và LaTeX
-    pattern = r'(\$[^$]+\$|\\\[.*?\\\])'
-    parts = re.split(pattern, text)
-    
-    for part in parts:
-        if not part:
-            continue
-        
+    for is_math, part in tokenize_latex_text(text):
         # Phần LaTeX
-        if part.startswith('$') or part.startswith('\\['):
+        if is_math:
             try:
                 latex_expr = clean_latex_math(part)
-                insert_equation_into_paragraph(latex_expr, paragraph)
+                insert_equation_into_paragraph(latex_expr, paragraph, cancel_token)
             except Exception as e:
                 # Fallback: thêm text thuần
-                run = paragraph.add_run(part)
-                if bold:
-                    run.bold = True
+                append_text_run(paragraph, part, bold)
         # Phần text thường
         else:
-            cleaned_part = re.sub(r'^\s*/', '', part)
-            run = paragraph.add_run(cleaned_part)
-            if bold:
-                run.bold = True
+            append_text_run(paragraph, part, bold)
 
 
-def insert_equation_into_paragraph(latex_math_dollar, paragraph):
+def insert_equation_into_paragraph(latex_math_dollar, paragraph, cancel_token=None):
     """Chèn công thức toán học vào paragraph"""
-    omml_str = latex_to_omml_via_pandoc(latex_math_dollar)
+    omml_str = latex_to_omml_via_pandoc(latex_math_dollar, cancel_token)
     
     if not omml_str:
         # Fallback: Thêm text thuần nếu không convert được
-        paragraph.add_run(f" [{latex_math_dollar}] ")
+        append_text_run(paragraph, f" [{latex_math_dollar}] ")
         return
     
     # Thêm namespace nếu thiếu
@@ -181,82 +329,162 @@ def insert_equation_into_paragraph(latex_math_dollar, paragraph):
             count=1
         )
     
+    # StreamingDocument: ghi thẳng chuỗi OMML, bỏ qua bước parse bằng lxml
+    if hasattr(paragraph, "add_omml"):
+        paragraph.add_omml(omml_str)
+        return
+    
     try:
         omml_element = parse_xml(omml_str)
         run = paragraph.add_run()
         run._r.append(omml_element)
     except Exception as e:
         print(f"Lỗi chèn equation: {e}")
-        paragraph.add_run(f" [{latex_math_dollar}] ")
+        append_text_run(paragraph, f" [{latex_math_dollar}] ")
 
 
-def clean_latex_math(latex_raw):
-    latex_raw = re.sub(r'\\/', '', latex_raw)
-    latex_raw = re.sub(r'\\operatorname\s*{\s*([^}]*)\s*}',
-                       lambda m: m.group(1).replace(' ', ''), latex_raw)
-    latex_raw = re.sub(r'\\root\s*(\d+)\s*{([^}]*)}', r'\\sqrt[\1]{\2}', latex_raw)
-    latex_raw = re.sub(r'\\root\s*{(\d+)}\s*\\of\s*{([^}]*)}', r'\\sqrt[\1]{\2}', latex_raw)
-    latex_raw = re.sub(r'\\root\s*(\d+)\s*\\sqrt\s*{([^}]*)}', r'\\sqrt[\1]{\2}', latex_raw)
-    latex_raw = re.sub(r'([a-zA-Z])\s*\\frac\s*{([^}]+)}\s*{([^}]+)}',
-                       r'\1^{\\frac{\2}{\3}}', latex_raw)
-    latex_raw = re.sub(r'\\sp\s*{([^}]*)}', r'^{\1}', latex_raw)
-    latex_raw = re.sub(r'{\\bf\s*([^}]*)}', r'\1', latex_raw)
-    latex_raw = re.sub(r'\\\s*log', r'\\log', latex_raw)
-    latex_raw = re.sub(r'\\bigskip', '', latex_raw)
-    latex_raw = re.sub(r'\\nonumber', '', latex_raw)
-    latex_raw = latex_raw.replace(r'\?', '?')
-    latex_raw = re.sub(r'\\cdot\s*(?=\w)', r'\\cdot ', latex_raw)
-    latex_raw = latex_raw.replace(r'\dotstan', r'\cdot \tan')
-    latex_raw = re.sub(r'(?<!\\)(\bln\b|\blog\b|\bsin\b|\bcos\b|\btan\b|\blog_{?\d*}?)',
-                       r'\\\1', latex_raw)
-    latex_raw = re.sub(r'(\\Leftrightarrow|\\Rightarrow|\\rightarrow)(?=\w)', r'\1 ', latex_raw)
-    latex_raw = latex_raw.replace(r'\\n', r'\n')
-    
+# ============================================================================
+# CHUẨN HÓA CÔNG THỨC LATEX (LUẬT COMPILE SẴN + CACHE)
+# ============================================================================
+#
+# Mỗi luật: (tên, chuỗi bắt buộc phải có để luật khớp được, pattern, thay thế).
+# Thứ tự giữ nguyên như chuỗi re.sub cũ (luật sau chạy trên kết quả luật trước). Các luật
+# không gộp thành một regex được mà vẫn giống hệt kết quả, nên thay vào đó mỗi luật có
+# "guard": công thức không chứa chuỗi đó thì bỏ qua luật (phép `in` chạy trong C),
+# một công thức thường chỉ phải chạy 2-4 regex thay vì ~17.
+# Kết quả nhớ theo công thức gốc: đề lặp lại \frac, \sqrt... nhiều lần chỉ tốn một lần tra cache.
+
+def _operatorname_repl(match):
+    return match.group(1).replace(' ', '')
+
+_LATEX_RULES = [
+    ("bo_slash", ('\\/',), re.compile(r'\\/'), ''),
+    ("operatorname", ('\\operatorname',), re.compile(r'\\operatorname\s*{\s*([^}]*)\s*}'), _operatorname_repl),
+    ("root_n", ('\\root',), re.compile(r'\\root\s*(\d+)\s*{([^}]*)}'), r'\\sqrt[\1]{\2}'),
+    ("root_of", ('\\root',), re.compile(r'\\root\s*{(\d+)}\s*\\of\s*{([^}]*)}'), r'\\sqrt[\1]{\2}'),
+    ("root_sqrt", ('\\root',), re.compile(r'\\root\s*(\d+)\s*\\sqrt\s*{([^}]*)}'), r'\\sqrt[\1]{\2}'),
+    ("frac_mu", ('\\frac',), re.compile(r'([a-zA-Z])\s*\\frac\s*{([^}]+)}\s*{([^}]+)}'), r'\1^{\\frac{\2}{\3}}'),
+    ("sp", ('\\sp',), re.compile(r'\\sp\s*{([^}]*)}'), r'^{\1}'),
+    ("bf", ('{\\bf',), re.compile(r'{\\bf\s*([^}]*)}'), r'\1'),
+    ("log_cach", ('log',), re.compile(r'\\\s*log'), r'\\log'),
+    ("bigskip", ('\\bigskip',), re.compile(r'\\bigskip'), ''),
+    ("nonumber", ('\\nonumber',), re.compile(r'\\nonumber'), ''),
+    ("hoi", ('\\?',), None, '?'),
+    ("cdot", ('\\cdot',), re.compile(r'\\cdot\s*(?=\w)'), r'\\cdot '),
+    ("dotstan", ('\\dotstan',), None, r'\cdot \tan'),
+    ("ham_thieu_slash", ('ln', 'log', 'sin', 'cos', 'tan'),
+     re.compile(r'(?<!\\)(\bln\b|\blog\b|\bsin\b|\bcos\b|\btan\b|\blog_{?\d*}?)'), r'\\\1'),
+    ("mui_ten", ('ightarrow',), re.compile(r'(\\Leftrightarrow|\\Rightarrow|\\rightarrow)(?=\w)'), r'\1 '),
+    ("xuong_dong", ('\\\\n',), None, r'\n'),
+]
+
+# Công thức gốc -> công thức đã chuẩn hóa
+_LATEX_CACHE = LruCache(8192)
+# LATEX_TRACE=1: in các luật đã áp dụng cho mỗi công thức mới (chưa có trong cache)
+LATEX_TRACE = os.getenv("LATEX_TRACE", "") == "1"
+
+
+def _apply_latex_rules(latex_raw, trace=None):
+    for name, guards, pattern, repl in _LATEX_RULES:
+        if not any(guard in latex_raw for guard in guards):
+            continue
+        if pattern is None:
+            # Luật thay chuỗi cố định: guard chính là chuỗi cần thay
+            result = latex_raw.replace(guards[0], repl)
+        else:
+            result = pattern.sub(repl, latex_raw)
+        if trace is not None and result != latex_raw:
+            trace.append((name, latex_raw, result))
+        latex_raw = result
+
     latex_raw = latex_raw.strip()
     # ✅ KHÁC BIỆT: Version cũ KHÔNG replace \n và \r
     # latex_raw = latex_raw.replace('\n', ' ').replace('\r', '')  # ← XÓA DÒNG NÀY
-    
+
     if not (latex_raw.startswith('$') and latex_raw.endswith('$')):
         latex_raw = f"${latex_raw}$"
-    
+
     return latex_raw
 
-def ensure_output_folder_for_batch(batch_name):
-    """Tạo folder riêng cho batch"""
-    base_path = get_app_path()
-    output_base = os.path.join(base_path, "output")
+
+def clean_latex_math(latex_raw):
+    cleaned = _LATEX_CACHE.get(latex_raw)
+    if cleaned is None:
+        cleaned = trace_latex_math(latex_raw)[0] if LATEX_TRACE else _apply_latex_rules(latex_raw)
+        _LATEX_CACHE.put(latex_raw, cleaned)
+    return cleaned
+
+
+def trace_latex_math(latex_raw):
+    """
+    Chạy chuẩn hóa (không qua cache) và in từng luật đã làm thay đổi công thức.
+    Trả về (kết quả, [(tên luật, trước, sau), ...]) - dùng khi soi công thức bị đổi sai.
+    """
+    trace = []
+    cleaned = _apply_latex_rules(latex_raw, trace)
+    for name, before, after in trace:
+        print(f"🔎 {name}: {before!r} -> {after!r}")
+    return cleaned, trace
+
+def ensure_output_folder_for_batch(batch_name, output_root=None):
+    """Tạo folder riêng cho batch (output_root: thư mục output dùng chung, mặc định <app>/output)"""
+    if output_root:
+        output_base = output_root
+    else:
+        output_base = os.path.join(get_app_path(), "output")
     batch_folder = os.path.join(output_base, batch_name)
-    
-    with _OUTPUT_DIR_LOCK:
-        os.makedirs(output_base, exist_ok=True)
-        os.makedirs(batch_folder, exist_ok=True)
-    
+    # makedirs(exist_ok=True) đã an toàn khi nhiều luồng cùng tạo
+    os.makedirs(batch_folder, exist_ok=True)
     return batch_folder
 
-def save_document_securely(doc, batch_name, file_name):
-    """Lưu file DOCX với thread-safety"""
-    batch_folder = ensure_output_folder_for_batch(batch_name)
+def _lock_for_path(path: str) -> threading.Lock:
+    key = os.path.normcase(os.path.abspath(path))
+    with _PATH_LOCKS_GUARD:
+        lock = _PATH_LOCKS.get(key)
+        if lock is None:
+            lock = _PATH_LOCKS[key] = threading.Lock()
+        return lock
+
+def save_document_securely(doc, batch_name, file_name, output_root=None):
+    """
+    Lưu file DOCX nguyên tử: ghi ra file tạm trong cùng thư mục batch rồi os.replace.
+    Người đọc không bao giờ thấy file .docx ghi dở; chỉ các lần lưu cùng đích mới phải chờ nhau.
+    """
+    batch_folder = ensure_output_folder_for_batch(batch_name, output_root)
     if not batch_folder:
         return None
 
     output_path = os.path.join(batch_folder, f"{file_name}.docx")
-    
-    with _FILE_LOCK:
-        max_retries = 3
-        for retry_count in range(max_retries):
-            try:
-                doc.save(output_path)
-                if os.path.exists(output_path):
+    max_retries = 3
+
+    try:
+        with _lock_for_path(output_path):
+            for retry_count in range(max_retries):
+                # Tên tạm không có đuôi .docx để không lọt vào danh sách file kết quả
+                tmp_path = f"{output_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+                try:
+                    with timed("save"):
+                        doc.save(tmp_path)
+                        # Windows: os.replace lỗi nếu file đích đang mở trong Word -> thử lại
+                        os.replace(tmp_path, output_path)
                     file_size = os.path.getsize(output_path)
                     print(f"✅ Đã lưu file: {output_path} ({file_size} bytes)")
                     return output_path
-            except Exception as e:
-                print(f"⚠️ Lỗi lưu file lần {retry_count + 1}: {e}")
-                if retry_count < max_retries - 1:
-                    time.sleep(0.5)
-        
-        print(f"❌ Không thể lưu file sau {max_retries} lần thử")
-        return None
+                except Exception as e:
+                    print(f"⚠️ Lỗi lưu file lần {retry_count + 1}: {e}")
+                    try:
+                        os.remove(tmp_path)
+                    except OSError:
+                        pass
+                    if retry_count < max_retries - 1:
+                        time.sleep(0.5)
+    finally:
+        # StreamingDocument giữ file tạm trên đĩa -> dọn ngay sau khi lưu
+        if hasattr(doc, "close"):
+            doc.close()
+
+    print(f"❌ Không thể lưu file sau {max_retries} lần thử")
+    return None
 
 def clean_json_string(text: str) -> str:
     if not text:
@@ -286,7 +514,7 @@ def clean_json_string(text: str) -> str:
     # Trường hợp tệ nhất: Trả về nguyên gốc để các hàm repair (AI sửa lỗi) xử lý tiếp
     return text
 
-def repair_json_with_ai(broken_json_str: str, client) -> str:
+def repair_json_with_ai(broken_json_str: str, client, cancel_token=None) -> str:
     """Gửi JSON lỗi cho AI sửa"""
     print("⚠️ JSON lỗi. Đang yêu cầu AI sửa...")
     prompt_fix = f"""
@@ -300,86 +528,82 @@ NHIỆM VỤ:
 3. KHÔNG thay đổi công thức LaTeX (giữ nguyên \\frac, \\sqrt...)
 4. CHỈ TRẢ VỀ JSON ĐÃ SỬA (không markdown, không giải thích)
     """
-    repaired_text = client.send_data_to_check(prompt_fix)
+    repaired_text = client.send_data_to_check(prompt_fix, cancel_token=cancel_token)
     return clean_json_string(repaired_text)
+
+
+# Chuỗi JSON "..." : (không phải " hoặc \) HOẶC (\ theo sau bất kỳ ký tự nào, trừ xuống dòng)
+_JSON_STRING_RE = re.compile(r'"((?:[^"\\]|\\.)*)"')
+# Escape JSON hợp lệ (\\, \", \/, \b, \f, \n, \r, \t, \uXXXX) hoặc một backslash lẻ
+_JSON_ESCAPE_OR_BARE_RE = re.compile(r'\\(?:[\\"/bfnrt]|u[0-9A-Fa-f]{4})?')
+# Backslash lẻ (KHÔNG mở đầu escape hợp lệ) - chỉ đúng khi nội dung không có "\\"
+_BARE_BACKSLASH_RE = re.compile(r'\\(?![\\"/bfnrt]|u[0-9A-Fa-f]{4})')
+
+
+def _escape_bare_backslash(match) -> str:
+    escape = match.group()
+    return escape if len(escape) > 1 else '\\\\'
+
+
+def _fix_json_string_content(content: str) -> str:
+    """Nội dung một chuỗi JSON (không gồm dấu "): giữ escape hợp lệ, backslash còn lại -> \\\\"""
+    if '\\\\' in content:
+        # Có "\\" thì phải quét từ trái sang để ghép cặp đúng (\\\frac = \\ + \frac)
+        return _JSON_ESCAPE_OR_BARE_RE.sub(_escape_bare_backslash, content)
+    return _BARE_BACKSLASH_RE.sub(r'\\\\', content)
+
+
+def _fix_json_string_match(match) -> str:
+    content = match.group(1)
+    if '\\' not in content:
+        return match.group(0)
+    return '"' + _fix_json_string_content(content) + '"'
+
+
 def sanitize_latex_json(text: str) -> str:
     """
     Sanitize JSON chứa LaTeX một cách AN TOÀN
-    
+
     Chiến lược:
     1. Chỉ xử lý BÊN TRONG chuỗi JSON (giữa dấu ngoặc kép)
     2. Giữ nguyên phần cấu trúc JSON (keys, colons, brackets)
     3. Escape backslash KHÔNG phải JSON escape hợp lệ
+
+    Thay vì duyệt từng ký tự bằng Python: cắt theo dấu " (str.split chạy trong C), ghép lại
+    các mảnh có " bị escape, và chỉ chạy regex trên những chuỗi có chứa backslash.
+    Kết quả giống hệt cách quét bằng _JSON_STRING_RE.
     """
-    
-    # Danh sách escape sequences hợp lệ trong JSON spec
-    VALID_JSON_ESCAPES = {
-        '\\\\', '\\"', '\\/', '\\b', '\\f', '\\n', '\\r', '\\t'
-    }
-    
-    def fix_string_content(match):
-        """
-        Xử lý nội dung BÊN TRONG chuỗi JSON (giữa dấu ngoặc kép)
-        match.group(0) = toàn bộ "..." (có dấu ")
-        match.group(1) = nội dung giữa dấu " (không có dấu ")
-        """
-        full_match = match.group(0)
-        content = match.group(1)
-        
-        # Nếu chuỗi rỗng, giữ nguyên
-        if not content:
-            return full_match
-        
-        result = []
-        i = 0
-        
-        while i < len(content):
-            char = content[i]
-            
-            if char == '\\':
-                # Kiểm tra có phải escape hợp lệ không
-                if i + 1 < len(content):
-                    next_char = content[i + 1]
-                    two_chars = char + next_char
-                    
-                    # Trường hợp 1: JSON escape hợp lệ (\\, \", \n, \t...)
-                    if two_chars in VALID_JSON_ESCAPES:
-                        result.append(two_chars)
-                        i += 2
-                        continue
-                    
-                    # Trường hợp 2: Unicode escape (\uXXXX)
-                    if next_char == 'u' and i + 5 < len(content):
-                        hex_part = content[i+2:i+6]
-                        if len(hex_part) == 4 and all(c in '0123456789ABCDEFabcdef' for c in hex_part):
-                            result.append(content[i:i+6])  # \uXXXX
-                            i += 6
-                            continue
-                    
-                    # Trường hợp 3: LaTeX command (VD: \frac, \sqrt, \sin)
-                    # → Escape thành \\
-                    result.append('\\\\')
-                    i += 1
-                else:
-                    # Backslash ở cuối chuỗi → Escape
-                    result.append('\\\\')
-                    i += 1
-            else:
-                result.append(char)
-                i += 1
-        
-        # Trả về chuỗi đã fix (VẪN CÓ dấu ngoặc kép)
-        return '"' + ''.join(result) + '"'
-    
-    # Regex tìm tất cả chuỗi JSON: "..."
-    # (?:[^"\\]|\\.)* nghĩa là: (không phải " hoặc \) HOẶC (\ theo sau bất kỳ ký tự nào)
-    string_pattern = r'"((?:[^"\\]|\\.)*)"'
-    
-    sanitized = re.sub(string_pattern, fix_string_content, text)
-    
-    return sanitized
+    if '\\' not in text:
+        return text
+    if '\\\n' in text:
+        # "\" + xuống dòng: regex coi đó là chỗ kết thúc chuỗi, cách cắt theo " thì không
+        # -> hiếm gặp, đi đường regex để giữ đúng hành vi cũ
+        return _JSON_STRING_RE.sub(_fix_json_string_match, text)
 
-def parse_json_safely(json_str: str, client) -> Optional[Dict]:
+    parts = text.split('"')
+    if '\\"' in text:
+        # Mảnh kết thúc bằng số lẻ backslash -> dấu " sau nó là \" (chỉ tính khi mảnh nằm TRONG chuỗi,
+        # ngoài chuỗi thì \ không escape được gì). Mỗi lần ghép làm đảo chẵn/lẻ các mảnh phía sau.
+        escaped = [k for k, piece in enumerate(parts[:-1])
+                   if piece[-1:] == '\\' and (len(piece) - len(piece.rstrip('\\'))) % 2]
+        merges = []
+        for k in escaped:
+            if (k + len(merges)) % 2:
+                merges.append(k)
+        for k in reversed(merges):
+            parts[k:k + 2] = ['"'.join(parts[k:k + 2])]
+
+    # Mảnh chẵn nằm ngoài chuỗi, mảnh lẻ là nội dung chuỗi
+    # (số mảnh chẵn -> mảnh lẻ cuối là chuỗi chưa đóng, giữ nguyên như regex)
+    n = len(parts)
+    for k in range(1, n if n % 2 else n - 1, 2):
+        content = parts[k]
+        if '\\' in content:
+            parts[k] = _fix_json_string_content(content)
+    return '"'.join(parts)
+
+
+def parse_json_safely(json_str: str, client, cancel_token=None) -> Optional[Dict]:
     """Parse JSON an toàn với Sanitization và Retry AI"""
     # 1. Clean markdown
     cleaned_str = clean_json_string(json_str)
@@ -389,7 +613,8 @@ def parse_json_safely(json_str: str, client) -> Optional[Dict]:
     
     # Thử parse lần 1 (với chuỗi đã sanitize)
     try:
-        return json.loads(sanitized_str, strict=False)
+        with timed("json_parse"):
+            return json.loads(sanitized_str, strict=False)
     except json.JSONDecodeError as e:
         print(f"❌ Lỗi JSON lần 1 (Logic): {e}")
         # Debug: In ra đoạn lỗi để kiểm tra nếu cần
@@ -401,7 +626,8 @@ def parse_json_safely(json_str: str, client) -> Optional[Dict]:
     try:
         # Lưu ý: Gửi chuỗi gốc (cleaned_str) hoặc chuỗi đã sanitize tùy chiến lược. 
         # Thường gửi chuỗi gốc để AI tự định dạng lại từ đầu sẽ an toàn hơn về ngữ nghĩa.
-        repaired_str = repair_json_with_ai(cleaned_str, client)
+        with timed("json_repair"):
+            repaired_str = repair_json_with_ai(cleaned_str, client, cancel_token)
         
         # Sau khi AI sửa, vẫn nên sanitize lại một lần nữa để chắc chắn
         repaired_str = sanitize_latex_json(repaired_str)
@@ -410,9 +636,26 @@ def parse_json_safely(json_str: str, client) -> Optional[Dict]:
     except json.JSONDecodeError as e:
         print(f"❌ Lỗi JSON lần 2 (AI Give up): {e}")
         return None
-def generate_or_get_image(hinh_anh_data: Dict) -> tuple:
+def pending_image_descriptions(data) -> List[str]:
+    """Mô tả các ảnh đề cần sinh mà chưa có trong cache (để sinh trước, song song, rồi mới render)"""
+    if isinstance(data, Exam):
+        specs = [q.hinh_anh for q in data.questions]
+    else:
+        specs = [ImageSpec.from_raw(cau.get("hinh_anh")) if isinstance(cau, dict) else None
+                 for cau in data.get("cau_hoi", [])]
+    pending = []
+    for spec in specs:
+        if spec is None or not spec.co_hinh or spec.loai != "tu_mo_ta" or not spec.mo_ta:
+            continue
+        if spec.mo_ta not in pending and _IMAGE_CACHE.get(spec.mo_ta) is None:
+            pending.append(spec.mo_ta)
+    return pending
+
+def generate_or_get_image(hinh_anh_data: Dict, cancel_token=None, images: Optional[Dict[str, bytes]] = None) -> tuple:
     """
     Xử lý gọi hàm sinh ảnh.
+    images: ảnh đã sinh sẵn theo mô tả (pipeline asyncio) - dùng trước cache/API;
+            mô tả có trong images nhưng giá trị None = đã sinh lỗi, không gọi lại API.
     Returns: (image_bytes, placeholder_text) - image_bytes là 1 object duy nhất
     """
     mo_ta = hinh_anh_data.get("mo_ta", hinh_anh_data.get("description", ""))
@@ -420,11 +663,21 @@ def generate_or_get_image(hinh_anh_data: Dict) -> tuple:
     loai = hinh_anh_data.get("loai", "tu_mo_ta")
     
     if loai == "tu_mo_ta" and mo_ta:
+        if images is not None and mo_ta in images:
+            if images[mo_ta]:
+                return images[mo_ta], None
+            return None, f"⚠️ [Lỗi sinh ảnh] Server không trả về ảnh cho mô tả: {mo_ta}"
+        cached = _IMAGE_CACHE.get(mo_ta)
+        if cached is not None:
+            add_value("image_cache_hits")
+            return cached, None
         try:
             from process.text2Image import generate_image_from_text
             # Hàm này trả về 1 bytes object (hoặc None)
-            image_bytes = generate_image_from_text(mo_ta)
+            with timed("image"):
+                image_bytes = generate_image_from_text(mo_ta, cancel_token=cancel_token)
             if image_bytes:
+                _IMAGE_CACHE.put(mo_ta, image_bytes)
                 return image_bytes, None
             else:
                 # Nếu API trả về None (do lỗi mạng hoặc quota)
@@ -436,9 +689,10 @@ def generate_or_get_image(hinh_anh_data: Dict) -> tuple:
     placeholder = f"🖼️ [Cần chèn hình: {mo_ta}]"
     return None, placeholder
 
-def insert_image_or_placeholder(doc: Document, hinh_anh_data: Dict):
+def insert_image_or_placeholder(doc: Document, hinh_anh_data: Dict, cancel_token=None,
+                                images: Optional[Dict[str, bytes]] = None):
     """Chèn ảnh hoặc placeholder vào document"""
-    image_bytes, placeholder = generate_or_get_image(hinh_anh_data)
+    image_bytes, placeholder = generate_or_get_image(hinh_anh_data, cancel_token, images)
     
     if image_bytes:
         try:
@@ -610,45 +864,25 @@ class DynamicDocxRenderer:
     KHÔNG hard-code logic render
     """
     
-    def __init__(self, doc: Document):
+    def __init__(self, doc: Document, cancel_token=None, images: Optional[Dict[str, bytes]] = None):
         self.doc = doc
+        self.cancel_token = cancel_token
+        self.images = images
     
-    def render_title(self, data: Dict):
-        """Render tiêu đề tự động"""
-        loai_de = data.get("loai_de", "").upper()
-        title = self.doc.add_heading(f'ĐỀ {loai_de}', level=1)
+    def render_title(self, data):
+        """Render tiêu đề tự động (data: Exam hoặc dict)"""
+        loai_de = data.loai_de if isinstance(data, Exam) else data.get("loai_de", "")
+        title = self.doc.add_heading(f'ĐỀ {loai_de.upper()}', level=1)
         title.alignment = WD_ALIGN_PARAGRAPH.CENTER
     
     def auto_group_questions(self, data: Dict) -> Dict[str, List]:
         """
-        Tự động nhóm câu hỏi và CHUẨN HÓA key muc_do từ Tiếng Việt sang code.
+        Tự động nhóm câu hỏi (dict thô) và CHUẨN HÓA key muc_do từ Tiếng Việt sang code.
         Giúp người dùng thoải mái viết prompt "Vận dụng", "Nhận biết"... mà không bị lỗi file trắng.
         """
         grouped = {}
         for cau in data.get("cau_hoi", []):
-            # 1. Lấy dữ liệu thô từ AI (ví dụ: "Vận dụng", "Nhận biết", "Thông hiểu")
-            # Chuyển về chữ thường để dễ so sánh
-            raw_muc_do = str(cau.get("muc_do", "unknown")).lower().strip()
-            
-            # 2. Logic "Phiên dịch" thông minh (Mapping)
-            # Ưu tiên check "cao" trước để phân biệt "Vận dụng" và "Vận dụng cao"
-            if "cao" in raw_muc_do:
-                muc_do_chuan = "van_dung_cao"
-            elif "dụng" in raw_muc_do or "dung" in raw_muc_do:
-                muc_do_chuan = "van_dung"
-            elif "thông" in raw_muc_do or "thong" in raw_muc_do:
-                muc_do_chuan = "thong_hieu"
-            elif "nhận" in raw_muc_do or "nhan" in raw_muc_do:
-                muc_do_chuan = "nhan_biet"
-            else:
-                # Trường hợp AI ghi nội dung lạ, mặc định đưa vào Vận dụng 
-                # để đảm bảo câu hỏi vẫn hiện ra trong file (tránh lỗi trang trắng)
-                muc_do_chuan = "van_dung" 
-            
-            # 3. Gom nhóm theo key chuẩn
-            if muc_do_chuan not in grouped:
-                grouped[muc_do_chuan] = []
-            grouped[muc_do_chuan].append(cau)
+            grouped.setdefault(normalize_muc_do(cau.get("muc_do")), []).append(cau)
         
         # Sắp xếp theo STT trong mỗi nhóm
         for key in grouped:
@@ -669,126 +903,110 @@ class DynamicDocxRenderer:
         }
         return mapping.get(muc_do, muc_do.upper())
     
-    def render_question_trac_nghiem(self, cau: Dict):
+    def render_image(self, cau: BaseQuestion):
+        if cau.has_image:
+            insert_image_or_placeholder(self.doc, cau.hinh_anh.to_dict(), self.cancel_token, self.images)
+    
+    def render_question_trac_nghiem(self, cau: MultipleChoiceQuestion):
         """Render câu hỏi trắc nghiệm 4 đáp án"""
         # Câu hỏi
-        p = self.doc.add_paragraph()
-        p.add_run(f"Câu {cau['stt']}. ").bold = True
-        process_text_with_latex(cau['noi_dung'], p)
+        p = TPL_CAU_PREFIX.add_to(self.doc, cau.stt)
+        process_text_with_latex(cau.noi_dung, p, cancel_token=self.cancel_token)
         
         # Hình ảnh
-        hinh_anh = cau.get("hinh_anh", {})
-        if hinh_anh.get("co_hinh"):
-            insert_image_or_placeholder(self.doc, hinh_anh)
+        self.render_image(cau)
         
         # Đáp án - THÊM XỬ LÝ LATEX
-        for dap_an in cau.get("dap_an", []):
-            p_da = self.doc.add_paragraph()
-            run_ky_hieu = p_da.add_run(f"{dap_an['ky_hieu']}. ")
-            process_text_with_latex(dap_an['noi_dung'], p_da) 
+        for dap_an in cau.dap_an:
+            p_da = TPL_DAP_AN.add_to(self.doc, dap_an.ky_hieu)
+            process_text_with_latex(dap_an.noi_dung, p_da, cancel_token=self.cancel_token) 
         
         # Lời giải
-        p_lg = self.doc.add_paragraph()
-        p_lg.add_run("Lời giải").bold = True
+        TPL_LOI_GIAI.add_to(self.doc)
         
-        if "dap_an_dung" in cau:
-            p_dung = self.doc.add_paragraph()
-            p_dung.add_run(f"{cau['dap_an_dung']}").bold = True
-            self.doc.add_paragraph("####")
+        if cau.dap_an_dung is not None:
+            TPL_DAP_AN_DUNG.add_to(self.doc, cau.dap_an_dung)
+            TPL_SEPARATOR.add_to(self.doc)
         
         # Giải thích - THÊM XỬ LÝ LATEX
-        giai_thich = cau.get("giai_thich", "")
-        for line in giai_thich.split("\n"):
+        for line in cau.giai_thich.split("\n"):
             if line.strip():
-                p_gt = self.doc.add_paragraph()
-                process_text_with_latex(line.strip(), p_gt)  
-        
-        # Kết luận - THÊM XỬ LÝ LATEX
-        if "dap_an_dung" in cau:
-            dap_an_num = cau['dap_an_dung']
-            noi_dung_dap_an = cau['dap_an'][dap_an_num-1]['noi_dung']
-            p_ket_luan = self.doc.add_paragraph()
-            run = p_ket_luan.add_run("Vậy đáp án đúng là: ")
-            run.bold = True
-            process_text_with_latex(noi_dung_dap_an, p_ket_luan, bold=True) 
+                p_gt = TPL_EMPTY.add_to(self.doc)
+                process_text_with_latex(line.strip(), p_gt, cancel_token=self.cancel_token)  
+        
+        # Kết luận - THÊM XỬ LÝ LATEX (dap_an_dung đã được kiểm tra nằm trong danh sách đáp án)
+        correct = cau.correct_option
+        if correct is not None:
+            p_ket_luan = TPL_KET_LUAN.add_to(self.doc)
+            process_text_with_latex(correct.noi_dung, p_ket_luan, bold=True, cancel_token=self.cancel_token) 
     
-    def render_question_dung_sai(self, cau: Dict):
+    def render_question_dung_sai(self, cau: TrueFalseQuestion):
         """Render câu hỏi đúng/sai"""
         # Số câu
-        p = self.doc.add_paragraph()
-        p.add_run(f"Câu {cau['stt']}.").bold = True
+        TPL_CAU_PREFIX_DS.add_to(self.doc, cau.stt)
         
         # Đoạn thông tin - THÊM XỬ LÝ LATEX
-        if cau.get("doan_thong_tin"):
-            p_doan = self.doc.add_paragraph()
-            process_text_with_latex(cau.get("doan_thong_tin", ""), p_doan)  
+        if cau.doan_thong_tin:
+            p_doan = TPL_EMPTY.add_to(self.doc)
+            process_text_with_latex(cau.doan_thong_tin, p_doan, cancel_token=self.cancel_token)  
         
         # Hình ảnh
-        hinh_anh = cau.get("hinh_anh", {})
-        if hinh_anh.get("co_hinh"):
-            insert_image_or_placeholder(self.doc, hinh_anh)
+        self.render_image(cau)
         
         # Các ý a, b, c, d - THÊM XỬ LÝ LATEX
-        for y in cau.get("cac_y", []):
-            p_y = self.doc.add_paragraph()
-            p_y.add_run(f"{y['ky_hieu']}) ")
-            process_text_with_latex(y['noi_dung'], p_y)  
+        for y in cau.cac_y:
+            p_y = TPL_Y_DUNG_SAI.add_to(self.doc, y.ky_hieu)
+            process_text_with_latex(y.noi_dung, p_y, cancel_token=self.cancel_token)  
         
         # Lời giải
-        p_lg = self.doc.add_paragraph()
-        p_lg.add_run("Lời giải").bold = True
+        TPL_LOI_GIAI.add_to(self.doc)
+        TPL_DAP_AN_DUNG.add_to(self.doc, cau.dap_an_dung_sai)
+        TPL_SEPARATOR.add_to(self.doc)
         
-        p_da = self.doc.add_paragraph()
-        p_da.add_run(cau.get("dap_an_dung_sai", "")).bold = True
-        self.doc.add_paragraph("####")
+        # AI trả giải thích dạng đoạn văn thay vì từng ý -> in từng dòng
+        if isinstance(cau.giai_thich, str):
+            for line in cau.giai_thich.split("\n"):
+                if line.strip():
+                    process_text_with_latex(line.strip(), TPL_EMPTY.add_to(self.doc), cancel_token=self.cancel_token)
+            return
         
         # Giải thích từng ý - THÊM XỬ LÝ LATEX
-        for gt in cau.get("giai_thich", []):
-            p_gt = self.doc.add_paragraph()
-            p_gt.add_run('+) "')
-            process_text_with_latex(gt.get('noi_dung_y', ''), p_gt)  
-            run_kl = p_gt.add_run(f'" - {gt.get("ket_luan", "SAI")}. ')
-            run_kl.bold = True
+        for gt in cau.giai_thich:
+            p_gt = TPL_GIAI_THICH_Y.add_to(self.doc)
+            process_text_with_latex(gt.noi_dung_y, p_gt, cancel_token=self.cancel_token)  
+            append_text_run(p_gt, f'" - {gt.ket_luan}. ', bold=True)
             
-            if gt.get('giai_thich'):
-                # p_gt_detail = self.doc.add_paragraph()
-                process_text_with_latex(gt.get('giai_thich', ''), p_gt)  
+            if gt.giai_thich:
+                process_text_with_latex(gt.giai_thich, p_gt, cancel_token=self.cancel_token)  
     
-    def render_question_tra_loi_ngan(self, cau: Dict):
+    def render_question_tra_loi_ngan(self, cau: ShortAnswerQuestion):
         """Render câu hỏi trả lời ngắn"""
         # Câu hỏi
-        p = self.doc.add_paragraph()
-        p.add_run(f"Câu {cau['stt']}. ").bold = True
-        p_noi_dung = self.doc.add_paragraph()
-        process_text_with_latex(cau['noi_dung'], p_noi_dung)  
+        TPL_CAU_PREFIX.add_to(self.doc, cau.stt)
+        p_noi_dung = TPL_EMPTY.add_to(self.doc)
+        process_text_with_latex(cau.noi_dung, p_noi_dung, cancel_token=self.cancel_token)  
         
         # Hình ảnh (nếu có)
-        hinh_anh = cau.get("hinh_anh", {})
-        if hinh_anh.get("co_hinh"):
-            insert_image_or_placeholder(self.doc, hinh_anh)
+        self.render_image(cau)
         
         # Đáp án - THÊM XỬ LÝ LATEX
-        p_da = self.doc.add_paragraph()
-        run_label = p_da.add_run("Đáp án: ")
-        run_label.bold = True
+        p_da = TPL_DAP_AN_TLN.add_to(self.doc)
         
-        raw_ans = str(cau.get('dap_an', '')).strip()
+        raw_ans = cau.dap_an.strip()
         if raw_ans.startswith("[[") and raw_ans.endswith("]]"):
             final_ans = raw_ans
         else:
             final_ans = f"[[{raw_ans}]]"
         
         # XỬ LÝ LATEX TRONG ĐÁP ÁN
-        process_text_with_latex(final_ans, p_da, bold=True)  
+        process_text_with_latex(final_ans, p_da, bold=True, cancel_token=self.cancel_token)  
         
         # Lời giải header
-        p_lg = self.doc.add_paragraph()
-        p_lg.add_run("Lời giải").bold = True
-        self.doc.add_paragraph("####")
+        TPL_LOI_GIAI.add_to(self.doc)
+        TPL_SEPARATOR.add_to(self.doc)
         
         # Giải thích chi tiết - ĐÃ CÓ XỬ LÝ LATEX
-        giai_thich = cau.get("giai_thich", "")
-        lines = giai_thich.replace('\\n', '\n').split('\n')
+        lines = cau.giai_thich.replace('\\n', '\n').split('\n')
         
         for line in lines:
             text = line.strip()
@@ -805,31 +1023,29 @@ class DynamicDocxRenderer:
                 is_bold = True
                 text = text.replace('**', '')
 
-            p_gt = self.doc.add_paragraph()
-            process_text_with_latex(text, p_gt, bold=is_bold)  
+            p_gt = TPL_EMPTY.add_to(self.doc)
+            process_text_with_latex(text, p_gt, bold=is_bold, cancel_token=self.cancel_token)  
     
-    def render_all(self, data: Dict):
+    def render_all(self, data):
         """
-        Main render function - Có hỗ trợ chia PHẦN (PART) bên trong Mức độ
+        Main render function - Có hỗ trợ chia PHẦN (PART) bên trong Mức độ.
+        data: Exam đã kiểm tra, hoặc dict (sẽ được kiểm tra, câu lỗi bị cách ly thay vì làm hỏng cả file)
         """
-        self.render_title(data)
-        
-        # 1. Auto-group theo mức độ (Nhận biết, Thông hiểu...)
-        grouped = self.auto_group_questions(data)
+        exam = data if isinstance(data, Exam) else validate_exam(data)
+        self.render_title(exam)
         
-        # 2. Detect loại đề
-        loai_de = data.get("loai_de", "")
+        # 1. Auto-group theo mức độ (đã chuẩn hóa khi kiểm tra dữ liệu)
+        grouped = exam.grouped()
         
-        # 3. Render từng nhóm MỨC ĐỘ
-        # Thứ tự ưu tiên render
-        order_muc_do = ["nhan_biet", "thong_hieu", "van_dung", "van_dung_cao"]
+        # 2. Hàm render theo loại đề
+        render_question = {
+            "dung_sai": self.render_question_dung_sai,
+            "tra_loi_ngan": self.render_question_tra_loi_ngan,
+        }.get(exam.loai_de, self.render_question_trac_nghiem)
         
-        for muc_do in order_muc_do:
-            if muc_do not in grouped:
-                continue
-            
-            # Lấy danh sách câu hỏi trong mức độ này
-            questions = grouped[muc_do]
+        # 3. Render từng nhóm MỨC ĐỘ theo thứ tự ưu tiên
+        for muc_do in MUC_DO_ORDER:
+            questions = grouped.get(muc_do)
             if not questions:
                 continue
             section_title = self.get_section_title(muc_do)
@@ -837,24 +1053,203 @@ class DynamicDocxRenderer:
             current_phan = None
 
             for cau in questions:
-                # Lấy tên phần của câu hiện tại
-                phan_cua_cau = str(cau.get("phan", "")).strip()
-                
+                # Điểm kiểm tra hủy giữa các câu hỏi
+                raise_if_cancelled(self.cancel_token)
+
                 # Nếu câu này thuộc một phần mới -> In Header Phần
-                if phan_cua_cau and phan_cua_cau != current_phan:
+                if cau.phan and cau.phan != current_phan:
                     # In ra header cấp 3 (VD: Phần 1: Đội ngũ...)
                     # Dùng màu hoặc in đậm để phân biệt
-                    p_phan = self.doc.add_heading(phan_cua_cau.upper(), level=3)
+                    p_phan = self.doc.add_heading(cau.phan.upper(), level=3)
                     p_phan.alignment = WD_ALIGN_PARAGRAPH.LEFT
-                    current_phan = phan_cua_cau
+                    current_phan = cau.phan
                 
-                # Render nội dung câu hỏi như bình thường
-                if loai_de == "dung_sai":
-                    self.render_question_dung_sai(cau)
-                elif loai_de == "tra_loi_ngan":
-                    self.render_question_tra_loi_ngan(cau)
-                else:
-                    self.render_question_trac_nghiem(cau)
+                render_question(cau)
+
+# ============================================================================
+# CÁC BƯỚC (STAGE) CỦA PIPELINE - dùng chung cho response2docx_flexible và pipeline.py
+# ============================================================================
+
+def build_model_request(file_path, prompt: str, question_type: str = "trac_nghiem_4_dap_an",
+                        page_ranges: Optional[Dict[str, str]] = None):
+    """Prompt cuối cùng + các PDF phải gửi nguyên (CPU/đĩa, tách riêng để bản asyncio chạy trong executor)"""
+    # Wrap prompt với JSON structure hint
+    final_prompt = PromptBuilder.wrap_user_prompt(prompt, question_type)
+
+    # PDF_TEXT_MODE=auto: PDF trích được text -> gửi text kèm số trang thay cho file PDF
+    return prepare_model_input(final_prompt, file_path, page_ranges)
+
+def request_ai_response(file_path, prompt: str, project_id: str, creds, model_name: str,
+                        question_type: str = "trac_nghiem_4_dap_an", cancel_token=None, client=None,
+                        page_ranges: Optional[Dict[str, str]] = None):
+    """
+    Stage 1 (I/O): gửi PDF + prompt tới AI. Trả về (client, ai_response).
+    client: truyền sẵn client (VD: client giả lập trong benchmarks/), mặc định tạo VertexClient.
+    page_ranges: {đường dẫn PDF: "40-62"} - chỉ gửi các trang đã chọn (xem process.pdf_pages).
+    """
+    if client is None:
+        from api.callAPI import VertexClient
+        client = VertexClient(project_id, creds, model_name)
+
+    final_prompt, pdf_files = build_model_request(file_path, prompt, question_type, page_ranges)
+
+    print("📤 Đang gửi request tới AI...")
+    with timed("model"):
+        ai_response = client.send_data_to_AI(final_prompt, pdf_files, cancel_token=cancel_token)
+    return client, ai_response
+
+def parse_ai_response(ai_response: str, client, cancel_token=None, question_type: Optional[str] = None) -> Optional[Exam]:
+    """
+    Stage 2 (CPU, có thể gọi AI sửa JSON): parse response thành Exam đã kiểm tra - lần kiểm tra
+    DUY NHẤT; các stage sau (bù câu, render, ảnh) dùng thẳng Exam, chỉ to_dict() khi ghi file đi kèm
+    hoặc gửi sang tiến trình render con.
+    Câu sai cấu trúc được cách ly vào khóa "cau_hoi_loi" thay vì làm hỏng cả file.
+    """
+    print("🔄 Đang parse JSON...")
+    data = parse_json_safely(ai_response, client, cancel_token)
+    if not data:
+        print("❌ Không thể parse JSON từ AI")
+        return None
+
+    try:
+        exam = validate_exam(data, question_type)
+    except QuestionValidationError as e:
+        print(f"❌ JSON không đúng cấu trúc đề: {e}")
+        return None
+    if not exam.questions:
+        print(f"❌ Không có câu hỏi hợp lệ ({len(exam.quarantined)} câu bị cách ly)")
+        return None
+    if exam.quarantined:
+        print(f"⚠️ {len(exam.quarantined)} câu bị cách ly vào '{QUARANTINE_KEY}'")
+
+    print(f"✅ Parse thành công: {len(exam.questions)}/{exam.tong_so_cau} câu hỏi")
+    return exam
+
+def build_gap_fill_prompt(user_prompt: str, question_type: str, exam: Exam, missing: Dict[int, str]) -> str:
+    """Prompt ngắn chỉ yêu cầu sinh lại các stt còn thiếu, kèm danh sách câu đã có để tránh trùng"""
+    wanted = "\n".join(f"- Câu {stt}: mức độ {muc_do}" for stt, muc_do in sorted(missing.items()))
+    existing = "\n".join(
+        f"- Câu {q.stt}: {(getattr(q, 'noi_dung', '') or getattr(q, 'doan_thong_tin', ''))[:80]}"
+        for q in exam.questions
+    )
+    task = f"""### YÊU CẦU BỔ SUNG (CHỈ SINH CÁC CÂU CÒN THIẾU):
+Đề gốc có {exam.tong_so_cau} câu nhưng các câu sau bị thiếu hoặc sai cấu trúc. 
+CHỈ sinh đúng các câu này, giữ nguyên stt và mức độ đã ghi:
+{wanted}
+
+Các câu đã có (KHÔNG được trùng nội dung):
+{existing}
+
+"tong_so_cau" trong JSON trả về = số câu bổ sung ({len(missing)})."""
+    return PromptBuilder.wrap_user_prompt(f"{user_prompt}\n\n{task}", question_type)
+
+def fill_missing_questions(exam: Exam, client, file_path, user_prompt: str,
+                           question_type: str = "trac_nghiem_4_dap_an", cancel_token=None,
+                           page_ranges: Optional[Dict[str, str]] = None) -> Exam:
+    """
+    Stage 2b (I/O): so tong_so_cau với số câu hợp lệ; nếu thiếu ít thì gọi AI một lần
+    nữa (cùng PDF) CHỈ cho các stt thiếu/bị cách ly rồi gộp vào exam, thay vì sinh lại cả đề.
+    Thiếu quá GAP_FILL_MAX_RATIO thì bỏ qua (lệch quá nhiều, nên sinh lại từ đầu).
+    """
+    targets = parse_muc_do_targets(user_prompt, exam.tong_so_cau)
+    for round_index in range(GAP_FILL_ROUNDS):
+        missing = find_missing_questions(exam)
+        if not missing:
+            break
+        if len(missing) > exam.tong_so_cau * GAP_FILL_MAX_RATIO:
+            print(f"⚠️ Thiếu {len(missing)}/{exam.tong_so_cau} câu - quá nhiều để bù, giữ nguyên kết quả")
+            break
+
+        # Có / yêu cầu theo mức độ: số yêu cầu đọc từ prompt, prompt không ghi thì chỉ báo số câu thiếu
+        have = count_by_muc_do(exam.questions)
+        detail = ", ".join(f"{k}: {have.get(k, 0)}/{v}" for k, v in targets.items())
+        print(f"🩹 Bù {len(missing)} câu thiếu (lần {round_index + 1})" + (f" - {detail}" if detail else ""))
+
+        raise_if_cancelled(cancel_token)
+        prompt = build_gap_fill_prompt(user_prompt, question_type, exam, missing)
+        prompt, pdf_files = prepare_model_input(prompt, file_path, page_ranges)
+        try:
+            with timed("gap_fill"):
+                response = client.send_data_to_AI(prompt, pdf_files, cancel_token=cancel_token)
+        except Exception as e:
+            print(f"⚠️ Không bù được câu thiếu: {e}")
+            break
+        filled_data = parse_json_safely(response, client, cancel_token)
+        if not filled_data:
+            print("⚠️ JSON bù câu không hợp lệ, giữ nguyên kết quả")
+            break
+        try:
+            filled = validate_exam(filled_data, question_type)
+        except QuestionValidationError as e:
+            print(f"⚠️ JSON bù câu sai cấu trúc: {e}")
+            break
+
+        merged = merge_filled_questions(exam, filled, missing)
+        print(f"✅ Đã bù {len(merged)}/{len(missing)} câu: {merged}")
+        if not merged:
+            break
+    return exam
+
+def render_document(data, cancel_token=None, streaming: Optional[bool] = None,
+                    images: Optional[Dict[str, bytes]] = None) -> Optional[Document]:
+    """
+    Stage 3 (CPU + pandoc + sinh ảnh): render Exam (hoặc dict - sẽ được kiểm tra) thành Document.
+    streaming=None: tự chọn StreamingDocument khi đề có từ STREAMING_MIN_QUESTIONS câu trở lên.
+    images: {mô tả: bytes} ảnh đã sinh sẵn, không phải gọi API trong lúc render.
+    """
+    print("📝 Đang tạo DOCX...")
+    if streaming is None:
+        count = len(data.questions) if isinstance(data, Exam) else len(data.get("cau_hoi", []))
+        streaming = count >= STREAMING_MIN_QUESTIONS
+    if streaming:
+        from process.docx_stream import StreamingDocument
+        doc = StreamingDocument()
+    else:
+        doc = Document()
+    renderer = DynamicDocxRenderer(doc, cancel_token, images)
+
+    rendered = False
+    try:
+        with timed("render"):
+            renderer.render_all(data)
+        rendered = True
+        print("✅ Render DOCX thành công")
+    except Exception as e:
+        print(f"❌ Lỗi khi render DOCX: {e}")
+        traceback.print_exc()
+        return None
+    finally:
+        # Lỗi/hủy giữa chừng: dọn file tạm của StreamingDocument
+        if not rendered and hasattr(doc, "close"):
+            doc.close()
+    return doc
+
+def render_and_save(data, batch_name: str, file_name: str, output_root: Optional[str] = None,
+                    cancel_token=None) -> str:
+    """Stage 3+4 gộp: render rồi lưu, trả về đường dẫn (dùng cho render đa tiến trình)"""
+    exam = data if isinstance(data, Exam) else validate_exam(data)
+    doc = render_document(exam, cancel_token)
+    if doc is None:
+        raise RuntimeError("Lỗi khi render DOCX")
+    raise_if_cancelled(cancel_token)
+    output_path = save_document_securely(doc, batch_name, file_name, output_root)
+    if not output_path:
+        raise RuntimeError("Không thể lưu file")
+    save_sidecars(exam, output_path)
+    return output_path
+
+def save_sidecars(data, output_path: str):
+    """
+    Ghi các file đi kèm DOCX (Exam -> dict một lần tại đây):
+    - <tên>.preview.html: GUI mở file này thay vì convert lại bằng mammoth
+    - <tên>.questions.json: JSON chuẩn hóa để xuất Moodle/QTI/Markdown mà không gọi lại AI
+    """
+    from process.preview_html import write_preview_sidecar
+    from process.exporters import write_canonical_json
+    if isinstance(data, Exam):
+        data = data.to_dict()
+    write_preview_sidecar(data, output_path)
+    write_canonical_json(data, output_path)
 
 def response2docx_flexible(
     file_path: str,
@@ -864,50 +1259,41 @@ def response2docx_flexible(
     creds: str,
     model_name: str,
     question_type: str = "trac_nghiem_4_dap_an",
-    batch_name: Optional[str] = None
+    batch_name: Optional[str] = None,
+    output_root: Optional[str] = None,
+    cancel_token=None,
+    page_ranges: Optional[Dict[str, str]] = None
 ) -> Optional[str]:
     try:
-        from api.callAPI import VertexClient
-        
-        client = VertexClient(project_id, creds, model_name)
-        
         if not batch_name:
             batch_name = file_name.replace("_TN", "").replace("_DS", "").replace("_TLN", "")
         
-        # 1. Wrap prompt với JSON structure hint
-        final_prompt = PromptBuilder.wrap_user_prompt(prompt, question_type)
-        
-        # 2. Gửi request AI
-        print("📤 Đang gửi request tới AI...")
-        ai_response = client.send_data_to_AI(final_prompt, file_path)
+        # 1-2. Wrap prompt + gửi request AI
+        client, ai_response = request_ai_response(
+            file_path, prompt, project_id, creds, model_name, question_type, cancel_token,
+            page_ranges=page_ranges
+        )
         
-        # 3. Parse JSON
-        print("🔄 Đang parse JSON...")
-        data = parse_json_safely(ai_response, client)
-        if not data:
-            print("❌ Không thể parse JSON từ AI")
+        # 3. Parse JSON (kiểm tra cấu trúc một lần, ra Exam)
+        data = parse_ai_response(ai_response, client, cancel_token, question_type)
+        if data is None:
             return None
         
-        print(f"✅ Parse thành công: {data.get('tong_so_cau', 0)} câu hỏi")
+        # 3b. Bù câu thiếu/lỗi bằng một request nhỏ (không sinh lại cả đề)
+        data = fill_missing_questions(data, client, file_path, prompt, question_type, cancel_token, page_ranges)
         
         # 4. Render DOCX động
-        print("📝 Đang tạo DOCX...")
-        doc = Document()
-        renderer = DynamicDocxRenderer(doc)
-        
-        try:
-            renderer.render_all(data)
-            print("✅ Render DOCX thành công")
-        except Exception as e:
-            print(f"❌ Lỗi khi render DOCX: {e}")
-            traceback.print_exc()
+        doc = render_document(data, cancel_token)
+        if doc is None:
             return None
         
         # 5. Lưu file
+        raise_if_cancelled(cancel_token)
         print("💾 Đang lưu file...")
-        output_path = save_document_securely(doc, batch_name, file_name)
+        output_path = save_document_securely(doc, batch_name, file_name, output_root)
         
         if output_path:
+            save_sidecars(data, output_path)
             print(f"✅ Hoàn thành: {output_path}")
         else:
             print("❌ Không thể lưu file")
@@ -919,28 +1305,31 @@ def response2docx_flexible(
         traceback.print_exc()
         return None
 
-def response2docx_json(file_path, prompt, file_name, project_id, creds, model_name, batch_name=None):
+def response2docx_json(file_path, prompt, file_name, project_id, creds, model_name, batch_name=None, cancel_token=None):
     """Wrapper cho trắc nghiệm 4 đáp án (legacy)"""
     return response2docx_flexible(
         file_path, prompt, file_name, project_id, creds, model_name,
         question_type="trac_nghiem_4_dap_an",
-        batch_name=batch_name
+        batch_name=batch_name,
+        cancel_token=cancel_token
     )
 
-def response2docx_dung_sai_json(file_path, prompt, file_name, project_id, creds, model_name, batch_name=None):
+def response2docx_dung_sai_json(file_path, prompt, file_name, project_id, creds, model_name, batch_name=None, cancel_token=None):
     """Wrapper cho đúng/sai (legacy)"""
     return response2docx_flexible(
         file_path, prompt, file_name, project_id, creds, model_name,
         question_type="dung_sai",
-        batch_name=batch_name
+        batch_name=batch_name,
+        cancel_token=cancel_token
     )
     
-def response2docx_tra_loi_ngan_json(file_path, prompt, file_name, project_id, creds, model_name, batch_name=None):
+def response2docx_tra_loi_ngan_json(file_path, prompt, file_name, project_id, creds, model_name, batch_name=None, cancel_token=None):
     """Wrapper cho trả lời ngắn (legacy compatibility)"""
     return response2docx_flexible(
         file_path, prompt, file_name, project_id, creds, model_name,
         question_type="tra_loi_ngan",
-        batch_name=batch_name
+        batch_name=batch_name,
+        cancel_token=cancel_token
     )
 
 class ConfigManager:
@@ -0,0 +1,369 @@
+import json
+import os
+import socket
+import time
+import uuid
+from typing import Dict, List, Optional
+
+from process.job_queue import (
+    Job, output_stamp, owner_is_live, task_priority,
+    STATE_PENDING, STATE_LEASED, STATE_COMMITTING, STATE_DONE, STATE_DEAD
+)
+
+# ============================================================
+# HÀNG ĐỢI DẠNG THƯ MỤC (SPOOL) CHO NHIỀU MÁY DÙNG CHUNG
+# ============================================================
+#
+# Cấu trúc thư mục trên ổ mạng dùng chung:
+#   spool/pending/<tên job>.json               -> chờ xử lý (tên file sắp xếp theo ưu tiên)
+#   spool/leased/<tên job>.json@<worker>       -> đang được worker giữ lease (mtime = heartbeat)
+#   spool/committing/<tên job>.json@<worker>   -> worker đang đưa output vào vị trí cuối
+#   spool/done/<tên job>.json, spool/dead/<tên job>.json
+#   spool/workers/<worker>.json                -> heartbeat của từng node
+#
+# Mọi chuyển trạng thái đều là os.rename (nguyên tử trên cùng một filesystem),
+# nên hai worker không bao giờ cùng lấy được một job.
+
+_STATE_DIRS = (STATE_PENDING, STATE_LEASED, STATE_COMMITTING, STATE_DONE, STATE_DEAD, "workers")
+
+
+def _write_json_atomic(path: str, data: Dict):
+    tmp_path = f"{path}.{uuid.uuid4().hex[:8]}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False)
+    os.replace(tmp_path, path)
+
+
+def _read_json(path: str) -> Optional[Dict]:
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+class SpoolJobQueue:
+    """
+    Hàng đợi dựa trên thư mục, cùng giao diện với JobQueue (SQLite).
+    Dùng khi nhiều máy chia nhau một batch qua ổ mạng (SQLite không an toàn trên ổ mạng).
+    """
+
+    def __init__(self, spool_dir: str, visibility_timeout: float = 1800, max_attempts: int = 3,
+                 retry_delay: float = 30):
+        self.spool_dir = spool_dir
+        self.visibility_timeout = visibility_timeout
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        for name in _STATE_DIRS:
+            os.makedirs(os.path.join(spool_dir, name), exist_ok=True)
+
+    # ---------------- Helper ----------------
+    def _dir(self, state: str) -> str:
+        return os.path.join(self.spool_dir, state)
+
+    def _owned_path(self, state: str, job_id: str, owner: str) -> str:
+        return os.path.join(self._dir(state), f"{job_id}@{owner}")
+
+    @staticmethod
+    def _split_owned(file_name: str):
+        job_id, _, owner = file_name.partition("@")
+        return job_id, owner
+
+    def _list(self, state: str) -> List[str]:
+        try:
+            return sorted(n for n in os.listdir(self._dir(state)) if not n.endswith(".tmp"))
+        except FileNotFoundError:
+            return []
+
+    @staticmethod
+    def _to_job(data: Dict, state: str, owner: Optional[str] = None, expires: Optional[float] = None) -> Job:
+        row = dict(data)
+        row.update(state=state, lease_owner=owner, lease_expires=expires,
+                   payload=json.dumps(data.get("payload", {}), ensure_ascii=False))
+        return Job(row)
+
+    def close(self):
+        """Không giữ kết nối nào - giữ cho tương thích với JobQueue"""
+        pass
+
+    # ---------------- Producer ----------------
+    def enqueue(self, task_type: str, output_name: str, payload: Dict, batch_id: Optional[str] = None,
+                priority: Optional[int] = None, size_hint: int = 0,
+                max_attempts: Optional[int] = None) -> str:
+        """Cùng quy tắc với JobQueue.enqueue: trùng key + payload -> dùng lại; payload khác -> cập nhật job đang chờ"""
+        if priority is None:
+            priority = task_priority(task_type)
+        now = time.time()
+        job_key = f"{output_name}:{task_type}"
+        normalized = json.loads(json.dumps(payload, ensure_ascii=False))
+
+        existing = self._find_active(job_key)
+        for state, name, data in existing:
+            if data.get("payload") == normalized:
+                return self._split_owned(name)[0]
+        for state, name, data in existing:
+            if state == STATE_PENDING and self._update_pending(name, normalized, batch_id, max_attempts, now):
+                return name
+
+        # Tên file quyết định thứ tự lease: ưu tiên -> kích thước nhóm -> thời điểm thêm
+        job_id = f"{priority:02d}-{min(size_hint, 10 ** 12 - 1):012d}-{time.time_ns()}-{uuid.uuid4().hex[:8]}.json"
+        data = {
+            "id": job_id,
+            "job_key": job_key,
+            "batch_id": batch_id,
+            "task_type": task_type,
+            "output_name": output_name,
+            "payload": normalized,
+            "priority": priority,
+            "attempts": 0,
+            "max_attempts": max_attempts or self.max_attempts,
+            "available_at": now,
+            "result": None,
+            "last_error": None,
+        }
+        _write_json_atomic(os.path.join(self._dir(STATE_PENDING), job_id), data)
+        return job_id
+
+    def _find_active(self, job_key: str):
+        """Các job cùng key đang chờ / đang chạy: [(trạng thái, tên file, dữ liệu)]"""
+        found = []
+        for state in (STATE_PENDING, STATE_LEASED):
+            for name in self._list(state):
+                data = _read_json(os.path.join(self._dir(state), name))
+                if data is not None and data.get("job_key") == job_key:
+                    found.append((state, name, data))
+        return found
+
+    def _update_pending(self, job_id: str, payload: Dict, batch_id: Optional[str],
+                        max_attempts: Optional[int], now: float) -> bool:
+        """
+        Thay payload của job đang chờ. Đổi tên sang file tạm trước khi sửa để worker khác không
+        lease giữa chừng; job vừa bị lease mất -> False (người gọi thêm job mới).
+        """
+        path = os.path.join(self._dir(STATE_PENDING), job_id)
+        claim = f"{path}.{uuid.uuid4().hex[:8]}.tmp"
+        try:
+            os.rename(path, claim)
+        except FileNotFoundError:
+            return False
+        data = _read_json(claim) or {}
+        data.update(payload=payload, batch_id=batch_id, attempts=0, available_at=now, last_error=None,
+                    max_attempts=max_attempts or self.max_attempts)
+        _write_json_atomic(claim, data)
+        os.replace(claim, path)
+        return True
+
+    # ---------------- Consumer ----------------
+    def lease(self, owner: str, visibility_timeout: Optional[float] = None) -> Optional[Job]:
+        timeout = visibility_timeout or self.visibility_timeout
+        self._reap_expired()
+
+        now = time.time()
+        for job_id in self._list(STATE_PENDING):
+            src = os.path.join(self._dir(STATE_PENDING), job_id)
+            data = _read_json(src)
+            if data is None or data.get("available_at", 0) > now:
+                continue
+            try:
+                # Làm mới mtime trước khi rename để reaper không coi lease mới là hết hạn
+                os.utime(src)
+                dst = self._owned_path(STATE_LEASED, job_id, owner)
+                os.rename(src, dst)
+            except FileNotFoundError:
+                # Worker khác đã lấy trước
+                continue
+
+            data["attempts"] = data.get("attempts", 0) + 1
+            _write_json_atomic(dst, data)
+            return self._to_job(data, STATE_LEASED, owner, now + timeout)
+        return None
+
+    def heartbeat(self, job_id: str, owner: str, visibility_timeout: Optional[float] = None) -> bool:
+        try:
+            os.utime(self._owned_path(STATE_LEASED, job_id, owner))
+            return True
+        except FileNotFoundError:
+            return False
+
+    def heartbeat_many(self, job_ids: List[str], owner: str,
+                       visibility_timeout: Optional[float] = None) -> List[str]:
+        return [job_id for job_id in job_ids if self.heartbeat(job_id, owner, visibility_timeout)]
+
+    def begin_commit(self, job_id: str, owner: str, result: str, staged_path: Optional[str] = None) -> bool:
+        src = self._owned_path(STATE_LEASED, job_id, owner)
+        dst = self._owned_path(STATE_COMMITTING, job_id, owner)
+        try:
+            os.rename(src, dst)
+        except FileNotFoundError:
+            return False
+        data = _read_json(dst) or {}
+        data["result"] = result
+        data["result_stamp"] = output_stamp(staged_path)
+        _write_json_atomic(dst, data)
+        return True
+
+    def complete(self, job_id: str, owner: str, result: Optional[str] = None) -> bool:
+        for state in (STATE_COMMITTING, STATE_LEASED):
+            src = self._owned_path(state, job_id, owner)
+            data = _read_json(src)
+            if data is None:
+                continue
+            if result is not None:
+                data["result"] = result
+            _write_json_atomic(src, data)
+            try:
+                os.rename(src, os.path.join(self._dir(STATE_DONE), job_id))
+                return True
+            except FileNotFoundError:
+                return False
+        return False
+
+    def fail(self, job_id: str, owner: str, error: str) -> str:
+        # Lỗi giữa lúc commit (file output đang bị mở...) -> job nằm ở committing của chính owner
+        for state in (STATE_LEASED, STATE_COMMITTING):
+            src = self._owned_path(state, job_id, owner)
+            data = _read_json(src)
+            if data is not None:
+                break
+        else:
+            return ""
+        data["last_error"] = str(error)[:2000]
+        if data.get("attempts", 0) >= data.get("max_attempts", self.max_attempts):
+            new_state = STATE_DEAD
+        else:
+            new_state = STATE_PENDING
+            data["available_at"] = time.time() + self.retry_delay * (2 ** (data.get("attempts", 1) - 1))
+        _write_json_atomic(src, data)
+        try:
+            os.rename(src, os.path.join(self._dir(new_state), job_id))
+        except FileNotFoundError:
+            return ""
+        return new_state
+
+    def release(self, job_id: str, owner: str) -> bool:
+        src = self._owned_path(STATE_LEASED, job_id, owner)
+        data = _read_json(src)
+        if data is None:
+            return False
+        data["attempts"] = max(data.get("attempts", 1) - 1, 0)
+        data["available_at"] = time.time()
+        _write_json_atomic(src, data)
+        try:
+            os.rename(src, os.path.join(self._dir(STATE_PENDING), job_id))
+            return True
+        except FileNotFoundError:
+            return False
+
+    def _reap_expired(self):
+        """Thu hồi lease của worker đã chết (không heartbeat quá visibility_timeout)"""
+        now = time.time()
+        for state in (STATE_LEASED, STATE_COMMITTING):
+            for name in self._list(state):
+                path = os.path.join(self._dir(state), name)
+                try:
+                    if os.path.getmtime(path) + self.visibility_timeout > now:
+                        continue
+                except FileNotFoundError:
+                    continue
+                job_id, _ = self._split_owned(name)
+                data = _read_json(path) or {}
+
+                if state == STATE_COMMITTING:
+                    # Chỉ tính là xong nếu file output đúng là file của commit này (xem output_stamp)
+                    stamp = data.get("result_stamp")
+                    target = STATE_DONE if stamp and output_stamp(data.get("result")) == stamp else STATE_PENDING
+                elif data.get("attempts", 0) >= data.get("max_attempts", self.max_attempts):
+                    target = STATE_DEAD
+                    data["last_error"] = "Lease hết hạn (worker không phản hồi)"
+                    _write_json_atomic(path, data)
+                else:
+                    target = STATE_PENDING
+                try:
+                    os.rename(path, os.path.join(self._dir(target), job_id))
+                except FileNotFoundError:
+                    pass
+
+    # ---------------- Quản trị ----------------
+    def has_active(self) -> bool:
+        return any(self._list(s) for s in (STATE_PENDING, STATE_LEASED, STATE_COMMITTING))
+
+    def count_active(self) -> int:
+        return sum(len(self._list(s)) for s in (STATE_PENDING, STATE_LEASED, STATE_COMMITTING))
+
+    def stats(self) -> Dict[str, int]:
+        return {s: len(self._list(s)) for s in _STATE_DIRS if s != "workers"}
+
+    def dead_letters(self) -> List[Job]:
+        jobs = []
+        for name in self._list(STATE_DEAD):
+            data = _read_json(os.path.join(self._dir(STATE_DEAD), name))
+            if data:
+                jobs.append(self._to_job(data, STATE_DEAD))
+        return jobs
+
+    def requeue_dead(self, job_id: Optional[str] = None) -> int:
+        count = 0
+        for name in self._list(STATE_DEAD):
+            if job_id is not None and name != job_id:
+                continue
+            path = os.path.join(self._dir(STATE_DEAD), name)
+            data = _read_json(path) or {}
+            data.update(attempts=0, available_at=time.time())
+            _write_json_atomic(path, data)
+            try:
+                os.rename(path, os.path.join(self._dir(STATE_PENDING), name))
+                count += 1
+            except FileNotFoundError:
+                pass
+        return count
+
+    def reclaim_orphaned(self, max_age: float = 120) -> int:
+        """Như JobQueue.reclaim_orphaned: thu hồi ngay lease/commit của owner không còn sống"""
+        live = self.live_workers(max_age)
+        count = 0
+        for state in (STATE_LEASED, STATE_COMMITTING):
+            for name in self._list(state):
+                job_id, owner = self._split_owned(name)
+                if owner_is_live(owner, live):
+                    continue
+                path = os.path.join(self._dir(state), name)
+                data = _read_json(path) or {}
+                if state == STATE_COMMITTING:
+                    stamp = data.get("result_stamp")
+                    target = STATE_DONE if stamp and output_stamp(data.get("result")) == stamp else STATE_PENDING
+                else:
+                    target = STATE_PENDING
+                    data.update(attempts=max(data.get("attempts", 1) - 1, 0), available_at=time.time())
+                    _write_json_atomic(path, data)
+                try:
+                    os.rename(path, os.path.join(self._dir(target), job_id))
+                    count += 1
+                except FileNotFoundError:
+                    pass
+        return count
+
+    def discard_active(self) -> int:
+        """Bỏ job còn tồn của phiên cũ; job worker còn sống đang giữ thì để nguyên"""
+        self.reclaim_orphaned()
+        count = 0
+        for name in self._list(STATE_PENDING):
+            try:
+                os.remove(os.path.join(self._dir(STATE_PENDING), name))
+                count += 1
+            except FileNotFoundError:
+                pass
+        return count
+
+    def register_worker(self, worker_id: str, info: Optional[Dict] = None):
+        data = dict(info or {})
+        data.update(host=socket.gethostname(), pid=os.getpid(), last_seen=time.time())
+        _write_json_atomic(os.path.join(self._dir("workers"), f"{worker_id}.json"), data)
+
+    def live_workers(self, max_age: float = 120) -> Dict[str, Dict]:
+        cutoff = time.time() - max_age
+        result = {}
+        for name in self._list("workers"):
+            data = _read_json(os.path.join(self._dir("workers"), name))
+            if data and data.get("last_seen", 0) >= cutoff:
+                result[name[:-len(".json")]] = data
+        return result
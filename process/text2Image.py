@@ -2,45 +2,90 @@ import os
 from google import genai
 from google.genai import types
 from api.callAPI import get_vertex_ai_credentials 
+from process.cancellation import run_cancellable
+from process.metrics import add_value
 
-def generate_image_from_text(prompt, aspect_ratio="1:1"):
-    try:
-        credentials = get_vertex_ai_credentials()
-        project_id = os.getenv("PROJECT_ID")
-        location = "global" 
+IMAGE_MODEL_NAME = "gemini-3-pro-image-preview"
 
-        if not credentials or not project_id:
-            print("❌ Lỗi: Thiếu Credentials/Project ID")
-            return None
+def make_image_client():
+    """Client GenAI cho model ảnh (None nếu thiếu credentials/project)"""
+    credentials = get_vertex_ai_credentials()
+    project_id = os.getenv("PROJECT_ID")
+    location = "global" 
+
+    if not credentials or not project_id:
+        print("❌ Lỗi: Thiếu Credentials/Project ID")
+        return None
+
+    return genai.Client(vertexai=True, project=project_id, location=location, credentials=credentials)
+
+def _image_request(prompt, aspect_ratio):
+    return dict(
+        model=IMAGE_MODEL_NAME,
+        contents=f"Vẽ hình ảnh minh họa chính xác cho mô tả sau: {prompt}",
+        config=types.GenerateContentConfig(
+            # tools=[{"google_search": {}}],
+            response_modalities=["IMAGE"],
+            candidate_count=1, # Yêu cầu rõ ràng chỉ sinh 1 ảnh
+            image_config=types.ImageConfig(aspect_ratio=aspect_ratio),
+        ),
+    )
 
-        client = genai.Client(vertexai=True, project=project_id, location=location, credentials=credentials)
-        model_name = "gemini-3-pro-image-preview" 
+def _image_bytes(response):
+    for part in response.parts:
+        if part.inline_data and part.inline_data.data:
+            print(f"✅ Sinh ảnh thành công ({len(part.inline_data.data)} bytes)")
+            # Ảnh tính tiền theo từng ảnh (xem process.budget)
+            add_value("images")
+            return part.inline_data.data
+
+    print("❌ API không trả về dữ liệu ảnh.")
+    return None
+
+def generate_image_from_text(prompt, aspect_ratio="1:1", cancel_token=None):
+    try:
+        client = make_image_client()
+        if client is None:
+            return None
 
         print(f"🎨 Đang sinh ảnh: {prompt[:30]}...")
         
         # Gọi API với timeout=60s (Đủ cho 1 ảnh)
-        response = client.models.generate_content(
-            model=model_name,
-            contents=f"Vẽ hình ảnh minh họa chính xác cho mô tả sau: {prompt}",
-            config=types.GenerateContentConfig(
-                # tools=[{"google_search": {}}],
-                response_modalities=["IMAGE"],
-                candidate_count=1, # Yêu cầu rõ ràng chỉ sinh 1 ảnh
-                image_config=types.ImageConfig(aspect_ratio=aspect_ratio),
-            )
+        response = run_cancellable(
+            client.models.generate_content,
+            **_image_request(prompt, aspect_ratio),
+            cancel_token=cancel_token
         )
-        for part in response.parts:
-            if part.inline_data and part.inline_data.data:
-                print(f"✅ Sinh ảnh thành công ({len(part.inline_data.data)} bytes)")
-                return part.inline_data.data
-
-        print("❌ API không trả về dữ liệu ảnh.")
-        return None
+        return _image_bytes(response)
             
     except Exception as e:
         print(f"❌ Lỗi sinh ảnh: {str(e)}")
         return None
 
+async def generate_image_from_text_async(prompt, aspect_ratio="1:1", client=None, metrics=None):
+    """
+    Bản asyncio (client.aio): client dùng chung cho nhiều ảnh; metrics là TaskMetrics của tác vụ
+    (event loop chạy nhiều tác vụ trên một luồng). Lỗi 429 được raise để bộ giới hạn tốc độ xử lý.
+    """
+    from process.async_pipeline import is_rate_limit_error
+    from process.metrics import bind
+
+    try:
+        client = client or make_image_client()
+        if client is None:
+            return None
+
+        print(f"🎨 Đang sinh ảnh: {prompt[:30]}...")
+        response = await client.aio.models.generate_content(**_image_request(prompt, aspect_ratio))
+        with bind(metrics):
+            return _image_bytes(response)
+
+    except Exception as e:
+        if is_rate_limit_error(e):
+            raise
+        print(f"❌ Lỗi sinh ảnh: {str(e)}")
+        return None
+
 # Hàm phụ trợ giữ nguyên
 def get_image_size_for_aspect_ratio(aspect_ratio, base_width_inches=3.0):
     try:
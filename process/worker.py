@@ -0,0 +1,407 @@
+import argparse
+import os
+import shutil
+import signal
+import socket
+import sys
+import threading
+import time
+import uuid
+from typing import Optional
+
+# Cho phép chạy trực tiếp: python process/worker.py ...
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from process.job_queue import JobQueue, LeaseKeeper, STATE_DEAD, estimate_group_size
+from process.cancellation import CancellationToken, OperationCancelled
+from process.pipeline import TASK_TYPES
+from process.metrics import MetricsLog, TaskMetrics, aggregate, bind, format_summary
+from process.profiling import new_task_profiler, section
+
+# ============================================================
+# WORKER DAEMON - NHIỀU MÁY CHIA NHAU MỘT HÀNG ĐỢI
+# ============================================================
+#
+# Chạy worker (mỗi máy một lệnh, cùng trỏ vào ổ mạng dùng chung):
+#   python -m process.worker run --spool //server/genques/spool --output //server/genques/output --threads 4
+# Đẩy việc vào hàng đợi:
+#   python -m process.worker enqueue --spool ... --group "Bài 1" --types TN DS a.pdf b.pdf
+# Xem trạng thái:
+#   python -m process.worker status --spool ...
+
+DEFAULT_MODEL_NAME = "gemini-2.5-pro"
+
+DEFAULT_PROMPT_FILES = {
+    "TN": "testTN.txt",
+    "DS": "testDS.txt",
+    "TLN": "testTLN.txt",
+}
+
+
+def open_queue(spool_dir: Optional[str] = None, db_path: Optional[str] = None, **kwargs):
+    """Mở hàng đợi: spool thư mục (nhiều máy) hoặc SQLite (nhiều tiến trình trên một máy)"""
+    if spool_dir:
+        from process.spool_queue import SpoolJobQueue
+        return SpoolJobQueue(spool_dir, **kwargs)
+    return JobQueue(db_path or "jobs.db", **kwargs)
+
+
+def make_worker_id() -> str:
+    host = socket.gethostname().replace("@", "_")
+    return f"{host}-{os.getpid()}-{uuid.uuid4().hex[:6]}"
+
+
+def run_job(job, queue, worker_id, output_root, project_id, creds, model_name=DEFAULT_MODEL_NAME,
+            cancel_token=None):
+    """
+    Xử lý một job với commit đúng-một-lần:
+    1. Sinh DOCX vào thư mục staging riêng của worker (cùng ổ với output).
+    2. begin_commit: chỉ thành công nếu worker vẫn giữ lease.
+    3. os.replace vào output/<batch_name>/ (+ link sang các nhóm trùng nội dung) rồi đánh dấu done.
+    Trả về (output_path, error_msg).
+    """
+    from process.response2docx import response2docx_flexible, ensure_output_folder_for_batch
+    from process.preview_html import preview_path_for
+    from process.exporters import canonical_json_path_for
+    from process.dedupe import link_alias_outputs
+
+    payload = job.payload
+    task_type = payload["task_type"]
+    question_type, suffix = TASK_TYPES.get(task_type, TASK_TYPES["TN"])
+    batch_name = payload["output_name"]
+    file_name = f"{batch_name}{suffix}"
+
+    stage_root = os.path.join(output_root, ".staging", worker_id, str(job.id).replace(".json", ""))
+    try:
+        staged_path = response2docx_flexible(
+            payload["pdf_files"],
+            payload["prompt_content"],
+            file_name,
+            project_id,
+            creds,
+            model_name,
+            question_type=question_type,
+            batch_name=batch_name,
+            output_root=stage_root,
+            cancel_token=cancel_token,
+            page_ranges=payload.get("page_ranges")
+        )
+        if not staged_path or not os.path.exists(staged_path):
+            return None, "Hàm trả về None hoặc file không tồn tại"
+
+        final_folder = ensure_output_folder_for_batch(batch_name, output_root)
+        final_path = os.path.join(final_folder, os.path.basename(staged_path))
+
+        if not queue.begin_commit(job.id, worker_id, final_path, staged_path):
+            # Lease đã bị thu hồi (worker khác đang/đã làm job này) -> bỏ kết quả của mình
+            print(f"⚠️ Mất lease job {job.id}, bỏ kết quả để tránh ghi trùng")
+            return None, None
+
+        try:
+            os.replace(staged_path, final_path)
+            for sidecar_path_for in (preview_path_for, canonical_json_path_for):
+                staged_sidecar = sidecar_path_for(staged_path)
+                if os.path.exists(staged_sidecar):
+                    os.replace(staged_sidecar, sidecar_path_for(final_path))
+        except OSError as e:
+            # VD: file .docx đang mở trong Word (Windows). Job đang 'committing' -> fail() trả về hàng đợi
+            return None, f"Không ghi được file kết quả {final_path}: {e}"
+        aliases = payload.get("aliases")
+        if aliases:
+            # Nhóm trùng nội dung (gộp ở GUI) nhận bản link của kết quả, như pipeline.save_item
+            link_alias_outputs(final_path, batch_name, aliases)
+        queue.complete(job.id, worker_id, final_path)
+        return final_path, None
+    finally:
+        shutil.rmtree(stage_root, ignore_errors=True)
+        try:
+            os.rmdir(os.path.dirname(stage_root))
+        except OSError:
+            pass
+
+
+class WorkerDaemon:
+    """Worker chạy nền: N luồng lease job + 1 luồng heartbeat của node"""
+
+    def __init__(self, queue, output_root, project_id, creds, threads=3,
+                 model_name=DEFAULT_MODEL_NAME, drain=False, poll_interval=5.0,
+                 heartbeat_interval=30.0, worker_id=None):
+        self.queue = queue
+        self.output_root = os.path.abspath(output_root)
+        self.project_id = project_id
+        self.creds = creds
+        self.threads = threads
+        self.model_name = model_name
+        self.drain = drain
+        self.poll_interval = poll_interval
+        self.heartbeat_interval = heartbeat_interval
+        self.worker_id = worker_id or make_worker_id()
+        self.stop_event = threading.Event()
+        self.cancel_token = CancellationToken()
+        self.lock = threading.Lock()
+        self.in_flight = {}
+        self.done_count = 0
+        self.failed_count = 0
+        self.metrics_log = MetricsLog(os.path.join(self.output_root, ".metrics", f"{self.worker_id}.jsonl"))
+
+    def _node_info(self):
+        with self.lock:
+            return {
+                "threads": self.threads,
+                "in_flight": list(self.in_flight.values()),
+                "done": self.done_count,
+                "failed": self.failed_count,
+            }
+
+    def _heartbeat_loop(self):
+        while not self.stop_event.is_set():
+            try:
+                self.queue.register_worker(self.worker_id, self._node_info())
+            except Exception as e:
+                print(f"⚠️ Lỗi heartbeat worker: {e}")
+            self.stop_event.wait(self.heartbeat_interval)
+        self.queue.close()
+
+    def _consume_loop(self, slot):
+        owner = f"{self.worker_id}-{slot}"
+        try:
+            while not self.stop_event.is_set():
+                job = self.queue.lease(owner)
+                if job is None:
+                    if self.drain and not self.queue.has_active():
+                        return
+                    self.stop_event.wait(self.poll_interval)
+                    continue
+
+                label = f"{job.output_name} ({job.task_type})"
+                with self.lock:
+                    self.in_flight[owner] = label
+                print(f"▶️ [{owner}] Bắt đầu {label} (lần {job.attempts}/{job.max_attempts})")
+
+                metrics = TaskMetrics(label, task_type=job.task_type, worker=owner)
+                profiler = new_task_profiler(label)
+                status = "cancelled"
+                with LeaseKeeper(self.queue, job.id, owner), bind(metrics), section(profiler):
+                    try:
+                        result_path, error_msg = run_job(
+                            job, self.queue, owner, self.output_root,
+                            self.project_id, self.creds, self.model_name,
+                            cancel_token=self.cancel_token
+                        )
+                        status = "done" if result_path else "error"
+                    except OperationCancelled:
+                        self.queue.release(job.id, owner)
+                        print(f"⏹️ [{owner}] Đã hủy {label}, trả job về hàng đợi")
+                        result_path, error_msg = None, None
+                    except Exception as e:
+                        result_path, error_msg = None, str(e)
+                        status = "error"
+                self.metrics_log.write(metrics, job_id=job.id, status=status, error=error_msg)
+                if profiler is not None:
+                    profile_path = profiler.dump()
+                    if profile_path:
+                        print(f"🔬 [{owner}] Profile {label}: {profile_path}")
+
+                with self.lock:
+                    self.in_flight.pop(owner, None)
+
+                if result_path:
+                    with self.lock:
+                        self.done_count += 1
+                    print(f"✅ [{owner}] Xong {label}: {result_path}")
+                elif error_msg:
+                    new_state = self.queue.fail(job.id, owner, error_msg)
+                    if new_state == STATE_DEAD:
+                        with self.lock:
+                            self.failed_count += 1
+                    print(f"⚠️ [{owner}] Lỗi {label} -> {new_state or 'mất lease'}: {error_msg}")
+        finally:
+            self.queue.close()
+
+    def run(self):
+        print(f"🚀 Worker {self.worker_id}: {self.threads} luồng, output = {self.output_root}")
+        heartbeat = threading.Thread(target=self._heartbeat_loop, daemon=True)
+        heartbeat.start()
+
+        consumers = [threading.Thread(target=self._consume_loop, args=(i,), daemon=True)
+                     for i in range(self.threads)]
+        for t in consumers:
+            t.start()
+            # Giãn cách khởi động để tránh 429
+            time.sleep(0.1)
+
+        try:
+            while any(t.is_alive() for t in consumers):
+                for t in consumers:
+                    t.join(timeout=1)
+        except KeyboardInterrupt:
+            self.stop()
+
+        self.stop_event.set()
+        heartbeat.join(timeout=5)
+        print(f"🏁 Worker dừng. ✅ {self.done_count} | ❌ {self.failed_count}")
+        timing = format_summary(aggregate(self.metrics_log.records))
+        if timing:
+            print(timing)
+
+    def stop(self):
+        print("🛑 Đang dừng worker (hủy các job đang chạy, trả về hàng đợi)...")
+        self.stop_event.set()
+        self.cancel_token.cancel()
+
+
+# ============================================================
+# CLI
+# ============================================================
+
+def _add_queue_args(parser):
+    parser.add_argument("--spool", help="Thư mục spool dùng chung (ổ mạng)")
+    parser.add_argument("--db", help="File SQLite (nhiều tiến trình trên cùng một máy)")
+    parser.add_argument("--visibility-timeout", type=float, default=1800,
+                        help="Số giây job bị thu hồi nếu worker không heartbeat")
+    parser.add_argument("--max-attempts", type=int, default=3)
+
+
+def _queue_from_args(args):
+    return open_queue(args.spool, args.db, visibility_timeout=args.visibility_timeout,
+                      max_attempts=args.max_attempts)
+
+
+def cmd_run(args):
+    from api.callAPI import get_vertex_ai_credentials
+
+    creds = get_vertex_ai_credentials()
+    project_id = os.getenv("PROJECT_ID")
+    if not creds or not project_id:
+        print("❌ Thiếu Credentials/Project ID, không thể chạy worker")
+        return 1
+
+    daemon = WorkerDaemon(
+        _queue_from_args(args), args.output, project_id, creds,
+        threads=args.threads, model_name=args.model, drain=args.drain,
+        worker_id=args.worker_id
+    )
+    metrics_server = None
+    if args.metrics_port:
+        from process.metrics_server import MetricsServer, build_generation_registry
+
+        registry = build_generation_registry(
+            _queue_from_args(args), in_flight=lambda: len(daemon.in_flight)
+        )
+        metrics_server = MetricsServer(registry, args.metrics_port, args.metrics_host).start()
+    signal.signal(signal.SIGTERM, lambda *_: daemon.stop())
+    try:
+        daemon.run()
+    finally:
+        if metrics_server is not None:
+            metrics_server.stop()
+    return 0
+
+
+def _page_ranges_from_args(pages_args, pdf_files):
+    """--pages 40-62 (cả nhóm) / --pages sgk.pdf=40-62 (từng file) -> {đường dẫn: khoảng trang}"""
+    from process.pdf_pages import PageRangeError, parse_page_ranges
+
+    page_ranges = {}
+    for value in pages_args or []:
+        name, sep, spec = value.rpartition("=")
+        parse_page_ranges(spec)  # báo lỗi sớm, trước khi vào hàng đợi
+        if not sep:
+            page_ranges.update({path: spec for path in pdf_files})
+            continue
+        matched = [path for path in pdf_files
+                   if os.path.basename(path) == name or path == os.path.abspath(name)]
+        if not matched:
+            raise PageRangeError(f"--pages {value}: không có file {name} trong nhóm")
+        page_ranges.update({path: spec for path in matched})
+    return page_ranges
+
+
+def cmd_enqueue(args):
+    from process.pdf_pages import PageRangeError
+
+    queue = _queue_from_args(args)
+    pdf_files = [os.path.abspath(p) for p in args.pdfs]
+    group = args.group or os.path.splitext(os.path.basename(pdf_files[0]))[0]
+    try:
+        page_ranges = _page_ranges_from_args(args.pages, pdf_files)
+    except PageRangeError as e:
+        print(f"❌ {e}")
+        return 2
+
+    for task_type in args.types:
+        prompt_path = getattr(args, f"prompt_{task_type.lower()}") or DEFAULT_PROMPT_FILES[task_type]
+        with open(prompt_path, "r", encoding="utf-8") as f:
+            prompt_content = f.read()
+        payload = {
+            "output_name": group,
+            "pdf_files": pdf_files,
+            "task_type": task_type,
+            "prompt_content": prompt_content,
+        }
+        if page_ranges:
+            payload["page_ranges"] = page_ranges
+        job_id = queue.enqueue(task_type, group, payload, batch_id=args.batch_id,
+                               size_hint=estimate_group_size(pdf_files))
+        print(f"📥 Đã thêm {group} ({task_type}) -> job {job_id}")
+    return 0
+
+
+def cmd_status(args):
+    queue = _queue_from_args(args)
+    print("📊 Hàng đợi:", queue.stats())
+    for worker_id, info in queue.live_workers().items():
+        print(f"   🖥️ {worker_id}: {info}")
+    for job in queue.dead_letters():
+        print(f"   ☠️ {job.output_name} ({job.task_type}): {job.last_error}")
+    return 0
+
+
+def cmd_requeue_dead(args):
+    print(f"🔁 Đã đưa lại {_queue_from_args(args).requeue_dead()} job vào hàng đợi")
+    return 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="GenQues worker daemon")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p_run = sub.add_parser("run", help="Chạy worker lấy việc từ hàng đợi")
+    _add_queue_args(p_run)
+    p_run.add_argument("--output", required=True, help="Thư mục output dùng chung")
+    p_run.add_argument("--threads", type=int, default=3)
+    p_run.add_argument("--model", default=DEFAULT_MODEL_NAME)
+    p_run.add_argument("--worker-id")
+    p_run.add_argument("--drain", action="store_true", help="Thoát khi hàng đợi trống")
+    p_run.add_argument("--metrics-port", type=int, default=int(os.getenv("METRICS_PORT", "0")),
+                       help="Mở endpoint Prometheus /metrics ở cổng này (0 = tắt)")
+    p_run.add_argument("--metrics-host", default="127.0.0.1")
+    p_run.set_defaults(func=cmd_run)
+
+    p_enq = sub.add_parser("enqueue", help="Thêm một nhóm PDF vào hàng đợi")
+    _add_queue_args(p_enq)
+    p_enq.add_argument("--group", help="Tên nhóm (= tên thư mục output)")
+    p_enq.add_argument("--types", nargs="+", choices=list(TASK_TYPES), default=["TN", "DS", "TLN"])
+    p_enq.add_argument("--prompt-tn")
+    p_enq.add_argument("--prompt-ds")
+    p_enq.add_argument("--prompt-tln")
+    p_enq.add_argument("--batch-id")
+    p_enq.add_argument("--pages", action="append",
+                       help="Chỉ gửi các trang này: 40-62,70 cho cả nhóm hoặc sgk.pdf=40-62 cho một file (lặp lại được)")
+    p_enq.add_argument("pdfs", nargs="+")
+    p_enq.set_defaults(func=cmd_enqueue)
+
+    p_status = sub.add_parser("status", help="Xem trạng thái hàng đợi và các worker")
+    _add_queue_args(p_status)
+    p_status.set_defaults(func=cmd_status)
+
+    p_requeue = sub.add_parser("requeue-dead", help="Chạy lại các job trong dead-letter")
+    _add_queue_args(p_requeue)
+    p_requeue.set_defaults(func=cmd_requeue_dead)
+
+    args = parser.parse_args(argv)
+    return args.func(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
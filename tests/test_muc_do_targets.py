@@ -0,0 +1,12 @@
+from process.question_model import parse_muc_do_targets
+
+
+def test_explicit_counts_take_priority_over_percent():
+    prompt = "+ 50% Thông hiểu (20 câu).\n+ 30% Vận dụng (12 câu).\n+ 20% Vận dụng cao (8 câu)."
+    assert parse_muc_do_targets(prompt, 40) == {"thong_hieu": 20, "van_dung": 12, "van_dung_cao": 8}
+
+
+def test_percent_targets_and_no_levels():
+    prompt = "- 50% - Vận dụng: ...\n- 50% - Vận dụng cao: ..."
+    assert parse_muc_do_targets(prompt, 10) == {"van_dung": 5, "van_dung_cao": 5}
+    assert parse_muc_do_targets("Soạn đề trắc nghiệm", 10) == {}
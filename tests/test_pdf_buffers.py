@@ -0,0 +1,47 @@
+import os
+import threading
+
+import pytest
+
+from process.cancellation import CancellationToken
+from process.pdf_buffers import PdfBufferPool
+
+
+def _write(path, size):
+    with open(path, "wb") as f:
+        f.write(b"%PDF" + b"x" * (size - 4))
+    return str(path)
+
+
+def test_group_with_unreadable_file_releases_remaining_claims(tmp_path):
+    """Nạp lỗi file đầu nhóm không được để các file sau kẹt ở trạng thái đang nạp"""
+    pool = PdfBufferPool(limit_bytes=10_000)
+    bad = _write(tmp_path / "a.pdf", 100)
+    good = _write(tmp_path / "b.pdf", 200)
+    real_load = pool._load
+
+    def load_deleted(key):
+        # File bị xóa giữa lúc stat (giữ chỗ) và lúc đọc -> _load lỗi thật
+        if key[0] == os.path.abspath(bad):
+            os.remove(bad)
+        return real_load(key)
+
+    pool._load = load_deleted
+
+    with pytest.raises(OSError):
+        pool.acquire([bad, good])
+
+    assert pool._loading == {}
+    assert pool.loaded_bytes == 0
+
+    # Lần sau lấy riêng b.pdf phải nạp được ngay, không chờ tới khi bị hủy
+    token = CancellationToken()
+    timer = threading.Timer(5, token.cancel)
+    timer.start()
+    try:
+        buffers = pool.acquire([good], token)
+    finally:
+        timer.cancel()
+    assert [buffer.path for buffer in buffers] == [os.path.abspath(good)]
+    pool.release(buffers)
+    assert pool.stats()["idle_files"] == 1
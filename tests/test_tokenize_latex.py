@@ -0,0 +1,12 @@
+from process.response2docx import tokenize_latex_text
+
+
+def test_display_math_spanning_lines_stays_math():
+    """\\[ ... \\] qua nhiều dòng không khớp regex tách nhưng vẫn phải đi nhánh công thức như bản gốc"""
+    tokens = tokenize_latex_text("\\[ x^2\n+ 1 \\] với $y$")
+    assert tokens == [(True, "\\[ x^2\n+ 1 \\] với "), (True, "$y$")]
+
+
+def test_html_cleanup_runs_in_original_order():
+    # &nbsp; bỏ trước rồi mới tới &lt; (như chuỗi replace gốc); <br> đổi trước khi bỏ thẻ
+    assert tokenize_latex_text("a&&nbsp;lt;b<b<br>>c") == [(False, "abc")]